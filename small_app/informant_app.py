@@ -2,11 +2,13 @@ import argparse
 import sys
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QTableWidget, QTableWidgetItem, QListWidget, QLabel, QPushButton, QComboBox
+    QTableView, QListWidget, QLabel, QPushButton, QComboBox, QLineEdit
 )
 from PySide6.QtGui import QColor, QPalette
 from PySide6.QtCore import QTimer
 
+from table_models import DHTTableModel
+
 
 class InformantNodeGUI(QMainWindow):
     def __init__(self, informant_node):
@@ -34,11 +36,19 @@ class InformantNodeGUI(QMainWindow):
         theme_layout.addWidget(self.theme_selector)
         main_layout.addLayout(theme_layout)
 
-        # DHT Table
-        self.dht_table = QTableWidget(0, 3)
-        self.dht_table.setHorizontalHeaderLabels(["Filename", "Host", "Ports"])
+        # DHT Table, rows are built on a worker thread and fetched by the view on demand
+        dht_layout = QVBoxLayout()
+        self.dht_filter = QLineEdit()
+        self.dht_filter.setPlaceholderText("Filter by filename")
+        self.dht_model = DHTTableModel(self.informant_node.dht, self)
+        self.dht_filter.textChanged.connect(self.dht_model.set_filter)
+        self.dht_table = QTableView()
+        self.dht_table.setModel(self.dht_model)
+        self.dht_table.setSortingEnabled(True)
         self.dht_table.horizontalHeader().setStretchLastSection(True)
-        main_layout.addWidget(self.dht_table)
+        dht_layout.addWidget(self.dht_filter)
+        dht_layout.addWidget(self.dht_table)
+        main_layout.addLayout(dht_layout)
 
         # Nodes List
         nodes_layout = QVBoxLayout()
@@ -96,7 +106,7 @@ class InformantNodeGUI(QMainWindow):
 
         # Apply table styles
         table_style = f"""
-            QTableWidget {{
+            QTableView {{
                 background-color: {theme['background']};
                 color: {theme['text']};
                 gridline-color: {theme['accent']};
@@ -109,16 +119,8 @@ class InformantNodeGUI(QMainWindow):
         self.dht_table.setStyleSheet(table_style)
 
     def refresh_data(self):
-        # Refresh DHT Table
-        self.dht_table.setRowCount(0)
-        dht_data = self.informant_node.dht.get_all_files()
-        for filename, file_data in dht_data.items():
-            for host, ports in file_data["providers"].items():
-                row_position = self.dht_table.rowCount()
-                self.dht_table.insertRow(row_position)
-                self.dht_table.setItem(row_position, 0, QTableWidgetItem(filename))
-                self.dht_table.setItem(row_position, 1, QTableWidgetItem(host))
-                self.dht_table.setItem(row_position, 2, QTableWidgetItem(", ".join(ports.keys())))
+        # Refresh DHT Table (in the background)
+        self.dht_model.refresh()
 
         # Refresh Nodes List
         self.nodes_list.clear()
@@ -3,13 +3,17 @@ import json
 import logging
 import asyncio
 from models.dht import DHT
+from services.runtime import NodeRuntime
 from services.uwu_protocol.service import UWUService
-from services.uwu_protocol.base_handler import UWUHandlerBase
-from services.uwu_protocol.enums import MessageType, RequestAction, ResponseAction
-from services.uwu_protocol.protocol import UWUProtocol
+from services.uwu_protocol.base_handler import UWUHandlerBase, read_only
+from services.uwu_protocol.enums import MessageType, RequestAction, ResponseAction, Lane
+from services.uwu_protocol.protocol import UWUProtocol, FRAME_DELIMITER
+from services.uwu_protocol.log import get_logger, Summary
 
 logging.basicConfig(level=logging.INFO)
 
+log = get_logger("handler")
+
 
 class InformantNodeHandler(UWUHandlerBase):
     def __init__(self, informant_node):
@@ -21,7 +25,7 @@ class InformantNodeHandler(UWUHandlerBase):
         """
         return {
             (MessageType.REQUEST, RequestAction.REGISTER): self.handle_register,
-            (MessageType.REQUEST, RequestAction.GET_DHT): self.handle_get_dht,
+            (MessageType.REQUEST, RequestAction.GET_DHT): (self.handle_get_dht, Lane.BULK),
         }
 
     async def handle_register(self, message, reader, writer):
@@ -32,15 +36,19 @@ class InformantNodeHandler(UWUHandlerBase):
             peer_info = message.get("peer_info")
             files = message.get("data", {}).get("files", [])
             if peer_info and files:
-                for file in files:
-                    self.informant_node.dht.add_file(
-                        filename=file["filename"],
-                        host=peer_info["host"],
-                        port=peer_info["port"],
-                        details={"size": file["size"]}
-                    )
-                logging.info(f"Files registered by peer {peer_info['host']}:{peer_info['port']}")
-                response = UWUProtocol.create_message(MessageType.RESPONSE, ResponseAction.REGISTER_ACK, peer_info, {"data": "Files registered successfully"})
+                # One batch per register, so the DHT is broadcast and saved once instead of once per file
+                with self.informant_node.dht.batch():
+                    for file in files:
+                        self.informant_node.dht.add_file(
+                            filename=file["filename"],
+                            host=peer_info["host"],
+                            port=peer_info["port"],
+                            details={"size": file["size"]}
+                        )
+                log.sampled(logging.INFO, "registered", "Files registered by peer %s:%s", peer_info["host"],
+                            peer_info["port"])
+                response = UWUProtocol.create_message(MessageType.RESPONSE, ResponseAction.REGISTER_ACK, peer_info, {"data": "Files registered successfully"},
+                                                      request_id=message.get("id"))
                 writer.write(response)
                 await writer.drain()
             else:
@@ -51,7 +59,8 @@ class InformantNodeHandler(UWUHandlerBase):
                 MessageType.ERROR,
                 ResponseAction.REGISTER_ACK,
                 {},
-                {"message": "Failed to register files"}
+                {"message": "Failed to register files"},
+                request_id=message.get("id")
             )
             writer.write(response)
             await writer.drain()
@@ -66,30 +75,31 @@ class InformantNodeHandler(UWUHandlerBase):
         writer.write(json.dumps(response).encode())
         await writer.drain()
 
+    @read_only
     async def handle_get_dht(self, message, reader, writer):
         """
-        Handle requests to retrieve the current DHT.
+        Handle requests to retrieve the current DHT. The response goes back on the connection of the request.
         """
         try:
-            logging.info(f"DHT request from {message['peer_info']}")
+            log.debug("DHT request from %s", message["peer_info"])
             response = UWUProtocol.create_message(
                 msg_type=MessageType.RESPONSE,
                 action=ResponseAction.GET_DHT_RESPONSE,
                 peer_info=message["peer_info"],
-                data={"dht": self.informant_node.dht.get_all_files()}
+                data={"dht": self.informant_node.dht.get_all_files()},
+                request_id=message.get("id")
             )
-            new_reader, new_writer = await asyncio.open_connection(message["peer_info"]["host"], message["peer_info"]["port"])
-            new_writer.write(response)
-            await new_writer.drain()
-            logging.info(f"Sending DHT response: {response.decode()}")
+            writer.write(response)
+            await writer.drain()
+            log.debug("Sent DHT response: %s", Summary(response))
         except Exception as e:
             logging.error(f"Error handling GET_DHT request: {e}")
-            self.send_error_from_exception(writer, e)
+            self.send_error_from_exception(writer, e, message.get("id"))
         finally:
             writer.close()
             await writer.wait_closed()
 
-    def send_error_from_exception(self, writer, exception):
+    def send_error_from_exception(self, writer, exception, request_id=None):
         """
         Send an error message in response to an exception.
         """
@@ -97,7 +107,8 @@ class InformantNodeHandler(UWUHandlerBase):
             MessageType.ERROR,
             ResponseAction.ERROR,
             {},
-            {"message": str(exception) if exception else "Unknown error"}
+            {"message": str(exception) if exception else "Unknown error"},
+            request_id=request_id
         )
         writer.write(error_response)
 
@@ -111,6 +122,9 @@ class InformantNode:
         self.dht.bind_on_change(self.broadcast_dht)
         self.handler = InformantNodeHandler(self)
 
+        # Single event loop of the node, the service and the broadcasts share it
+        self.runtime = NodeRuntime(name=f"informant_node_{self.port}")
+
     def get_peers(self):
         """
         Get the list of connected peers.
@@ -129,23 +143,25 @@ class InformantNode:
         """
         Update the DHT with data from a peer.
         """
-        for filename, file_data in dht_data.items():
-            for provider, details in file_data.get("providers", {}).items():
-                host, port = provider
-                self.dht.add_file(filename, host, port, details)
+        with self.dht.batch():
+            for filename, file_data in dht_data.items():
+                for provider, details in file_data.get("providers", {}).items():
+                    host, port = provider
+                    self.dht.add_file(filename, host, port, details)
 
     def broadcast_dht(self):
         """
-        Broadcast the DHT to all connected peers.
+        Broadcast the DHT to all connected peers. The message is encoded once and sent to every peer concurrently
+        from the runtime loop, so a DHT change never waits on the network.
         """
+        if not self.peers or not self.runtime.is_running():
+            return
+
+        payload = json.dumps({"type": "REQUEST", "action": "DHT_UPDATE", "data": self.dht.get_all_files()}).encode()
         for peer in self.peers:
             try:
                 peer_ip, peer_port = peer.split(":")
-                self.send_message(
-                    {"type": "REQUEST", "action": "DHT_UPDATE", "data": self.dht.get_all_files()},
-                    peer_ip,
-                    int(peer_port),
-                )
+                self.runtime.submit(self.send_payload(payload, peer_ip, int(peer_port)))
             except Exception as e:
                 logging.error(f"Failed to broadcast to peer {peer}: {e}")
 
@@ -153,31 +169,31 @@ class InformantNode:
         """
         Get a list of tuples (host, port) for connected nodes.
         """
-        connected_nodes = []
-        # The connected nodes is all the nodes present on the DHT
-        for filename, file_data in self.dht.get_all_files().items():
-            for host, ports in file_data["providers"].items():
-                for port in ports.keys():
-                    connected_nodes.append((host, int(port)))
-        # remove duplicates
-        connected_nodes = list(set(connected_nodes))
-
-        return connected_nodes
+        # The connected nodes is all the nodes present on the DHT, taken from its node index
+        return self.dht.get_nodes()
 
     def send_message(self, message, peer_ip, peer_port):
         """
-        Send a message to a peer.
+        Send a message to a peer, from any thread. Returns a concurrent.futures.Future of the send.
+        """
+        return self.runtime.submit(self.send_payload(json.dumps(message).encode(), peer_ip, peer_port))
+
+    async def send_payload(self, payload: bytes, peer_ip, peer_port):
+        """
+        Send an encoded message to a peer, on the runtime loop.
         """
         try:
-            with socket.create_connection((peer_ip, peer_port)) as client:
-                client.sendall(json.dumps(message).encode())
-                logging.info(f"Message sent to {peer_ip}:{peer_port}")
+            async with self.runtime.connection(peer_ip, peer_port, timeout=5) as (reader, writer):
+                writer.write(payload + FRAME_DELIMITER)
+                await writer.drain()
+            logging.info(f"Message sent to {peer_ip}:{peer_port}")
         except Exception as e:
             logging.error(f"Failed to send message to {peer_ip}:{peer_port}: {e}")
 
     def start_informant_node(self):
         """
-        Start the informant node service.
+        Start the informant node runtime, with the service on its loop.
         """
-        service = UWUService(host=self.host, port=self.port, handler=self.handler)
+        self.runtime.start()
+        service = UWUService(host=self.host, port=self.port, handler=self.handler, runtime=self.runtime)
         service.start_service()
@@ -1,6 +1,7 @@
 import json
 import os
-from threading import Lock
+from contextlib import contextmanager
+from threading import RLock
 import logging
 
 PERSISTENCE_DEFAULT_FILE = os.path.join(os.path.dirname(__file__), "data", "dht_persistence.json")
@@ -9,10 +10,14 @@ PERSISTENCE_DEFAULT_FILE = os.path.join(os.path.dirname(__file__), "data", "dht_
 class DHT:
     """
     Distributed Hash Table (DHT) for file sharing.
+
+    Mutations run inside batch(), so a group of them notifies and persists only once.
     """
     def __init__(self, persistence_file=None):
         self._dht = {}
-        self._lock = Lock()
+        self._lock = RLock()
+        self._batch_depth = 0
+        self._changed = False
         self._node_files = {}  # (host, port) -> set of filenames
         self.persistence_file = persistence_file
         self._on_change = None  # Hook for ViewModel
@@ -46,11 +51,35 @@ class DHT:
         self._on_change = callback
 
     def _notify_change(self):
+        if self._batch_depth:
+            # Coalesced into a single notification when the outermost batch exits
+            self._changed = True
+            return
+
         logging.info("[DHT] DHT changed, notifying...")
         if self._on_change:
             self._on_change()
         self._save_persistent_data()
 
+    @contextmanager
+    def batch(self):
+        """
+        Groups several mutations under one lock acquisition, with a single notification and save at the end:
+
+            with dht.batch():
+                for file in files:
+                    dht.add_file(...)
+        """
+        with self._lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0 and self._changed:
+                    self._changed = False
+                    self._notify_change()
+
     def _rebuild_node_files(self):
         """
         Rebuilds the _node_files index from the current DHT.
@@ -71,7 +100,7 @@ class DHT:
         }
 
     def add_file(self, filename: str, host: str, port: int, details: dict):
-        with self._lock:
+        with self.batch():
             entry = self._dht.get(filename)
 
             if entry:
@@ -86,32 +115,47 @@ class DHT:
             self._node_files.setdefault((host, port), set()).add(filename)
             self._notify_change()
 
-    def remove_file(self, filename: str, host: str, port: int):
-        with self._lock:
-            if filename in self._dht:
-                providers = self._dht[filename]["providers"]
-                if host in providers and str(port) in providers[host]:
-                    del providers[host][str(port)]
-                    if not providers[host]:
-                        del providers[host]
-                if not providers:
-                    del self._dht[filename]
-
-                if (host, port) in self._node_files:
-                    self._node_files[(host, port)].discard(filename)
-                    if not self._node_files[(host, port)]:
-                        del self._node_files[(host, port)]
+    def _remove_file_locked(self, filename: str, host: str, port: int) -> bool:
+        """
+        Removes a provider of a file. The caller must hold the lock and notify the change.
+        :return: True if the file was in the DHT.
+        """
+        if filename not in self._dht:
+            return False
+
+        providers = self._dht[filename]["providers"]
+        if host in providers and str(port) in providers[host]:
+            del providers[host][str(port)]
+            if not providers[host]:
+                del providers[host]
+        if not providers:
+            del self._dht[filename]
+
+        if (host, port) in self._node_files:
+            self._node_files[(host, port)].discard(filename)
+            if not self._node_files[(host, port)]:
+                del self._node_files[(host, port)]
+
+        return True
 
+    def remove_file(self, filename: str, host: str, port: int):
+        with self.batch():
+            if self._remove_file_locked(filename, host, port):
                 self._notify_change()
 
     def remove_all_files_for_node(self, host: str, port: int):
-        with self._lock:
-            filenames = self._node_files.get((host, port), set()).copy()
+        """
+        Removes every file of a node using the node index, with a single notification.
+        """
+        with self.batch():
+            filenames = self._node_files.pop((host, port), set())
             for filename in filenames:
-                self.remove_file(filename, host, port)
+                self._remove_file_locked(filename, host, port)
+            if filenames:
+                self._notify_change()
 
     def update_node_files(self, host: str, port: int, files: list):
-        with self._lock:
+        with self.batch():
             current_filenames = {file["filename"] for file in files}
             old_filenames = self._node_files.get((host, port), set()).copy()
 
@@ -124,7 +168,24 @@ class DHT:
             for filename in stale_files:
                 self.remove_file(filename, host, port)
 
-            self._notify_change()
+    def get_nodes(self) -> list:
+        """
+        Returns the (host, port) of every node with files in the DHT.
+        """
+        with self._lock:
+            return list(self._node_files.keys())
+
+    def get_entries(self) -> list:
+        """
+        Returns every (filename, host, port, details) entry of the DHT as flat tuples.
+        """
+        with self._lock:
+            return [
+                (filename, host, int(port), provider.get("details"))
+                for filename, file_data in self._dht.items()
+                for host, ports in file_data["providers"].items()
+                for port, provider in ports.items()
+            ]
 
     def get_all_files(self) -> dict:
         with self._lock:
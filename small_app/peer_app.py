@@ -14,6 +14,13 @@ def main():
     parser.add_argument("--informant_ip", type=str, default="127.0.0.1", help="IP address of the Informant Node.")
     parser.add_argument("--informant_port", type=int, default=6942, help="Port of the Informant Node.")
     parser.add_argument("--shared_dir", type=str, default=None, help="Directory to share files from.")
+    parser.add_argument("--max_downloads", type=int, default=3, help="Number of downloads running at the same time.")
+    parser.add_argument("--fsync", type=str, default="on_close", choices=["never", "on_close", "periodic"],
+                        help="When downloaded files are synced to disk.")
+    parser.add_argument("--cache_mb", type=int, default=64, help="Memory used to cache the chunks of served files.")
+    parser.add_argument("--upload_slots", type=int, default=4, help="Number of uploads served at the same time.")
+    parser.add_argument("--upload_rate", type=int, default=None, help="Overall upload limit in KiB/s.")
+    parser.add_argument("--peer_upload_rate", type=int, default=None, help="Upload limit per downloading peer in KiB/s.")
     args = parser.parse_args()
 
     # Create Peer Node
@@ -23,6 +30,12 @@ def main():
         informant_host=args.informant_ip,
         informant_port=args.informant_port,
         shared_dir=args.shared_dir,
+        max_downloads=args.max_downloads,
+        fsync_policy=args.fsync,
+        cache_size=args.cache_mb * 1024 * 1024,
+        upload_slots=args.upload_slots,
+        upload_rate=args.upload_rate * 1024 if args.upload_rate else None,
+        peer_upload_rate=args.peer_upload_rate * 1024 if args.peer_upload_rate else None,
     )
     peer_node.start_peer_node()
 
@@ -1,11 +1,20 @@
 from PySide6.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
-    QTableWidget, QTableWidgetItem, QPushButton, QFileDialog, QLabel, QGroupBox, QComboBox
+    QTableView, QPushButton, QFileDialog, QLabel, QGroupBox, QComboBox
 )
-from PySide6.QtCore import QTimer
+from PySide6.QtCore import QObject, QTimer, Signal
 from PySide6.QtGui import QColor, QPalette
 import os
 
+from table_models import DiffTableModel, DownloadsTableModel
+
+
+class DownloadSignals(QObject):
+    """
+    Carries the download updates from the node's event loop thread to the GUI thread.
+    """
+    updated = Signal(object)
+
 
 class PeerNodeGUI(QMainWindow):
     def __init__(self, peer_node):
@@ -45,8 +54,9 @@ class PeerNodeGUI(QMainWindow):
         # Shared Files Section
         shared_files_group = QGroupBox("Shared Files (Local)")
         shared_files_layout = QVBoxLayout()
-        self.shared_files_table = QTableWidget(0, 2)
-        self.shared_files_table.setHorizontalHeaderLabels(["Filename", "Size"])
+        self.shared_files_model = DiffTableModel(["Filename", "Size"], self.list_shared_files, self)
+        self.shared_files_table = QTableView()
+        self.shared_files_table.setModel(self.shared_files_model)
         shared_files_layout.addWidget(self.shared_files_table)
         shared_files_group.setLayout(shared_files_layout)
         main_layout.addWidget(shared_files_group)
@@ -54,8 +64,10 @@ class PeerNodeGUI(QMainWindow):
         # DHT Files Section
         dht_files_group = QGroupBox("DHT Files (External)")
         dht_files_layout = QVBoxLayout()
-        self.dht_files_table = QTableWidget(0, 4)
-        self.dht_files_table.setHorizontalHeaderLabels(["Filename", "Size", "IP", "Port"])
+        self.dht_files_model = DiffTableModel(["Filename", "Size", "IP", "Port"], self.list_dht_files, self)
+        self.dht_files_table = QTableView()
+        self.dht_files_table.setModel(self.dht_files_model)
+        self.dht_files_table.setSelectionBehavior(QTableView.SelectRows)
         dht_files_layout.addWidget(self.dht_files_table)
         self.download_button = QPushButton("Download Selected File")
         self.download_button.clicked.connect(self.download_file)
@@ -63,6 +75,24 @@ class PeerNodeGUI(QMainWindow):
         dht_files_group.setLayout(dht_files_layout)
         main_layout.addWidget(dht_files_group)
 
+        # Downloads Section, updated from the download manager through a queued signal
+        downloads_group = QGroupBox("Downloads")
+        downloads_layout = QVBoxLayout()
+        self.downloads_model = DownloadsTableModel(self)
+        self.downloads_table = QTableView()
+        self.downloads_table.setModel(self.downloads_model)
+        self.downloads_table.setSelectionBehavior(QTableView.SelectRows)
+        downloads_layout.addWidget(self.downloads_table)
+        self.cancel_download_button = QPushButton("Cancel Selected Download")
+        self.cancel_download_button.clicked.connect(self.cancel_download)
+        downloads_layout.addWidget(self.cancel_download_button)
+        downloads_group.setLayout(downloads_layout)
+        main_layout.addWidget(downloads_group)
+
+        self.download_signals = DownloadSignals(self)
+        self.download_signals.updated.connect(self.downloads_model.update_download)
+        self.peer_node.downloads.bind_on_update(self.download_signals.updated.emit)
+
         # Timer to refresh both tables
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.refresh_tables)
@@ -103,7 +133,7 @@ class PeerNodeGUI(QMainWindow):
 
         # Apply table styles
         table_style = f"""
-            QTableWidget {{
+            QTableView {{
                 background-color: {theme['background']};
                 color: {theme['text']};
                 gridline-color: {theme['accent']};
@@ -115,6 +145,7 @@ class PeerNodeGUI(QMainWindow):
         """
         self.shared_files_table.setStyleSheet(table_style)
         self.dht_files_table.setStyleSheet(table_style)
+        self.downloads_table.setStyleSheet(table_style)
 
     # Other methods (change_shared_dir, refresh_tables, etc.) remain unchanged
 
@@ -130,62 +161,64 @@ class PeerNodeGUI(QMainWindow):
 
     def refresh_tables(self):
         """
-        Refresh both the shared files and DHT files tables.
+        Refresh both the shared files and DHT files tables. The listings are built on worker threads, only the rows
+        that changed since the last refresh reach the GUI thread.
         """
-        self.refresh_shared_files()
-        self.refresh_dht_files()
+        self.shared_files_model.refresh()
+        self.dht_files_model.refresh()
 
-    def refresh_shared_files(self):
+    def list_shared_files(self):
         """
-        Refresh the list of files shared by this node.
+        List the files shared by this node as {filename: (filename, size)}. Runs on a worker thread.
         """
-        self.shared_files_table.setRowCount(0)
-        for filename in os.listdir(self.peer_node.shared_dir):
-            file_path = os.path.join(self.peer_node.shared_dir, filename)
-            if os.path.isfile(file_path):
-                row_position = self.shared_files_table.rowCount()
-                self.shared_files_table.insertRow(row_position)
-                self.shared_files_table.setItem(row_position, 0, QTableWidgetItem(filename))
-                self.shared_files_table.setItem(row_position, 1, QTableWidgetItem(str(os.path.getsize(file_path))))
-
-    def refresh_dht_files(self):
+        rows = {}
+        with os.scandir(self.peer_node.shared_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    rows[entry.name] = (entry.name, entry.stat().st_size)
+        return rows
+
+    def list_dht_files(self):
         """
-        Refresh the list of files available in the DHT (external files).
+        List the files available in the DHT (external files) as {(filename, host, port): (filename, size, host, port)}.
+        Runs on a worker thread.
         """
-        self.dht_files_table.setRowCount(0)
-        dht_data = self.peer_node.dht  # Use the updated DHT structure
-        print(f"[PEER_GUI] DHT to be rendered: ", dht_data)
+        rows = {}
+        dht_data = self.peer_node.dht  # Replaced as a whole on every sync, never mutated in place
 
         for filename, file_info in dht_data.items():
             providers = file_info.get("providers", {})
             for host, ports in providers.items():
                 for port, port_data in ports.items():
-                    details = port_data.get("details", {})
-                    file_size = details.get("size", "Unknown")
+                    port = int(port)
 
                     # Skip files shared by this node
-                    if host == self.peer_node.host and int(port) == self.peer_node.port:
+                    if host == self.peer_node.host and port == self.peer_node.port:
                         continue
 
-                    row_position = self.dht_files_table.rowCount()
-                    self.dht_files_table.insertRow(row_position)
-                    self.dht_files_table.setItem(row_position, 0, QTableWidgetItem(filename))
-                    self.dht_files_table.setItem(row_position, 1, QTableWidgetItem(str(file_size)))
-                    self.dht_files_table.setItem(row_position, 2, QTableWidgetItem(host))
-                    self.dht_files_table.setItem(row_position, 3, QTableWidgetItem(str(port)))
+                    details = port_data.get("details") or {}
+                    file_size = details.get("size", "Unknown")
+                    rows[(filename, host, port)] = (filename, file_size, host, port)
+        return rows
 
     def download_file(self):
         """
         Download the selected file from the selected peer.
         """
-        selected_row = self.dht_files_table.currentRow()
-        if selected_row == -1:
+        selected_index = self.dht_files_table.currentIndex()
+        if not selected_index.isValid():
             return  # No row selected
 
-        filename = self.dht_files_table.item(selected_row, 0).text()
-        host = self.dht_files_table.item(selected_row, 2).text()
-        port = int(self.dht_files_table.item(selected_row, 3).text())
+        filename, size, host, port = self.dht_files_model.row_at(selected_index.row())
 
         save_path = QFileDialog.getSaveFileName(self, "Save File", filename)[0]
         if save_path:
-            self.peer_node.download_file(filename, host, port, save_path)
\ No newline at end of file
+            self.peer_node.download_file(filename, host, port, save_path, size if isinstance(size, int) else None)
+
+    def cancel_download(self):
+        """
+        Cancel the selected download.
+        """
+        selected_index = self.downloads_table.currentIndex()
+        if selected_index.isValid():
+            self.peer_node.cancel_download(self.downloads_model.download_id_at(selected_index.row()))
\ No newline at end of file
@@ -5,12 +5,22 @@ import os
 import socket
 import logging
 from services.uwu_protocol.service import UWUService
-from services.uwu_protocol.protocol import UWUProtocol
-from services.uwu_protocol.base_handler import UWUHandlerBase
-from services.uwu_protocol.enums import MessageType, RequestAction, ResponseAction
+from services.uwu_protocol.protocol import UWUProtocol, FRAME_DELIMITER
+from services.uwu_protocol.base_handler import UWUHandlerBase, streaming
+from services.uwu_protocol.enums import MessageType, RequestAction, ResponseAction, Lane
+from services.uwu_protocol.log import get_logger, Summary
+from services.runtime import NodeRuntime
+from services.download_manager import DownloadManager
+from services.chunk_cache import ChunkCache, CACHE_SIZE
+from services.disk_writer import DiskWriter, FsyncPolicy
 
 logging.basicConfig(level=logging.INFO)
 
+log = get_logger("peer")
+
+# Seconds between two syncs with the informant
+SYNC_INTERVAL = 5
+
 
 class PeerNodeHandler(UWUHandlerBase):
     def __init__(self, peer_node):
@@ -21,8 +31,7 @@ class PeerNodeHandler(UWUHandlerBase):
         Bind actions to handler methods.
         """
         return {
-            (MessageType.REQUEST, RequestAction.FILE_DOWNLOAD): self.handle_file_download,
-            (MessageType.RESPONSE, ResponseAction.GET_DHT_RESPONSE): self.handle_get_dht_response,
+            (MessageType.REQUEST, RequestAction.FILE_DOWNLOAD): (self.handle_file_download, Lane.BULK),
             (MessageType.ERROR, True): self.handle_error,
         }
 
@@ -35,73 +44,54 @@ class PeerNodeHandler(UWUHandlerBase):
         writer.close()
         await writer.wait_closed()
 
+    @streaming
     async def handle_file_download(self, message, reader, writer):
         """
         Handle file download requests from other peers (server-side).
+
+        The response is a JSON header line with the file size, followed by the raw file content from the requested
+        offset, so the downloader can count bytes as they arrive and resume a partial download. The content goes
+        through the service's upload scheduler, which shares the upstream fairly between downloaders, and is read
+        through the node's chunk cache.
         """
         filename = message["data"].get("filename")
+        offset = int(message["data"].get("offset", 0))
         file_path = os.path.join(self.peer_node.shared_dir, filename)
 
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, "rb") as file:
-                    file_content = file.read()
-                response = UWUProtocol.create_message(
-                    msg_type=MessageType.RESPONSE,
-                    action=ResponseAction.FILE_DOWNLOAD_RESPONSE.value,
-                    peer_info={"host": self.peer_node.host, "port": self.peer_node.port},
-                    data={"filename": filename, "content": file_content.decode("latin1")}
-                )
-                writer.write(response)
-                await writer.drain()
-                logging.info(f"Served file '{filename}' to client.")
-            except Exception as e:
-                logging.error(f"Error serving file '{filename}': {e}")
-                writer.write(b"ERROR: Unable to read file")
-                await writer.drain()
-        else:
-            writer.write(b"ERROR: File not found")
-            await writer.drain()
+        if not os.path.isfile(file_path):
+            await self.send_download_error(writer, "File not found", message.get("id"))
+            return
 
-    async def download_file(self, filename, host, port, save_path):
-        """
-        Download a file from another peer (client-side).
-        """
         try:
-            # Create the request message
-            message = UWUProtocol.create_message(
-                msg_type=MessageType.REQUEST,
-                action=RequestAction.FILE_DOWNLOAD.value,
+            stat = os.stat(file_path)
+            offset = min(offset, stat.st_size)
+            header = UWUProtocol.create_message(
+                msg_type=MessageType.RESPONSE,
+                action=ResponseAction.FILE_DOWNLOAD_RESPONSE.value,
                 peer_info={"host": self.peer_node.host, "port": self.peer_node.port},
-                data={"filename": filename}
+                data={"filename": filename, "size": stat.st_size, "offset": offset},
+                request_id=message.get("id")
             )
+            writer.write(header + b"\n")
 
-            # Establish connection to the peer
-            reader, writer = await asyncio.open_connection(host, port)
-
-            # Send the request
-            writer.write(message)
-            await writer.drain()
-
-            # Receive the response
-            response_data = await reader.read()
-            response = UWUProtocol.parse_message(response_data)
-
-            if response["action"] == ResponseAction.FILE_DOWNLOAD_RESPONSE.value:
-                # Save the file content
-                with open(save_path, "wb") as file:
-                    file.write(response["data"]["content"].encode("latin1"))
-                logging.info(f"File '{filename}' downloaded successfully to '{save_path}'.")
-            else:
-                logging.error(f"Failed to download file: {response.get('message', 'Unknown error')}")
-
+            peer = writer.get_extra_info("peername")[0]
+            chunks = self.peer_node.chunk_cache.read_chunks(file_path, stat, offset)
+            await self.peer_node.service.uploads.upload(peer, writer, chunks)
+            logging.info(f"Served file '{filename}' to client.")
         except Exception as e:
-            logging.error(f"Error downloading file '{filename}' from {host}:{port}: {e}")
-
-        finally:
-            if 'writer' in locals():
-                writer.close()
-                await writer.wait_closed()
+            logging.error(f"Error serving file '{filename}': {e}")
+            await self.send_download_error(writer, "Unable to read file", message.get("id"))
+
+    async def send_download_error(self, writer, error_message, request_id=None):
+        response = UWUProtocol.create_message(
+            msg_type=MessageType.ERROR,
+            action=ResponseAction.ERROR.value,
+            peer_info={"host": self.peer_node.host, "port": self.peer_node.port},
+            data={"message": error_message},
+            request_id=request_id
+        )
+        writer.write(response + b"\n")
+        await writer.drain()
 
     async def register_with_informant(self):
         """
@@ -126,25 +116,17 @@ class PeerNodeHandler(UWUHandlerBase):
                 data={"files": files}
             )
 
-            # Log the message for debugging
-            logging.info(f"Message being sent: {message.decode()}")
-
-            # Establish an asyncio connection
-            reader, writer = await asyncio.open_connection(self.peer_node.informant_host, self.peer_node.informant_port)
+            log.debug("Message being sent: %s", Summary(message))
 
-            # Send the message
-            writer.write(message)
-            await writer.drain()
+            # Connect through the node runtime, which closes the connection once sent
+            informant = (self.peer_node.informant_host, self.peer_node.informant_port)
+            async with self.peer_node.runtime.connection(*informant) as (reader, writer):
+                writer.write(message + FRAME_DELIMITER)
+                await writer.drain()
 
         except Exception as e:
             logging.error(f"Failed to register with Informant Node: {e}")
 
-        finally:
-            # Ensure the connection is properly closed
-            if 'writer' in locals():
-                writer.close()
-                await writer.wait_closed()
-
     async def handle_dht_request(self):
         """
         Fetch the DHT from the informant node.
@@ -153,26 +135,39 @@ class PeerNodeHandler(UWUHandlerBase):
             logging.info(f"Fetching DHT from Informant Node at {self.peer_node.informant_host}:{self.peer_node.informant_port}")
 
             # Create the request message
+            request_id = UWUProtocol.next_request_id()
             message = UWUProtocol.create_message(
                 msg_type=MessageType.REQUEST,
                 action=RequestAction.GET_DHT,
                 peer_info={"host": self.peer_node.host, "port": self.peer_node.port},
-                data={}
+                data={},
+                request_id=request_id
             )
 
-            # Establish connection to the informant node
-            reader, writer = await asyncio.open_connection(self.peer_node.informant_host, self.peer_node.informant_port)
-
-            # Send the request
-            writer.write(message)
-            await writer.drain()
+            # Connect through the node runtime, the informant answers on the same connection and then closes it
+            informant = (self.peer_node.informant_host, self.peer_node.informant_port)
+            async with self.peer_node.runtime.connection(*informant, timeout=5) as (reader, writer):
+                writer.write(message + FRAME_DELIMITER)
+                await writer.drain()
+                data = await asyncio.wait_for(reader.read(), timeout=10)
+
+            response = UWUProtocol.parse_message(data)
+            if response.get("action") == ResponseAction.OVERLOADED.value:
+                logging.warning(f"Informant Node overloaded, next sync in {response['data']['retry_after']}s at least")
+                return response["data"]["retry_after"]
+            if response.get("id") != request_id:
+                logging.error(f"Unexpected response to the DHT request: {response}")
+            elif response.get("type") == MessageType.ERROR.value:
+                await self.handle_error(response, reader, writer)
+            else:
+                await self.handle_get_dht_response(response, reader, writer)
 
         except Exception as e:
             logging.error(f"Error fetching DHT from Informant Node: {e}")
 
     async def handle_get_dht_response(self, message, reader, writer):
         """
-        Handle the DHT response from the informant node.
+        Handle the DHT response from the informant node, read on the connection of the request.
         """
         logging.info("[PEER_NODE_HANDLER] Handling DHT response from Informant Node")
         try:
@@ -186,17 +181,68 @@ class PeerNodeHandler(UWUHandlerBase):
         except Exception as e:
             logging.error(f"[PEER_NODE_HANDLER] Error processing DHT response: {e}")
 
+    async def sync_with_informant(self):
+        """
+        Register the shared files and fetch the DHT in one BATCH request, a single round trip to the informant. The
+        register runs first, so the DHT that comes back already lists the files.
+        :return: Seconds the informant asked to wait before the next sync when it is overloaded, else None.
+        """
+        try:
+            files = [
+                {"filename": filename, "size": os.path.getsize(os.path.join(self.peer_node.shared_dir, filename))}
+                for filename in os.listdir(self.peer_node.shared_dir)
+                if os.path.isfile(os.path.join(self.peer_node.shared_dir, filename))
+            ]
+            request_id = UWUProtocol.next_request_id()
+            message = UWUProtocol.create_message(
+                msg_type=MessageType.REQUEST,
+                action=RequestAction.BATCH,
+                peer_info={"host": self.peer_node.host, "port": self.peer_node.port},
+                data={"requests": [
+                    UWUProtocol.create_sub_request(MessageType.REQUEST, RequestAction.REGISTER, {"files": files}),
+                    UWUProtocol.create_sub_request(MessageType.REQUEST, RequestAction.GET_DHT, {}),
+                ]},
+                request_id=request_id,
+                timeout=10
+            )
+
+            informant = (self.peer_node.informant_host, self.peer_node.informant_port)
+            async with self.peer_node.runtime.connection(*informant, timeout=5) as (reader, writer):
+                writer.write(message + FRAME_DELIMITER)
+                await writer.drain()
+                data = await asyncio.wait_for(reader.read(), timeout=10)
+
+            response = UWUProtocol.parse_message(data)
+            if response.get("action") == ResponseAction.OVERLOADED.value:
+                logging.warning(f"Informant Node overloaded, next sync in {response['data']['retry_after']}s at least")
+                return response["data"]["retry_after"]
+            if response.get("id") != request_id or response.get("type") != MessageType.RESPONSE.value:
+                logging.error(f"Unexpected response to the sync request: {response}")
+                return
+
+            register_response, dht_response = response["data"]["responses"]
+            if register_response is None or register_response.get("type") == MessageType.ERROR.value:
+                logging.warning(f"Register refused by the Informant Node: {register_response}")
+            if dht_response is not None and dht_response.get("type") == MessageType.RESPONSE.value:
+                await self.handle_get_dht_response(dht_response, reader, writer)
+
+        except Exception as e:
+            logging.error(f"Failed to sync with Informant Node: {e}")
+
     async def periodical(self):
         """
         Periodically register with the informant node and fetch the DHT.
         """
-        await self.register_with_informant()
-        await self.handle_dht_request()
-        print(f"Periodic tasks executed. New DHT: {self.peer_node.dht}")
+        retry_after = await self.sync_with_informant()
+        if log.enabled(logging.DEBUG):
+            log.debug("Periodic tasks executed. New DHT: %s", Summary(self.peer_node.dht))
+        # An overloaded informant is left alone for as long as it asked
+        return None if retry_after is None else max(SYNC_INTERVAL, retry_after)
 
 
 class PeerNode:
-    def __init__(self, host="127.0.0.1", port=6001, informant_host="127.0.0.1", informant_port=6000, shared_dir=None):
+    def __init__(self, host="127.0.0.1", port=6001, informant_host="127.0.0.1", informant_port=6000, shared_dir=None,
+                 max_downloads=3, fsync_policy=FsyncPolicy.ON_CLOSE, cache_size=CACHE_SIZE, upload_slots=4, upload_rate=None, peer_upload_rate=None):
         self.host = host
         self.port = port
         self.informant_host = informant_host
@@ -209,21 +255,48 @@ class PeerNode:
 
         # Initialize UWUService with periodic registration
         self.handler = PeerNodeHandler(self)
+        self.service = None
+
+        # Single event loop of the node, shared by the service, the downloads and the periodic tasks
+        self.runtime = NodeRuntime(name=f"peer_node_{self.port}")
+        self.upload_slots = upload_slots
+        self.upload_rate = upload_rate
+        self.peer_upload_rate = peer_upload_rate
+
+        # Chunks of the served files, shared by all the uploads
+        self.chunk_cache = ChunkCache(capacity=cache_size)
+
+        # Downloads run on the service loop, the queue survives restarts
+        self.downloads = DownloadManager(
+            self,
+            max_concurrent=max_downloads,
+            queue_file=os.path.join(os.path.dirname(__file__), "data", f"downloads_{self.port}.json"),
+            disk_writer=DiskWriter(fsync_policy=fsync_policy),
+        )
 
-    def download_file(self, filename, host, port, save_path):
+    def download_file(self, filename, host, port, save_path, size=None):
         """
-        Download a file from another peer.
+        Queue the download of a file from another peer, returns the download id.
         """
-        asyncio.run(self.handler.download_file(filename, host, port, save_path))
+        return self.downloads.enqueue(filename, host, port, save_path, size)
+
+    def cancel_download(self, download_id):
+        self.downloads.cancel(download_id)
 
     def start_peer_node(self):
         """
-        Start the UWUService in a separate thread.
+        Start the node runtime, with the UWUService and the download manager on its loop.
         """
-        service = UWUService(
+        self.runtime.start()
+        self.service = UWUService(
             host=self.host,
             port=self.port,
             handler=self.handler,
-            periodical_tasks_cbk=(lambda: self.handler.periodical(), 5),
+            periodical_tasks_cbk=(lambda: self.handler.periodical(), SYNC_INTERVAL),
+            upload_slots=self.upload_slots,
+            upload_rate=self.upload_rate,
+            peer_upload_rate=self.peer_upload_rate,
+            runtime=self.runtime,
         )
-        service.start_service()
+        self.service.start_service()
+        self.downloads.start(self.runtime.loop)
@@ -0,0 +1,127 @@
+import os
+from collections import OrderedDict
+
+from services.download_manager import CHUNK_SIZE
+
+# Default memory budget of the cache, in bytes
+CACHE_SIZE = 64 * 1024 * 1024
+# Share of the budget kept for chunks that were hit at least once
+PROTECTED_SHARE = 0.8
+
+
+class ChunkCache:
+    """
+    Segmented LRU cache of the chunks of the files a peer serves, within a memory budget of capacity bytes.
+
+    New chunks enter a probation segment and move to the protected segment on their first hit. Eviction takes from
+    probation first, so a single download of a big file can't flush the chunks of the files that are really popular.
+
+    Chunks are keyed by (file identity, chunk index). The identity holds the inode, size and mtime of the file, so a
+    file that changed on disk never hits its old chunks, and they are dropped as soon as the change is seen. Serving a
+    popular file to many peers then mostly comes from memory instead of one disk read per request.
+    """
+    def __init__(self, capacity: int = CACHE_SIZE, chunk_size: int = CHUNK_SIZE):
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.protected_capacity = int(capacity * PROTECTED_SHARE)
+        self.protected_size = 0
+        # (identity, index) -> bytes, least recently used first
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._identities = {}  # path -> identity
+        self._file_chunks = {}  # identity -> set of cached chunk indexes
+
+    def read_chunks(self, path: str, stat: os.stat_result, offset: int = 0):
+        """
+        Yields the content of the file from offset, in chunks of at most chunk_size bytes. The file is only opened
+        when a chunk is missing from the cache.
+        :param stat: Result of os.stat on the file, taken when the request was accepted.
+        """
+        identity = self.__identity(path, stat)
+        index, skip = divmod(offset, self.chunk_size)
+        file = None
+        try:
+            while index * self.chunk_size < stat.st_size:
+                key = (identity, index)
+                chunk = self.__get(key)
+                if chunk is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    if file is None:
+                        file = open(path, "rb")
+                    file.seek(index * self.chunk_size)
+                    chunk = file.read(self.chunk_size)
+                    if not chunk:
+                        return  # Truncated since the request was accepted
+                    self.__store(key, chunk)
+
+                yield chunk[skip:] if skip else chunk
+                skip = 0
+                index += 1
+        finally:
+            if file is not None:
+                file.close()
+
+    def invalidate(self, path: str):
+        """
+        Drops the cached chunks of a file.
+        """
+        identity = self._identities.pop(path, None)
+        for index in self._file_chunks.pop(identity, ()):
+            key = (identity, index)
+            if key in self._protected:
+                chunk = self._protected.pop(key)
+                self.protected_size -= len(chunk)
+            else:
+                chunk = self._probation.pop(key)
+            self.size -= len(chunk)
+
+    def __identity(self, path: str, stat: os.stat_result) -> tuple:
+        identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if self._identities.get(path) != identity:
+            self.invalidate(path)
+            self._identities[path] = identity
+        return identity
+
+    def __get(self, key: tuple):
+        chunk = self._protected.get(key)
+        if chunk is not None:
+            self._protected.move_to_end(key)
+            return chunk
+
+        chunk = self._probation.pop(key, None)
+        if chunk is None:
+            return None
+
+        # Promoted on its first hit, the protected segment overflows back into probation
+        self._protected[key] = chunk
+        self.protected_size += len(chunk)
+        while self.protected_size > self.protected_capacity:
+            old_key, old_chunk = self._protected.popitem(last=False)
+            self.protected_size -= len(old_chunk)
+            self._probation[old_key] = old_chunk
+        return chunk
+
+    def __store(self, key: tuple, chunk: bytes):
+        if len(chunk) > self.capacity or key in self._probation or key in self._protected:
+            return
+        self._probation[key] = chunk
+        self.size += len(chunk)
+        identity, index = key
+        self._file_chunks.setdefault(identity, set()).add(index)
+
+        while self.size > self.capacity:
+            if self._probation:
+                (old_identity, old_index), old_chunk = self._probation.popitem(last=False)
+            else:
+                (old_identity, old_index), old_chunk = self._protected.popitem(last=False)
+                self.protected_size -= len(old_chunk)
+            self.size -= len(old_chunk)
+            indexes = self._file_chunks[old_identity]
+            indexes.discard(old_index)
+            if not indexes:
+                del self._file_chunks[old_identity]
@@ -0,0 +1,179 @@
+import asyncio
+import errno
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+
+logging.basicConfig(level=logging.INFO)
+
+# Buffered bytes of a file that trigger a flush to disk
+FLUSH_SIZE = 4 * 1024 * 1024
+# With FsyncPolicy.PERIODIC, bytes written between two fsyncs
+FSYNC_INTERVAL = 64 * 1024 * 1024
+
+
+class FsyncPolicy(str, Enum):
+    NEVER = "never"  # Leave it to the OS
+    ON_CLOSE = "on_close"  # Once, when the file is closed
+    PERIODIC = "periodic"  # Every FSYNC_INTERVAL bytes and on close
+
+
+def _pwrite(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            # Writes to a file are never concurrent, see DiskFile.flush
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+class DiskFile:
+    """
+    A file being written through a DiskWriter.
+
+    Pieces can arrive in any order. They are buffered and, once FLUSH_SIZE bytes are pending, adjacent pieces are
+    joined and written with one positional write per contiguous run, on the writer's thread pool. write() only waits
+    for the disk when a second flush would start while the previous one is still running, which bounds the memory used
+    per file.
+    """
+    def __init__(self, writer: "DiskWriter", path: str, fd: int, flushed: int = 0):
+        self.path = path
+        self._writer = writer
+        self._fd = fd
+        self._pieces = {}  # offset -> bytes
+        self._pending = 0
+        self._flush_lock = asyncio.Lock()
+        self._unsynced = 0
+        self._written = [(0, flushed)] if flushed else []  # Sorted, merged [start, end) ranges already on disk
+
+    @property
+    def flushed(self) -> int:
+        """
+        End of the prefix of the file that is fully written to disk.
+        """
+        if self._written and self._written[0][0] == 0:
+            return self._written[0][1]
+        return 0
+
+    async def write(self, offset: int, data: bytes):
+        self._pieces[offset] = data
+        self._pending += len(data)
+        if self._pending >= self._writer.flush_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pieces:
+                return
+            pieces, self._pieces, self._pending = self._pieces, {}, 0
+            runs = self.__coalesce(pieces)
+            await self._writer.run(self.__write_runs, runs)
+            for start, data in runs:
+                self.__mark_written(start, start + len(data))
+
+            self._unsynced += sum(len(data) for _, data in runs)
+            if self._writer.fsync_policy == FsyncPolicy.PERIODIC and self._unsynced >= self._writer.fsync_interval:
+                await self._writer.run(os.fsync, self._fd)
+                self._unsynced = 0
+
+    async def close(self, truncate_to_flushed=False):
+        """
+        Flushes what is left, fsyncs according to the policy and closes the file.
+        :param truncate_to_flushed: Cut the file after the fully written prefix, for a transfer that did not finish,
+        so the preallocated tail is not mistaken for data.
+        """
+        try:
+            await self.flush()
+            if truncate_to_flushed:
+                await self._writer.run(os.ftruncate, self._fd, self.flushed)
+            if self._writer.fsync_policy != FsyncPolicy.NEVER and self._unsynced:
+                await self._writer.run(os.fsync, self._fd)
+        finally:
+            os.close(self._fd)
+
+    @staticmethod
+    def __coalesce(pieces: dict) -> list:
+        """
+        Joins the pieces that touch each other into [(offset, bytes)] runs.
+        """
+        runs = []
+        run_start, run_end, run_pieces = None, None, []
+        for offset in sorted(pieces):
+            data = pieces[offset]
+            if run_pieces and offset == run_end:
+                run_pieces.append(data)
+                run_end += len(data)
+                continue
+            if run_pieces:
+                runs.append((run_start, b"".join(run_pieces)))
+            run_start, run_end, run_pieces = offset, offset + len(data), [data]
+        if run_pieces:
+            runs.append((run_start, b"".join(run_pieces)))
+        return runs
+
+    def __write_runs(self, runs: list):
+        for offset, data in runs:
+            _pwrite(self._fd, data, offset)
+
+    def __mark_written(self, start: int, end: int):
+        merged = []
+        for range_start, range_end in self._written:
+            if range_end < start or range_start > end:
+                merged.append((range_start, range_end))
+            else:
+                start, end = min(start, range_start), max(end, range_end)
+        merged.append((start, end))
+        merged.sort()
+        self._written = merged
+
+
+class DiskWriter:
+    """
+    Writes downloaded files on a thread pool, so disk I/O never blocks the event loop.
+
+    Files are preallocated to their final size when it is known (posix_fallocate, where available), which avoids
+    fragmentation and fails early when the disk is full.
+    """
+    def __init__(self, max_workers=4, flush_size=FLUSH_SIZE, fsync_policy=FsyncPolicy.ON_CLOSE,
+                 fsync_interval=FSYNC_INTERVAL):
+        self.flush_size = flush_size
+        self.fsync_policy = FsyncPolicy(fsync_policy)
+        self.fsync_interval = fsync_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="disk_writer")
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def open(self, path: str, size: int = None, offset: int = 0) -> DiskFile:
+        """
+        Opens path for writing, keeping its first offset bytes (already downloaded) and dropping the rest.
+        :param size: Final size of the file, used to preallocate it.
+        """
+        fd = await self.run(self.__open, path, size, offset)
+        return DiskFile(self, path, fd, flushed=offset)
+
+    @staticmethod
+    def __open(path: str, size: int, offset: int) -> int:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            os.ftruncate(fd, offset)
+            if size and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        raise
+                    # Not supported by every file system, the file just grows as it is written
+                    logging.debug(f"[DISK_WRITER] Could not preallocate '{path}': {e}")
+        except Exception:
+            os.close(fd)
+            raise
+        return fd
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,318 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from enum import Enum
+
+from services.disk_writer import DiskWriter
+from services.uwu_protocol.protocol import UWUProtocol, FRAME_DELIMITER
+from services.uwu_protocol.enums import MessageType, RequestAction, ResponseAction
+from services.uwu_protocol.lanes import Overloaded
+
+logging.basicConfig(level=logging.INFO)
+
+# Bytes read from the socket at a time
+CHUNK_SIZE = 64 * 1024
+# Progress of a transfer is reported at most this often (seconds), state changes are always reported
+PROGRESS_INTERVAL = 0.2
+# Weight of the latest sample in the transfer speed moving average
+SPEED_SMOOTHING = 0.3
+# Times a download is retried when the providing peer is overloaded, before it fails
+OVERLOAD_RETRIES = 5
+# While transferring, the queue (with what is safely on disk) is saved at most this often (seconds)
+SAVE_INTERVAL = 2.0
+
+
+class DownloadState(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class Download:
+    """
+    A single transfer and its counters. Only touched from the node's event loop.
+    """
+    __slots__ = ("id", "filename", "host", "port", "save_path", "size", "received", "flushed", "state", "error",
+                 "speed", "_last_sample", "_last_report", "task")
+
+    def __init__(self, filename, host, port, save_path, size=None, id=None, state=DownloadState.QUEUED):
+        self.id = id or uuid.uuid4().hex
+        self.filename = filename
+        self.host = host
+        self.port = int(port)
+        self.save_path = save_path
+        self.size = size
+        self.received = 0
+        self.flushed = 0  # Bytes of the .part file known to be written, where a resume starts
+        self.state = DownloadState(state)
+        self.error = None
+        self.speed = 0.0  # Bytes per second
+        self._last_sample = None  # (time, received) of the last speed sample
+        self._last_report = 0.0
+        self.task = None
+
+    @property
+    def part_path(self):
+        return self.save_path + ".part"
+
+    @property
+    def eta(self):
+        """
+        Seconds left at the current speed, None when unknown.
+        """
+        if self.size is None or self.speed <= 0:
+            return None
+        return max(self.size - self.received, 0) / self.speed
+
+    def sample_speed(self, now):
+        if self._last_sample is None:
+            self._last_sample = (now, self.received)
+            return
+        last_time, last_received = self._last_sample
+        if now - last_time < PROGRESS_INTERVAL:
+            return
+        speed = (self.received - last_received) / (now - last_time)
+        self.speed = speed if self.speed == 0 else SPEED_SMOOTHING * speed + (1 - SPEED_SMOOTHING) * self.speed
+        self._last_sample = (now, self.received)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "host": self.host,
+            "port": self.port,
+            "save_path": self.save_path,
+            "size": self.size,
+            "received": self.received,
+            "flushed": self.flushed,
+            "state": self.state.value,
+            "error": self.error,
+            "speed": self.speed,
+            "eta": self.eta,
+        }
+
+
+class DownloadManager:
+    """
+    Runs the downloads of a peer node on the node's event loop.
+
+    Downloads are queued and at most max_concurrent of them transfer at the same time. The queue is saved to
+    queue_file, so unfinished downloads are picked up again on the next start and resume from their .part file.
+
+    enqueue() and cancel() can be called from any thread. Every update is handed to the callbacks bound with
+    bind_on_update as a dict, from the event loop thread.
+
+    Received data goes through a DiskWriter, so writing files never blocks the event loop.
+    """
+    def __init__(self, peer_node, max_concurrent=3, queue_file=None, disk_writer: DiskWriter = None):
+        self.peer_node = peer_node
+        self.max_concurrent = max_concurrent
+        self.queue_file = queue_file
+        self.disk_writer = disk_writer or DiskWriter()
+        self._last_save = 0.0
+        self.loop = None
+        self._downloads = {}  # id -> Download, in queue order
+        self._running = 0
+        self._on_update = []
+
+    def bind_on_update(self, callback):
+        self._on_update.append(callback)
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Attaches the manager to the node's event loop, reloads the saved queue and starts transferring.
+        """
+        self.loop = loop
+        self.loop.call_soon_threadsafe(self.__restore)
+
+    def enqueue(self, filename, host, port, save_path, size=None) -> str:
+        """
+        Queues a download and returns its id.
+        """
+        download = Download(filename, host, port, save_path, size)
+        if self.loop is None:
+            # Started along with the saved queue
+            self._downloads[download.id] = download
+        else:
+            self.loop.call_soon_threadsafe(self.__add, download)
+        return download.id
+
+    def cancel(self, download_id: str):
+        self.loop.call_soon_threadsafe(self.__cancel, download_id)
+
+    def __restore(self):
+        saved = []
+        if self.queue_file and os.path.exists(self.queue_file):
+            try:
+                with open(self.queue_file, "r") as file:
+                    saved = json.load(file)
+            except (json.JSONDecodeError, IOError) as e:
+                logging.warning(f"[DOWNLOADS] Failed to load the download queue: {e}")
+
+        enqueued_before_start = self._downloads
+        self._downloads = {}
+        for entry in saved:
+            # Transfers interrupted by the last shutdown go back to the queue
+            state = DownloadState.QUEUED if entry["state"] == DownloadState.RUNNING.value else entry["state"]
+            download = Download(entry["filename"], entry["host"], entry["port"], entry["save_path"],
+                                entry.get("size"), id=entry["id"], state=state)
+            download.received = entry.get("received", 0)
+            download.flushed = entry.get("flushed", 0)
+            self._downloads[download.id] = download
+            self.__notify(download)
+        logging.info(f"[DOWNLOADS] Restored {len(saved)} downloads.")
+
+        for download in enqueued_before_start.values():
+            self.__add(download)
+        self.__pump()
+
+    def __save(self):
+        if not self.queue_file:
+            return
+        self._last_save = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.queue_file), exist_ok=True)
+            with open(self.queue_file, "w") as file:
+                json.dump([download.to_dict() for download in self._downloads.values()], file, indent=4)
+        except IOError as e:
+            logging.error(f"[DOWNLOADS] Failed to save the download queue: {e}")
+
+    def __add(self, download: Download):
+        self._downloads[download.id] = download
+        self.__save()
+        self.__notify(download)
+        self.__pump()
+
+    def __cancel(self, download_id: str):
+        download = self._downloads.get(download_id)
+        if download is None or download.state not in (DownloadState.QUEUED, DownloadState.RUNNING):
+            return
+        if download.task is not None:
+            # The transfer task cleans up and sets the state itself
+            download.task.cancel()
+            return
+        self.__finish(download, DownloadState.CANCELLED)
+
+    def __pump(self):
+        """
+        Starts queued downloads while there are free transfer slots.
+        """
+        for download in self._downloads.values():
+            if self._running >= self.max_concurrent:
+                break
+            if download.state == DownloadState.QUEUED:
+                self._running += 1
+                download.state = DownloadState.RUNNING
+                download.task = asyncio.ensure_future(self.__transfer(download))
+                download.task.add_done_callback(lambda task, download=download: self.__on_transfer_done(download))
+                self.__notify(download)
+
+    def __on_transfer_done(self, download: Download):
+        self._running -= 1
+        # A task cancelled before it started never ran its own cleanup
+        if download.state == DownloadState.RUNNING:
+            self.__finish(download, DownloadState.CANCELLED)
+        self.__pump()
+
+    def __finish(self, download: Download, state: DownloadState, error=None):
+        download.state = state
+        download.error = error
+        download.speed = 0.0
+        download.task = None
+        if state == DownloadState.CANCELLED and os.path.exists(download.part_path):
+            os.remove(download.part_path)
+        self.__save()
+        self.__notify(download)
+
+    def __notify(self, download: Download, progress=False):
+        if progress:
+            now = time.monotonic()
+            download.sample_speed(now)
+            if now - download._last_report < PROGRESS_INTERVAL:
+                return
+            download._last_report = now
+            if now - self._last_save >= SAVE_INTERVAL:
+                self.__save()
+
+        info = download.to_dict()
+        for callback in self._on_update:
+            try:
+                callback(info)
+            except Exception as e:
+                logging.error(f"[DOWNLOADS] Update callback failed: {e}")
+
+    async def __transfer(self, download: Download):
+        try:
+            # Resume from what a previous run is known to have written, the .part file may be preallocated
+            offset = 0
+            if os.path.exists(download.part_path):
+                offset = min(download.flushed, os.path.getsize(download.part_path))
+            download.received = offset
+
+            for attempt in range(OVERLOAD_RETRIES + 1):
+                try:
+                    async with self.peer_node.runtime.connection(download.host, download.port) as (reader, writer):
+                        await self.__receive(download, offset, reader, writer)
+                    break
+                except Overloaded as e:
+                    if attempt == OVERLOAD_RETRIES:
+                        raise
+                    # Jittered, so the downloads turned away together don't come back together
+                    delay = e.retry_after * (1 + random.random())
+                    logging.info(f"[DOWNLOADS] {download.host}:{download.port} is overloaded, retrying "
+                                 f"'{download.filename}' in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+
+            if download.received != download.size:
+                raise IOError(f"Connection closed after {download.received} of {download.size} bytes")
+
+            os.replace(download.part_path, download.save_path)
+            logging.info(f"[DOWNLOADS] File '{download.filename}' downloaded successfully to '{download.save_path}'.")
+            self.__finish(download, DownloadState.COMPLETED)
+
+        except asyncio.CancelledError:
+            logging.info(f"[DOWNLOADS] Download of '{download.filename}' cancelled.")
+            self.__finish(download, DownloadState.CANCELLED)
+
+        except Exception as e:
+            logging.error(f"[DOWNLOADS] Error downloading file '{download.filename}' from "
+                          f"{download.host}:{download.port}: {e}")
+            self.__finish(download, DownloadState.FAILED, str(e))
+
+    async def __receive(self, download: Download, offset: int, reader, writer):
+        message = UWUProtocol.create_message(
+            msg_type=MessageType.REQUEST,
+            action=RequestAction.FILE_DOWNLOAD.value,
+            peer_info={"host": self.peer_node.host, "port": self.peer_node.port},
+            data={"filename": download.filename, "offset": offset}
+        )
+        writer.write(message + FRAME_DELIMITER)
+        await writer.drain()
+
+        # A JSON header line, followed by the raw file content until EOF
+        header = UWUProtocol.parse_message(await reader.readline())
+        if header["action"] == ResponseAction.OVERLOADED.value:
+            raise Overloaded(header["data"]["retry_after"])
+        if header["action"] != ResponseAction.FILE_DOWNLOAD_RESPONSE.value:
+            raise IOError(header.get("data", {}).get("message", "Unknown error"))
+        download.size = header["data"]["size"]
+        offset = header["data"].get("offset", 0)
+        download.received = offset
+
+        disk_file = await self.disk_writer.open(download.part_path, download.size, offset)
+        try:
+            while chunk := await reader.read(CHUNK_SIZE):
+                await disk_file.write(download.received, chunk)
+                download.received += len(chunk)
+                download.flushed = disk_file.flushed
+                self.__notify(download, progress=True)
+        finally:
+            # An unfinished file is cut after its written prefix, so the next run resumes from there
+            await disk_file.close(truncate_to_flushed=download.received != download.size)
+            download.flushed = disk_file.flushed
@@ -0,0 +1,32 @@
+import math
+from collections import deque
+
+
+class LatencyTracker:
+    """
+    Keeps the latest response times of a remote node and gives their percentiles, used to decide when a request has
+    been waiting for longer than usual.
+    """
+    def __init__(self, window: int = 100, default: float = 0.1, min_samples: int = 5):
+        """
+        :param window: Number of latest samples kept.
+        :param default: Value of every percentile until min_samples samples were recorded, in seconds.
+        """
+        self.default = default
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        """
+        :param q: Between 0 and 1, 0.95 for the p95.
+        """
+        if len(self._samples) < self.min_samples:
+            return self.default
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+
+    def p95(self) -> float:
+        return self.percentile(0.95)
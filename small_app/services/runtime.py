@@ -0,0 +1,146 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from .watchdog import LoopWatchdog
+
+logging.basicConfig(level=logging.INFO)
+
+# Connections opened at the same time to a single peer
+CONNECTIONS_PER_PEER = 8
+
+
+class NodeRuntime:
+    """
+    Owns the single event loop of a node, running in its own thread.
+
+    The protocol service, the downloads, the broadcasts and the periodic tasks all run on this loop, and share its
+    timers, its default thread pool and its per-peer connection limits. Code running outside of the loop (the GUI, the
+    CLI) hands coroutines over with submit() and gets a concurrent.futures.Future back, instead of starting an event
+    loop of its own.
+
+    Nothing running on the loop may block it. A LoopWatchdog measures its lag and captures where it blocks, see
+    watchdog.incidents().
+    """
+    def __init__(self, name="uwu_runtime", max_workers=None, connections_per_peer=CONNECTIONS_PER_PEER,
+                 watchdog: bool = True, slow_callbacks: bool = False):
+        """
+        :param watchdog: Watch the loop for blocking calls.
+        :param slow_callbacks: Run the loop in debug mode, so the watchdog also records the slow callbacks asyncio
+        reports. Costly, meant for debugging.
+        """
+        self.name = name
+        self.loop = None
+        self.connections_per_peer = connections_per_peer
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._thread = None
+        self._ready = threading.Event()
+        self._peer_limits = {}  # (host, port) -> (asyncio.Semaphore, connections open or waiting)
+        self.watchdog = LoopWatchdog(name, slow_callbacks=slow_callbacks) if watchdog else None
+
+    def start(self):
+        """
+        Starts the loop thread, returns once the loop is running. Starting a running runtime does nothing.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.__run, name=self.name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def stop(self, timeout=5):
+        """
+        Cancels what is still running on the loop and stops it.
+        """
+        if self._thread is None or self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def is_running(self) -> bool:
+        return self.loop is not None and self.loop.is_running()
+
+    def in_loop_thread(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """
+        Schedules a coroutine on the loop, from any thread.
+        """
+        if self.loop is None:
+            coro.close()
+            raise RuntimeError(f"[RUNTIME] {self.name} is not started")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+        Runs a coroutine on the loop and waits for its result. Must not be called from the loop thread itself.
+        """
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError("[RUNTIME] run() would block the loop it waits for, use submit() or await instead")
+        return self.submit(coro).result(timeout)
+
+    def call_soon(self, callback, *args):
+        """
+        Calls a function on the loop thread, from any thread.
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    @asynccontextmanager
+    async def connection(self, host: str, port: int, timeout: float = None):
+        """
+        Opens a connection to a peer, waiting while connections_per_peer connections to it are already open:
+
+            async with runtime.connection(host, port) as (reader, writer):
+                ...
+        """
+        key = (host, int(port))
+        limit, users = self._peer_limits.get(key) or (asyncio.Semaphore(self.connections_per_peer), 0)
+        self._peer_limits[key] = (limit, users + 1)
+        try:
+            async with limit:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+                try:
+                    yield reader, writer
+                finally:
+                    writer.close()
+                    try:
+                        await writer.wait_closed()
+                    except Exception:
+                        pass
+        finally:
+            limit, users = self._peer_limits[key]
+            if users == 1:
+                del self._peer_limits[key]
+            else:
+                self._peer_limits[key] = (limit, users - 1)
+
+    def __run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(self._executor)
+        self.loop.call_soon(self._ready.set)
+        if self.watchdog is not None:
+            self.watchdog.start(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            if self.watchdog is not None:
+                self.watchdog.stop()
+            try:
+                pending = asyncio.all_tasks(self.loop)
+                for task in pending:
+                    task.cancel()
+                self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+                self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            except Exception as e:
+                logging.error(f"[RUNTIME] Error while stopping {self.name}: {e}")
+            finally:
+                self.loop.close()
+                self._executor.shutdown(wait=False)
+                logging.info(f"[RUNTIME] {self.name} stopped.")
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import random
+import time
+from enum import Enum
+from typing import Awaitable, Callable, Dict, Optional
+
+
+class Overlap(str, Enum):
+    SKIP = "skip"  # A run due while the previous one is still running is dropped
+    COALESCE = "coalesce"  # Runs due while the previous one is running are merged into one, started right after it
+
+
+class TaskStats:
+    """
+    Counters of a periodic task, durations in seconds.
+    """
+    __slots__ = ("runs", "failures", "timeouts", "overruns", "skipped", "coalesced", "last_duration", "max_duration",
+                 "total_duration")
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.overruns = 0  # Runs that lasted longer than the interval
+        self.skipped = 0
+        self.coalesced = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+
+    def record(self, duration: float, interval: float):
+        self.runs += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        self.total_duration += duration
+        if duration > interval:
+            self.overruns += 1
+
+    def as_dict(self) -> dict:
+        stats = {name: getattr(self, name) for name in self.__slots__}
+        stats["mean_duration"] = self.total_duration / self.runs if self.runs else 0.0
+        return stats
+
+
+class PeriodicTask:
+    def __init__(self, name: str, callback: Callable[[], Awaitable], interval: float, jitter: float = 0.0,
+                 overlap: Overlap = Overlap.SKIP, timeout: Optional[float] = None, initial_delay: Optional[float] = None):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.jitter = jitter
+        self.overlap = Overlap(overlap)
+        self.timeout = timeout
+        self.initial_delay = interval if initial_delay is None else initial_delay
+        self.stats = TaskStats()
+        self.running: Optional[asyncio.Task] = None  # The current run
+        self.pending = False  # A coalesced run waits for the current one
+        self.ticker: Optional[asyncio.Task] = None
+
+    def is_running(self) -> bool:
+        return self.running is not None and not self.running.done()
+
+
+class PeriodicScheduler:
+    """
+    Runs named coroutine callbacks periodically on the loop it is started on.
+
+    Each task has its own interval and a random jitter added to every delay, so tasks started together drift apart. A
+    run never overlaps the previous run of the same task: when the next run is due while the previous one is still
+    running, it is skipped, or with Overlap.COALESCE all the runs due meanwhile are merged into one that starts as soon
+    as the previous run ends. A run can be given a timeout, it is cancelled once it is over.
+
+    A callback may return a number of seconds, the next run then waits that long instead of the interval.
+    """
+    def __init__(self):
+        self.tasks: Dict[str, PeriodicTask] = {}
+        self._started = False
+
+    def add(self, name: str, callback: Callable[[], Awaitable], interval: float, jitter: float = 0.0,
+            overlap: Overlap = Overlap.SKIP, timeout: Optional[float] = None, initial_delay: Optional[float] = None):
+        """
+        Registers a task, it starts with the scheduler or right away if the scheduler is running.
+        :param callback: Called without arguments, returns a coroutine.
+        :param interval: Seconds between two runs.
+        :param jitter: Up to this many seconds are randomly added to every delay.
+        :param overlap: What to do with a run due while the previous one is still running.
+        :param timeout: Longest run, in seconds, None for no limit.
+        :param initial_delay: Seconds before the first run, the interval if None.
+        """
+        if name in self.tasks:
+            raise ValueError(f"A periodic task named {name} already exists")
+        task = PeriodicTask(name, callback, interval, jitter, overlap, timeout, initial_delay)
+        self.tasks[name] = task
+        if self._started:
+            self.__start_task(task)
+
+    def remove(self, name: str):
+        """
+        Unregisters a task, its current run is cancelled.
+        """
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            self.__cancel_task(task)
+
+    def start(self):
+        """
+        Starts the tasks, from the loop they run on.
+        """
+        self._started = True
+        for task in self.tasks.values():
+            self.__start_task(task)
+
+    async def stop(self):
+        """
+        Stops the tasks and cancels their current runs.
+        """
+        self._started = False
+        pending = []
+        for task in self.tasks.values():
+            pending.extend(self.__cancel_task(task))
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        :return: {name: counters and durations of the task}
+        """
+        return {name: task.stats.as_dict() for name, task in self.tasks.items()}
+
+    def __start_task(self, task: PeriodicTask):
+        task.ticker = asyncio.create_task(self.__tick(task), name=f"periodic_{task.name}")
+
+    @staticmethod
+    def __cancel_task(task: PeriodicTask) -> list:
+        cancelled = []
+        for running in (task.ticker, task.running):
+            if running is not None and not running.done():
+                running.cancel()
+                cancelled.append(running)
+        task.ticker = task.running = None
+        task.pending = False
+        return cancelled
+
+    async def __tick(self, task: PeriodicTask):
+        delay = task.initial_delay
+        while True:
+            await asyncio.sleep(delay + random.uniform(0, task.jitter))
+            delay = task.interval
+
+            if task.is_running():
+                self.__overlap(task)
+                continue
+
+            task.running = asyncio.create_task(self.__run(task), name=f"periodic_{task.name}_run")
+            try:
+                # Waits for the run up to the interval, a longer run goes on while the next ones are due
+                next_delay = await asyncio.wait_for(asyncio.shield(task.running), task.interval)
+            except asyncio.TimeoutError:
+                self.__overlap(task)
+                continue
+            if next_delay is not None:
+                delay = max(0.0, next_delay)
+
+    @staticmethod
+    def __overlap(task: PeriodicTask):
+        if task.overlap == Overlap.COALESCE:
+            if task.pending:
+                task.stats.coalesced += 1
+            task.pending = True
+        else:
+            task.stats.skipped += 1
+            logging.info(f"[SCHEDULER] Skipping a run of {task.name}, the previous one is still running")
+
+    async def __run(self, task: PeriodicTask):
+        """
+        Runs the callback, again while coalesced runs are pending.
+        :return: The delay returned by the last run, if a number.
+        """
+        while True:
+            task.pending = False
+            started = time.perf_counter()
+            result = None
+            try:
+                result = await asyncio.wait_for(task.callback(), task.timeout)
+            except asyncio.TimeoutError:
+                task.stats.timeouts += 1
+                logging.warning(f"[SCHEDULER] Run of {task.name} timed out after {task.timeout}s")
+            except Exception as e:
+                task.stats.failures += 1
+                logging.error(f"[SCHEDULER] Run of {task.name} failed: {e!r}")
+            task.stats.record(time.perf_counter() - started, task.interval)
+
+            if not task.pending:
+                return result if isinstance(result, (int, float)) else None
@@ -2,6 +2,23 @@
 
 from .enums import MessageType
 
+
+def streaming(handler):
+    """
+    Marks a handler that streams for as long as it needs, so the service doesn't apply its request timeout to it.
+    """
+    handler.uwu_timeout = None
+    return handler
+
+
+def read_only(handler):
+    """
+    Marks a handler that doesn't change the state of the node. Inside a BATCH, consecutive read-only requests run at
+    the same time, any other request waits for the ones before it and holds back the ones after it.
+    """
+    handler.uwu_read_only = True
+    return handler
+
 class UWUHandlerBase:
     """
     Declare one method per RequestAction (or group of them).
@@ -14,7 +31,8 @@ class UWUHandlerBase:
         raise NotImplementedError("This is just an example")
 
     def bind(self):
-        # return a dict of action → bound coroutine
+        # return a dict of action → bound coroutine, or → (bound coroutine, Lane) to schedule it in a lane other than
+        # Lane.CONTROL
         return {
             "action":  self.on_action,
         }
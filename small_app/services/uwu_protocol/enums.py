@@ -16,6 +16,7 @@ class RequestAction(str, Enum):
     PEER_DISCOVERY = "peer_discovery"
     DHT_UPDATE = "dht_update"
     FILE_DOWNLOAD = "file_download"
+    BATCH = "batch"
 
 class ResponseAction(str, Enum):
     REGISTER_ACK = "register_ack"
@@ -24,9 +25,19 @@ class ResponseAction(str, Enum):
     PEER_LIST = "peer_list"
     DHT_UPDATE_RESPONSE = "dht_update_response"
     FILE_DOWNLOAD_RESPONSE = "file_download_response"
+    BATCH_RESPONSE = "batch_response"
     ERROR = "error"
     TIMEOUT = "timeout"
+    OVERLOADED = "overloaded"  # Turned away before it started, data["retry_after"] tells when to try again
 
 class EventAction(str, Enum):
     PEER_JOINED = "peer_joined"
     PEER_LEFT = "peer_left"
+
+class Lane(str, Enum):
+    """
+    Scheduling lane of a handler, declared in bind(). Each lane has its own concurrency limit and weight.
+    """
+    CONTROL = "control"  # Registrations, membership events
+    LOOKUP = "lookup"  # Small latency sensitive reads
+    BULK = "bulk"  # File transfers
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Tuple
+
+from .enums import Lane
+from ..latency import LatencyTracker
+
+# Handlers running at the same time, all lanes together
+MAX_CONCURRENT = 64
+# Handlers waiting for a slot, all lanes together, before new requests are turned away
+MAX_QUEUED = 256
+# Bounds of the delay overloaded clients are told to wait before retrying, in seconds
+MIN_RETRY_AFTER = 0.5
+MAX_RETRY_AFTER = 30.0
+# Lane -> (handlers of the lane running at the same time, weight)
+DEFAULT_LANES: Dict[Lane, Tuple[int, float]] = {
+    Lane.CONTROL: (16, 4),
+    Lane.LOOKUP: (MAX_CONCURRENT, 8),
+    Lane.BULK: (8, 1),
+}
+# Lane a batch takes when its sub-requests are in several lanes, the least urgent one wins
+LANE_URGENCY = (Lane.LOOKUP, Lane.CONTROL, Lane.BULK)
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is turned away because too many are waiting already.
+    """
+    def __init__(self, retry_after: float):
+        super().__init__(f"Overloaded, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class LaneScheduler:
+    """
+    Admits the handlers of a service by lane.
+
+    A handler runs once its lane is under its own limit and fewer than max_concurrent handlers run overall. When
+    handlers of several lanes wait for a free slot, the slots go to the lanes in proportion to their weights (stride
+    scheduling), so a lookup waits behind at most a few bulk requests however many of them are queued. The limit of the
+    bulk lane keeps room for the other lanes even when it is saturated.
+
+    At most max_queued handlers wait, past that acquire raises Overloaded right away, with the delay after which a
+    retry is likely to be admitted: the work queued is bounded instead of growing until every request times out.
+    """
+    def __init__(self, lanes: Dict[Lane, Tuple[int, float]] = None, max_concurrent: int = MAX_CONCURRENT,
+                 max_queued: int = MAX_QUEUED):
+        """
+        :param lanes: Lane -> (concurrency limit, weight), overrides DEFAULT_LANES.
+        :param max_concurrent: Handlers running at the same time, all lanes together.
+        :param max_queued: Handlers waiting for a slot, all lanes together.
+        """
+        lanes = {**DEFAULT_LANES, **(lanes or {})}
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queued = 0
+        self.rejected = {lane: 0 for lane in lanes}
+        self.limits = {lane: limit for lane, (limit, _) in lanes.items()}
+        self.weights = {lane: weight for lane, (_, weight) in lanes.items()}
+        self.active = {lane: 0 for lane in lanes}
+        self.handled = {lane: 0 for lane in lanes}
+        self.waits = {lane: LatencyTracker(default=0.0) for lane in lanes}
+        self._running = 0
+        self._waiters: Dict[Lane, deque] = {lane: deque() for lane in lanes}
+        self._pass = {lane: 0.0 for lane in lanes}  # Virtual time of each lane, the lowest one is served first
+        self._now = 0.0  # Virtual time of the last slot given
+
+    @asynccontextmanager
+    async def slot(self, lane: Lane):
+        """
+        Holds a slot of the lane for the duration of the block.
+        """
+        await self.acquire(lane)
+        try:
+            yield
+        finally:
+            self.release(lane)
+
+    async def acquire(self, lane: Lane):
+        started = time.perf_counter()
+        if not self._waiters[lane] and self.__has_room(lane):
+            self.__grant(lane)
+        else:
+            if self.queued >= self.max_queued:
+                self.rejected[lane] += 1
+                raise Overloaded(self.retry_after(lane))
+            if not self._waiters[lane]:
+                # An idle lane doesn't get credit for the time it didn't use
+                self._pass[lane] = max(self._pass[lane], self._now)
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters[lane].append(waiter)
+            self.queued += 1
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Granted right before the cancellation
+                    self.release(lane)
+                else:
+                    self._waiters[lane].remove(waiter)
+                    self.queued -= 1
+                raise
+        self.waits[lane].record(time.perf_counter() - started)
+
+    def release(self, lane: Lane):
+        self.active[lane] -= 1
+        self._running -= 1
+        self.__wake()
+
+    def retry_after(self, lane: Lane) -> float:
+        """
+        Seconds an overloaded client should wait before retrying, about the time the requests of the lane wait for a
+        slot now.
+        """
+        return round(min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, self.waits[lane].p95())), 3)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        :return: {lane: running, queued, handled and rejected requests, and the p95 of the time waited for a slot in
+        seconds}
+        """
+        return {
+            lane.value: {
+                "active": self.active[lane],
+                "queued": len(self._waiters[lane]),
+                "handled": self.handled[lane],
+                "rejected": self.rejected[lane],
+                "wait_p95": self.waits[lane].p95(),
+            }
+            for lane in self.limits
+        }
+
+    def __has_room(self, lane: Lane) -> bool:
+        return self._running < self.max_concurrent and self.active[lane] < self.limits[lane]
+
+    def __grant(self, lane: Lane):
+        self.active[lane] += 1
+        self.handled[lane] += 1
+        self._running += 1
+        self._now = self._pass[lane]
+        self._pass[lane] += 1 / self.weights[lane]
+
+    def __wake(self):
+        while self._running < self.max_concurrent:
+            ready = [lane for lane, waiters in self._waiters.items() if waiters and self.active[lane] < self.limits[lane]]
+            if not ready:
+                return
+            lane = min(ready, key=self._pass.__getitem__)
+            waiter = self._waiters[lane].popleft()
+            self.queued -= 1
+            self.__grant(lane)
+            waiter.set_result(None)
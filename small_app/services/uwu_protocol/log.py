@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from typing import Dict, Union
+
+# Parent of the protocol loggers, each category logs to "uwu.<category>" and can be given its own level
+ROOT_LOGGER = "uwu"
+# Environment variable setting the level of categories, e.g. "service=DEBUG,dht=WARNING", "uwu=ERROR" for all of them
+LEVELS_ENV = "UWU_LOG_LEVELS"
+# Level of the categories not set otherwise: what used to be printed on every request is logged at DEBUG
+DEFAULT_LEVEL = logging.INFO
+# A sampled message is logged once every SAMPLE_EVERY times
+SAMPLE_EVERY = 100
+# A rate limited message is logged at most this many times per second, per key
+RATE_LIMIT = 1.0
+
+
+def _size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024 or unit == "MiB":
+            return f"{size} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+class Summary:
+    """
+    Stands for a payload in a log message, as its size and a CRC32 of its bytes instead of its content: two log lines
+    with the same hash carried the same payload. It is only computed if the message is emitted:
+
+        log.debug("[UWU_SERVICE] Message received: %s", Summary(message, raw))
+
+    A protocol message is shown as its type, action, id and sender, followed by the summary of its data.
+    """
+    __slots__ = ("_payload", "_raw")
+
+    def __init__(self, payload, raw: Union[bytes, bytearray, memoryview] = None):
+        """
+        :param payload: Anything, a protocol message dict is shown by its header.
+        :param raw: The encoded payload if at hand, summarized instead of encoding the payload again.
+        """
+        self._payload = payload
+        self._raw = raw
+
+    def __str__(self):
+        payload, header = self._payload, ""
+        if isinstance(payload, dict) and "type" in payload and "action" in payload:
+            header = f"{getattr(payload['type'], 'value', payload['type'])} " \
+                     f"{getattr(payload['action'], 'value', payload['action'])}"
+            if payload.get("id") is not None:
+                header += f" #{payload['id']}"
+            peer_info = payload.get("peer_info") or {}
+            if isinstance(peer_info, dict) and peer_info.get("host"):
+                header += f" from {peer_info.get('host')}:{peer_info.get('port')}"
+            if self._raw is None:
+                payload = payload.get("data")
+
+        raw = self._raw
+        if raw is None:
+            if isinstance(payload, str):
+                raw = payload.encode()
+            elif isinstance(payload, (bytes, bytearray, memoryview)):
+                raw = payload
+            else:
+                raw = json.dumps(payload, default=str).encode()
+        summary = f"<{_size(len(raw))}, crc {zlib.crc32(raw):08x}>"
+        return f"{header} {summary}" if header else summary
+
+    __repr__ = __str__
+
+
+class ProtocolLogger:
+    """
+    Logger of a category of the protocol. Messages take %-style arguments, formatted only if the level is enabled, so
+    a disabled message costs a level check. Messages that can come with every request are either sampled, or rate
+    limited per key, so a node under load doesn't spend its time logging.
+    """
+    def __init__(self, category: str):
+        self.category = category
+        self.logger = logging.getLogger(f"{ROOT_LOGGER}.{category}")
+        self._seen: Dict[str, int] = {}  # key -> sampled messages seen
+        self._limits: Dict[str, tuple] = {}  # key -> (time of the last message logged, messages suppressed since)
+        self._lock = threading.Lock()
+
+    def enabled(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg: str, *args):
+        self.logger.debug(msg, *args)
+
+    def info(self, msg: str, *args):
+        self.logger.info(msg, *args)
+
+    def warning(self, msg: str, *args):
+        self.logger.warning(msg, *args)
+
+    def error(self, msg: str, *args):
+        self.logger.error(msg, *args)
+
+    def sampled(self, level: int, key: str, msg: str, *args, every: int = SAMPLE_EVERY):
+        """
+        Logs the first message of a key and then one every `every`, with the number of messages seen.
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+        with self._lock:
+            seen = self._seen[key] = self._seen.get(key, 0) + 1
+        if (seen - 1) % every == 0:
+            self.logger.log(level, msg + " (%d seen)", *args, seen)
+
+    def limited(self, level: int, key: str, msg: str, *args, per_second: float = RATE_LIMIT):
+        """
+        Logs at most per_second messages of a key per second, the next one logged tells how many were suppressed.
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._limits.get(key, (None, 0))
+            if last is not None and now - last < 1 / per_second:
+                self._limits[key] = (last, suppressed + 1)
+                return
+            self._limits[key] = (now, 0)
+        if suppressed:
+            self.logger.log(level, msg + " (%d similar suppressed)", *args, suppressed)
+        else:
+            self.logger.log(level, msg, *args)
+
+
+_loggers: Dict[str, ProtocolLogger] = {}
+_configured = False
+
+
+def get_logger(category: str) -> ProtocolLogger:
+    """
+    Returns the logger of a category, e.g. "service", "client", "handler" or "dht".
+    """
+    logger = _loggers.get(category)
+    if logger is None:
+        configure()
+        logger = _loggers.setdefault(category, ProtocolLogger(category))
+    return logger
+
+
+def set_level(category: str, level: Union[int, str]):
+    """
+    Sets the level of a category, of every category for ROOT_LOGGER.
+    """
+    name = ROOT_LOGGER if category in ("", ROOT_LOGGER) else f"{ROOT_LOGGER}.{category}"
+    logging.getLogger(name).setLevel(level.upper() if isinstance(level, str) else level)
+
+
+def configure(levels: str = None):
+    """
+    Sets the levels of the categories from `levels` or the UWU_LOG_LEVELS environment variable ("category=LEVEL,...").
+    The protocol logs go through the logging setup of the app. Called by the first get_logger, calling it again only
+    sets levels.
+    """
+    global _configured
+    root = logging.getLogger(ROOT_LOGGER)
+    if not _configured:
+        _configured = True
+        if root.level == logging.NOTSET:
+            root.setLevel(DEFAULT_LEVEL)
+        levels = levels if levels is not None else os.environ.get(LEVELS_ENV, "")
+
+    for setting in filter(None, (levels or "").split(",")):
+        category, _, level = setting.partition("=")
+        try:
+            set_level(category.strip(), level.strip())
+        except ValueError:
+            logging.warning(f"[UWU_LOG] Unknown log level in {setting!r}")
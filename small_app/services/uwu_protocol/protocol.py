@@ -4,31 +4,67 @@ This module defines the UWU protocol for communication between nodes in the netw
 UWUProtocol has RequestTypes and ResponseTypes enums to define the types of requests and responses that can be sent.
 It provides methods to create requests and responses, parse incoming messages, and validate the format of requests and responses.
 
-The protocol uses JSON for message formatting, and all messages are encoded to bytes before transmission.
+The protocol uses JSON for message formatting, and all messages are encoded to bytes before transmission. A request is
+ended by a newline, or by the end of the stream, a JSON message never contains a raw newline. Requests and
+events carry an "id", and a response carries the id of the request it answers, so it is matched with its request on
+the connection the request was sent on. A BATCH request carries an ordered list of sub-requests in data["requests"],
+each {"type", "action", "data"}, and gets one response with their responses in the same order in data["responses"].
 
 Each request and response function/callback is defined in the RequestFunctions class, which is responsible for handling
 specific request types (defined by the user).
 """
 from .enums import MessageType, RequestAction, ResponseAction, EventAction
+import itertools
 import json
 
+# Ends a request, so the receiver reads it at once while the sender keeps the connection open for the response
+FRAME_DELIMITER = b"\n"
+
+_request_ids = itertools.count(1)
+
 
 class UWUProtocol:
     @staticmethod
-    def create_message(msg_type: MessageType, action: str, peer_info: dict, data: dict) -> bytes:
-        return json.dumps({
+    def create_message(msg_type: MessageType, action: str, peer_info: dict, data: dict, request_id: int = None,
+                       timeout: float = None) -> bytes:
+        """
+        Builds and encodes a message.
+        :param request_id: Id of the message, requests and events get a new one if None. A response takes the id of
+        the request it answers.
+        :param timeout: Seconds the sender of a request waits for its response, the receiver doesn't start it after.
+        """
+        message = {
             "type": msg_type.value,
             "action": action,
             "peer_info": peer_info,
             "data": data
-        }).encode()
+        }
+        if request_id is None and msg_type in (MessageType.REQUEST, MessageType.EVENT):
+            request_id = UWUProtocol.next_request_id()
+        if request_id is not None:
+            message["id"] = request_id
+        if timeout is not None:
+            message["timeout"] = timeout
+        return json.dumps(message).encode()
+
+    @staticmethod
+    def create_sub_request(msg_type: MessageType, action: str, data: dict) -> dict:
+        """
+        Builds an entry of the requests list of a BATCH request.
+        """
+        return {"type": msg_type.value, "action": action, "data": data}
+
+    @staticmethod
+    def next_request_id() -> int:
+        return next(_request_ids)
 
     @staticmethod
     def parse_message(raw: bytes) -> dict:
         try:
             return json.loads(raw.decode())
-        except json.JSONDecodeError:
-            raise ValueError(f"[PROTOCOL] Invalid JSON format. JSON decode error: {raw.decode()}")
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            # The payload can be megabytes, only its size is reported
+            raise ValueError(f"[PROTOCOL] Invalid JSON format in a {len(raw)} bytes message: {e}")
 
     @staticmethod
     def is_valid(msg: dict) -> bool:
@@ -2,23 +2,80 @@ import json
 import asyncio
 import threading
 import logging
+import time
 from typing import Tuple
 
-from .protocol import UWUProtocol
-from .enums import MessageType, RequestAction, ResponseAction
+from .protocol import UWUProtocol, FRAME_DELIMITER
+from .enums import MessageType, RequestAction, ResponseAction, Lane
 from .base_handler import UWUHandlerBase
+from .upload_scheduler import UploadScheduler
+from .lanes import LaneScheduler, Overloaded, LANE_URGENCY, DEFAULT_LANES, MAX_CONCURRENT, MAX_QUEUED
+from .log import get_logger, Summary
+from ..runtime import NodeRuntime
+from ..scheduler import PeriodicScheduler, Overlap
 
 logging.basicConfig(level=logging.INFO)
 
+log = get_logger("service")
+
+# Longest message read from a client
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# Seconds a handler may run when its request doesn't carry a timeout
+REQUEST_TIMEOUT = 10
+
+
+class CaptureWriter:
+    """
+    Writer given to the handler of a sub-request of a batch, it keeps what the handler writes instead of sending it.
+    """
+    def __init__(self, writer):
+        self._writer = writer
+        self._parts = []
+
+    def write(self, data: bytes):
+        self._parts.append(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return self._writer.get_extra_info(name, default)
+
+    def response(self):
+        """
+        The message the handler wrote, None if it wrote nothing.
+        """
+        if not self._parts:
+            return None
+        return UWUProtocol.parse_message(b"".join(self._parts))
+
 
 class UWUService:
-    def __init__(self, host="0.0.0.0", port=6000, handler: UWUHandlerBase = None, periodical_tasks_cbk: Tuple[callable, int] = None):
+    def __init__(self, host="0.0.0.0", port=6000, handler: UWUHandlerBase = None, periodical_tasks_cbk: Tuple[callable, int] = None,
+                 upload_slots: int = 4, upload_rate: float = None, peer_upload_rate: float = None,
+                 runtime: NodeRuntime = None, lanes: dict = None, max_in_flight: int = MAX_CONCURRENT,
+                 max_queued: int = MAX_QUEUED, backlog: int = 100):
         """
         Initializes the UWUService with the given parameters.
         :param host:
         :param port:
         :param handler:
         :param periodical_tasks_cbk: A tuple containing a callback function and an interval in seconds.
+        :param upload_slots: Number of uploads served at the same time.
+        :param upload_rate: Overall upload rate limit in bytes per second, None for no limit.
+        :param peer_upload_rate: Upload rate limit per receiving peer in bytes per second, None for no limit.
+        :param runtime: Runtime of the node, the server runs on its loop. A runtime of its own is created if None.
+        :param lanes: Lane -> (concurrency limit, weight) of the lanes the handlers declare in bind(), overriding
+        lanes.DEFAULT_LANES.
+        :param max_in_flight: Requests handled at the same time.
+        :param max_queued: Requests waiting for a handler slot, the ones past it get an OVERLOADED response.
+        :param backlog: Connections the kernel keeps waiting to be accepted.
         """
         if handler is None:
             raise ValueError("Handler must be provided.")
@@ -26,12 +83,39 @@ class UWUService:
         self.host = host
         self.port = port
         self.server = None
-        self.loop = None
+        self.runtime = runtime or NodeRuntime(name=f"uwu_service_{port}")
         self.server_ready = threading.Event()
         self.handler = handler
-        self.handlers = self.handler.bind()
+        # bind() maps a request to its handler, or to (handler, Lane)
+        self.handlers = {}
+        self.handler_lanes = {}
+        for key, bound in self.handler.bind().items():
+            self.handlers[key], self.handler_lanes[key] = bound if isinstance(bound, tuple) else (bound, Lane.CONTROL)
+        # Every upload slot can be used, whatever the limit of the bulk lane
+        bulk_limit, bulk_weight = DEFAULT_LANES[Lane.BULK]
+        self.lanes = LaneScheduler({Lane.BULK: (max(upload_slots, bulk_limit), bulk_weight), **(lanes or {})},
+                                   max_concurrent=max_in_flight, max_queued=max_queued)
+        self.backlog = backlog
+        # Periodic tasks of the node, run on the service loop while the server is up
+        self.scheduler = PeriodicScheduler()
         self.periodical_tasks = periodical_tasks_cbk[0] if periodical_tasks_cbk is not None else None
         self.periodical_interval = 0 if periodical_tasks_cbk is None else periodical_tasks_cbk[1]
+        if self.periodical_tasks and self.periodical_interval > 0:
+            self.schedule("periodical_tasks", self.periodical_tasks, self.periodical_interval)
+        self.uploads = UploadScheduler(slots=upload_slots, rate=upload_rate, peer_rate=peer_upload_rate)
+
+    def schedule(self, name: str, callback, interval: float, jitter: float = 0.0, overlap: Overlap = Overlap.SKIP,
+                 timeout: float = None):
+        """
+        Runs callback() every interval seconds while the server is up, a run never overlaps the previous one. See
+        PeriodicScheduler.add. Once the service is running, it must be called from its loop.
+        """
+        self.scheduler.add(name, callback, interval, jitter=jitter, overlap=overlap, timeout=timeout)
+        logging.info(f"[UWU_SERVICE] Periodic task {name} scheduled every {interval} seconds.")
+
+    @property
+    def loop(self):
+        return self.runtime.loop
 
     def is_running(self):
         """
@@ -41,57 +125,161 @@ class UWUService:
         return self.server is not None and self.server.is_serving()
 
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        logging.info("[UWU_SERVICE] Handling client connection")
+        log.debug("[UWU_SERVICE] Handling client connection")
 
         try:
-            # Set a timeout for handling the client request
-            timeout = 10  # Timeout in seconds
-            logging.info("[UWU_SERVICE] Waiting for data from client...")
-            data = await reader.read(4096)
-            if not data:
-                logging.warning("[UWU_SERVICE] No data received from client.")
+            message = await self.__read_message(reader)
+            if message is None:
+                log.limited(logging.WARNING, "no_data", "[UWU_SERVICE] No data received from client.")
                 return
 
-            # Parse and validate the message
-            message = UWUProtocol.parse_message(data)
+            # Validate the message
             if not UWUProtocol.is_valid(message):
-                logging.error("[UWU_SERVICE] Invalid message received.")
+                log.limited(logging.ERROR, "invalid", "[UWU_SERVICE] Invalid message received: %s", Summary(message))
                 return
 
-            logging.info(f"[UWU_SERVICE] Message received: {message}")
-
-            print(f"[UWU_SERVICE] Loaded handlers:{self.handlers}")
+            log.debug("[UWU_SERVICE] Message received: %s", Summary(message))
 
-            # Find the appropriate handler
-            handler = self.handlers.get((message["type"], message["action"]))
+            # Find the appropriate handler, batches are run by the service itself
+            if (message["type"], message["action"]) == (MessageType.REQUEST, RequestAction.BATCH):
+                handler = self.handle_batch
+            else:
+                handler = self.handlers.get((message["type"], message["action"]))
             if not handler:
-                logging.error(f"[UWU_SERVICE] No handler for message type: {message['type'], message['action']}")
+                log.limited(logging.ERROR, "no_handler", "[UWU_SERVICE] No handler for message type: %s",
+                            (message["type"], message["action"]))
                 return
 
-            # Execute the handler with a timeout
-            await asyncio.wait_for(handler(message, reader, writer), timeout=timeout)
+            # A request the client stopped waiting for is not started, nor kept running
+            timeout = message.get("timeout")
+            deadline = time.monotonic() + timeout if isinstance(timeout, (int, float)) else None
+            lane = self.lane_of(message)
+            try:
+                await asyncio.wait_for(self.lanes.acquire(lane), self.__remaining(deadline))
+            except Overloaded as e:
+                log.limited(logging.WARNING, "overloaded", "[UWU_SERVICE] Overloaded, turning away %s request",
+                            message["action"])
+                response = UWUProtocol.create_message(
+                    MessageType.RESPONSE, ResponseAction.OVERLOADED.value, {},
+                    {"message": "Overloaded", "retry_after": e.retry_after}, request_id=message.get("id")
+                )
+                writer.write(response)
+                await writer.drain()
+                return
+
+            # Execute the handler within the deadline, or the default timeout. Streaming handlers run until they are done
+            handler_timeout = getattr(handler, "uwu_timeout", REQUEST_TIMEOUT)
+            if handler_timeout is not None and deadline is not None:
+                handler_timeout = self.__remaining(deadline)
+            try:
+                await asyncio.wait_for(handler(message, reader, writer), timeout=handler_timeout)
+            finally:
+                self.lanes.release(lane)
 
         except asyncio.TimeoutError:
-            logging.error("[UWU_SERVICE] Request timed out")
+            log.limited(logging.ERROR, "timeout", "[UWU_SERVICE] Request timed out")
             response = UWUProtocol.create_message(
-                MessageType.RESPONSE, ResponseAction.TIMEOUT.value, {}, {"message": "Request timed out"}
+                MessageType.RESPONSE, ResponseAction.TIMEOUT.value, {}, {"message": "Request timed out"},
+                request_id=message.get("id")
             )
             writer.write(response)
             await writer.drain()
 
         except Exception as e:
-            logging.error(f"[UWU_SERVICE] Error handling client: {e}")
+            log.limited(logging.ERROR, "error", "[UWU_SERVICE] Error handling client: %s", e)
 
         finally:
             writer.close()
             await writer.wait_closed()
-            logging.info("[UWU_SERVICE] Connection closed")
+            log.debug("[UWU_SERVICE] Connection closed")
+
+    def lane_of(self, message) -> Lane:
+        """
+        Returns the lane of a request, the least urgent lane of its sub-requests for a BATCH.
+        """
+        key = (message["type"], message["action"])
+        if key in self.handler_lanes:
+            return self.handler_lanes[key]
+        if message["action"] != RequestAction.BATCH:
+            return Lane.CONTROL
+
+        lanes = {Lane.LOOKUP}
+        for request in message.get("data", {}).get("requests", []):
+            lanes.add(self.handler_lanes.get((request.get("type"), request.get("action")), Lane.CONTROL))
+        return max(lanes, key=LANE_URGENCY.index)
+
+    @staticmethod
+    def __remaining(deadline):
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    @staticmethod
+    async def __read_message(reader: asyncio.StreamReader):
+        """
+        Reads a message up to its newline, or up to the end of the stream for a client that sends it and then closes
+        its side. The message is parsed once, when it is complete.
+        """
+        try:
+            data = await reader.readuntil(FRAME_DELIMITER)
+        except asyncio.IncompleteReadError as e:
+            data = e.partial
+        except asyncio.LimitOverrunError:
+            raise ValueError(f"[UWU_SERVICE] Message over {MAX_MESSAGE_SIZE} bytes")
+        return UWUProtocol.parse_message(data) if data.strip() else None
+
+    async def handle_batch(self, message, reader, writer):
+        """
+        Runs the sub-requests of a BATCH request in order and answers them with a single response. Consecutive
+        read-only sub-requests run concurrently, the others run alone, after the ones before them.
+        """
+        requests = message.get("data", {}).get("requests", [])
+        responses = [None] * len(requests)
+
+        async def run(index, sub_message, handler):
+            capture = CaptureWriter(writer)
+            try:
+                await handler(sub_message, reader, capture)
+                responses[index] = capture.response()
+            except Exception as e:
+                log.limited(logging.ERROR, "batch_error", "[UWU_SERVICE] Error in batched request %s: %s",
+                            sub_message["action"], e)
+                responses[index] = {"type": MessageType.ERROR.value, "action": ResponseAction.ERROR.value,
+                                    "data": {"message": str(e)}}
+
+        reads = []
+        for index, request in enumerate(requests):
+            sub_message = {"type": request.get("type"), "action": request.get("action"),
+                           "peer_info": message.get("peer_info"), "data": request.get("data", {})}
+            handler = self.handlers.get((sub_message["type"], sub_message["action"]))
+            # Streaming handlers own the connection, they can't be batched
+            if handler is None or getattr(handler, "uwu_timeout", 0) is None:
+                responses[index] = {"type": MessageType.ERROR.value, "action": ResponseAction.ERROR.value,
+                                    "data": {"message": f"No handler for {sub_message['action']}"}}
+                continue
+
+            if getattr(handler, "uwu_read_only", False):
+                reads.append(run(index, sub_message, handler))
+                continue
+            if reads:
+                await asyncio.gather(*reads)
+                reads = []
+            await run(index, sub_message, handler)
+
+        if reads:
+            await asyncio.gather(*reads)
+
+        response = UWUProtocol.create_message(
+            MessageType.RESPONSE, ResponseAction.BATCH_RESPONSE.value, message.get("peer_info"),
+            {"responses": responses}, request_id=message.get("id")
+        )
+        writer.write(response)
+        await writer.drain()
 
     async def get_server(self):
         """
         Starts the server and returns it.
         """
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, backlog=self.backlog,
+                                            limit=MAX_MESSAGE_SIZE)
         return server
 
     async def __start_server(self):
@@ -106,10 +294,7 @@ class UWUService:
         for key in self.handlers.keys():
             print(f"  - {key}")
 
-        # Schedule periodic task loop (customize interval)
-        if self.periodical_tasks and self.periodical_interval > 0:
-            print(f"[UWU_SERVICE] Periodic tasks scheduled every {self.periodical_interval} seconds.")
-            periodic_task = asyncio.create_task(self.__run_periodical_tasks_loop(interval=self.periodical_interval))
+        self.scheduler.start()
 
         try:
             logging.info("[UWU_SERVICE] Starting serve forever")
@@ -120,11 +305,8 @@ class UWUService:
         except Exception as e:
             print(f"[UWU_SERVICE] Exception in server loop: {e}")
         finally:
-            periodic_task.cancel()
-            try:
-                await periodic_task
-            except asyncio.CancelledError:
-                print("[UWU_SERVICE] Periodic tasks cancelled.")
+            await self.scheduler.stop()
+            print("[UWU_SERVICE] Periodic tasks cancelled.")
 
     async def __shutdown_server(self):
         """
@@ -136,44 +318,24 @@ class UWUService:
             await self.server.wait_closed()
             print("[UWU_SERVICE] Server shut down.")
 
-    def __server_thread_func(self):
-        """
-        Thread function to run the server loop.
-        """
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        try:
-            self.loop.run_until_complete(self.__start_server())
-        except Exception as e:
-            print(f"[ERROR] Server loop exception: {e}")
-        finally:
-            self.loop.close()
-
-    async def __run_periodical_tasks_loop(self, interval: int):
-        """
-        Runs the periodical_tasks() method every `interval` seconds in a non-blocking manner.
-        """
-        print(f"[UWU_SERVICE] Periodic task loop started with interval = {interval}s")
-        try:
-            while True:
-                # Schedule the periodic task and allow other tasks to run
-                await asyncio.sleep(interval)
-                asyncio.create_task(self.periodical_tasks())
-        except asyncio.CancelledError:
-            print("[UWU_SERVICE] Periodic task loop cancelled.")
-
     def stop_service(self):
         """
         Shuts down the server safely.
         :return:
         """
-        if self.server and self.loop:
-            asyncio.run_coroutine_threadsafe(self.__shutdown_server(), self.loop)
+        if self.server and self.runtime.is_running():
+            self.runtime.submit(self.__shutdown_server())
 
     def start_service(self):
         """
-        Starts the server in a new thread.
+        Starts the server on the runtime loop, starting the runtime if needed.
         :return:
         """
         print("[UWU_SERVICE] Starting server...")
-        threading.Thread(target=self.__server_thread_func, daemon=True).start()
+        self.runtime.start()
+        self.runtime.submit(self.__start_server()).add_done_callback(self.__on_server_done)
+
+    @staticmethod
+    def __on_server_done(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"[ERROR] Server loop exception: {future.exception()}")
@@ -0,0 +1,135 @@
+import asyncio
+import time
+from collections import deque
+
+
+class TokenBucket:
+    """
+    Token bucket of rate bytes per second, holding at most capacity bytes (one second worth by default).
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self, amount: int, now: float) -> float:
+        """
+        Seconds to wait before amount bytes can be taken. Amounts bigger than the bucket only need a full bucket, the
+        difference is paid back as debt.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = min(amount, self.capacity) - self.tokens
+        return 0.0 if missing <= 0 else missing / self.rate
+
+    def consume(self, amount: int):
+        self.tokens -= amount
+
+
+class UploadScheduler:
+    """
+    Shares the upstream of a node between the files it serves.
+
+    At most slots uploads run at the same time, the others wait for a free slot. Running uploads send one chunk per
+    turn, granted in round-robin order, so a fast downloader can't starve the others. Each chunk is also paid for in
+    the overall token bucket (rate) and in the bucket of the receiving peer (peer_rate), both in bytes per second.
+    Without rates, chunks are sent as fast as the sockets drain.
+    """
+    def __init__(self, slots: int = 4, rate: float = None, peer_rate: float = None):
+        self.slots = slots
+        self.rate = rate
+        self.peer_rate = peer_rate
+        self._slots = asyncio.Semaphore(slots)
+        self._bucket = TokenBucket(rate) if rate else None
+        self._peer_buckets = {}  # peer -> TokenBucket
+        self._peer_uploads = {}  # peer -> number of running uploads
+        self._waiting = deque()  # (peer, amount, future), in turn order
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    @property
+    def limited(self) -> bool:
+        return self._bucket is not None or self.peer_rate is not None
+
+    async def upload(self, peer: str, writer: asyncio.StreamWriter, chunks):
+        """
+        Sends the chunks (any iterable of bytes) to the writer once a slot is free, one turn per chunk.
+        :param peer: Identity of the receiving peer, usually its address.
+        """
+        async with self._slots:
+            self._peer_uploads[peer] = self._peer_uploads.get(peer, 0) + 1
+            try:
+                for chunk in chunks:
+                    if self.limited:
+                        await self.__turn(peer, len(chunk))
+                    writer.write(chunk)
+                    await writer.drain()
+            finally:
+                self._peer_uploads[peer] -= 1
+                if not self._peer_uploads[peer]:
+                    del self._peer_uploads[peer]
+                    self._peer_buckets.pop(peer, None)
+
+    async def __turn(self, peer: str, amount: int):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((peer, amount, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self.__dispatch())
+        else:
+            self._wakeup.set()
+        await future
+
+    async def __dispatch(self):
+        while self._waiting:
+            delay = self.__grant_ready()
+            if delay is None:
+                continue
+            # Wait for the buckets to refill, or for a new upload that may be allowed to send right away
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def __grant_ready(self):
+        """
+        Goes once through the waiting chunks in turn order and grants the ones both buckets allow. Blocked peers keep
+        their place. Returns the time until the next chunk could be granted, None when none is left waiting.
+        """
+        now = time.monotonic()
+        delay = None
+        for _ in range(len(self._waiting)):
+            peer, amount, future = self._waiting.popleft()
+            if future.done():
+                continue  # The upload was cancelled
+
+            wait = self._bucket.delay(amount, now) if self._bucket else 0.0
+            if wait > 0:
+                # Nobody can send before the overall bucket refills
+                self._waiting.appendleft((peer, amount, future))
+                return wait
+
+            peer_bucket = self.__peer_bucket(peer)
+            peer_wait = peer_bucket.delay(amount, now) if peer_bucket else 0.0
+            if peer_wait > 0:
+                self._waiting.append((peer, amount, future))
+                delay = peer_wait if delay is None else min(delay, peer_wait)
+                continue
+
+            if self._bucket:
+                self._bucket.consume(amount)
+            if peer_bucket:
+                peer_bucket.consume(amount)
+            future.set_result(None)
+        return delay
+
+    def __peer_bucket(self, peer: str):
+        if self.peer_rate is None:
+            return None
+        bucket = self._peer_buckets.get(peer)
+        if bucket is None:
+            bucket = self._peer_buckets[peer] = TokenBucket(self.peer_rate)
+        return bucket
@@ -0,0 +1,304 @@
+import logging
+import threading
+
+from PySide6.QtCore import QAbstractTableModel, QModelIndex, Qt, Signal, Slot
+
+# Rows handed to the view on every fetchMore
+FETCH_BATCH_SIZE = 256
+
+
+class DHTTableModel(QAbstractTableModel):
+    """
+    Table model of the DHT, one row per (file, host, port).
+
+    The rows are flat tuples built on a worker thread, already filtered and sorted, and the view only receives them in
+    batches through canFetchMore/fetchMore. The GUI thread never walks the whole DHT, so refreshing costs the same no
+    matter how big it is.
+    """
+    HEADERS = ["Filename", "Host", "Port"]
+
+    _rows_ready = Signal(int, object)
+
+    def __init__(self, dht, parent=None):
+        super().__init__(parent)
+        self._dht = dht
+        self._rows = []
+        self._fetched = 0
+
+        self._filter_text = ""
+        self._sort_column = None
+        self._sort_order = Qt.AscendingOrder
+
+        self._generation = 0
+        self._refreshing = False
+        self._rows_ready.connect(self._on_rows_ready)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._fetched
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._fetched < len(self._rows)
+
+    def fetchMore(self, parent=QModelIndex()):
+        count = min(FETCH_BATCH_SIZE, len(self._rows) - self._fetched)
+        if parent.isValid() or count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._fetched, self._fetched + count - 1)
+        self._fetched += count
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self._fetched or role != Qt.DisplayRole:
+            return None
+        return str(self._rows[index.row()][index.column()])
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """
+        Called by the view when a header is clicked, the sorting itself runs on the worker thread.
+        """
+        self._sort_column = column
+        self._sort_order = order
+        self.refresh(force=True)
+
+    def set_filter(self, text: str):
+        """
+        Only shows the rows whose filename contains the text (case insensitive).
+        """
+        self._filter_text = text
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """
+        Rebuilds the rows on a worker thread. Periodic refreshes are skipped while one is still running.
+        """
+        if self._refreshing and not force:
+            return
+
+        self._generation += 1
+        self._refreshing = True
+        threading.Thread(
+            target=self._build_rows,
+            args=(self._generation, self._filter_text, self._sort_column, self._sort_order),
+            daemon=True,
+        ).start()
+
+    def _build_rows(self, generation, filter_text, sort_column, sort_order):
+        rows = [entry[:3] for entry in self._dht.get_entries()]
+
+        if filter_text:
+            needle = filter_text.lower()
+            rows = [row for row in rows if needle in row[0].lower()]
+        if sort_column is not None:
+            rows.sort(key=lambda row: row[sort_column], reverse=sort_order == Qt.DescendingOrder)
+
+        self._rows_ready.emit(generation, rows)
+
+    @Slot(int, object)
+    def _on_rows_ready(self, generation, rows):
+        if generation != self._generation:
+            return
+
+        self.beginResetModel()
+        self._rows = rows
+        self._fetched = min(FETCH_BATCH_SIZE, len(rows))
+        self._refreshing = False
+        self.endResetModel()
+
+
+class DiffTableModel(QAbstractTableModel):
+    """
+    Table model kept up to date with diffs instead of full rebuilds.
+
+    list_rows is called on a worker thread and returns the whole listing as {key: row}. The worker compares it with the
+    previous listing and only hands the removed, changed and added rows to the GUI thread, so the view keeps its
+    selection and scroll position, and an unchanged listing costs nothing on the GUI thread.
+    """
+    _diff_ready = Signal(object, object, object)
+
+    def __init__(self, headers, list_rows, parent=None):
+        super().__init__(parent)
+        self.headers = headers
+        self._list_rows = list_rows
+
+        # GUI thread state
+        self._keys = []
+        self._rows = {}
+        self._positions = {}
+
+        # Worker state, only one worker runs at a time
+        self._snapshot = {}
+        self._refreshing = False
+        self._refresh_again = False
+        self._diff_ready.connect(self._on_diff_ready)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._keys)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        return str(self._rows[self._keys[index.row()]][index.column()])
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def row_at(self, row: int):
+        """
+        Returns the row tuple displayed at the given position.
+        """
+        return self._rows[self._keys[row]]
+
+    def refresh(self):
+        """
+        Lists the rows and computes the diff on a worker thread. A refresh asked for while one is running is run right
+        after it, with the newest listing.
+        """
+        if self._refreshing:
+            self._refresh_again = True
+            return
+
+        self._refreshing = True
+        threading.Thread(target=self._build_diff, daemon=True).start()
+
+    def _build_diff(self):
+        try:
+            rows = self._list_rows()
+        except Exception as e:
+            logging.error(f"[TABLE_MODEL] Failed to list rows: {e}")
+            rows = self._snapshot
+
+        previous = self._snapshot
+        removed = [key for key in previous if key not in rows]
+        changed = {key: row for key, row in rows.items() if key in previous and previous[key] != row}
+        added = {key: row for key, row in rows.items() if key not in previous}
+        self._snapshot = rows
+
+        self._diff_ready.emit(removed, changed, added)
+
+    @Slot(object, object, object)
+    def _on_diff_ready(self, removed, changed, added):
+        if removed:
+            self._remove_keys(removed)
+
+        for key, row in changed.items():
+            self._rows[key] = row
+            position = self._positions[key]
+            self.dataChanged.emit(self.index(position, 0), self.index(position, len(self.headers) - 1))
+
+        if added:
+            first = len(self._keys)
+            self.beginInsertRows(QModelIndex(), first, first + len(added) - 1)
+            for position, (key, row) in enumerate(added.items(), start=first):
+                self._keys.append(key)
+                self._rows[key] = row
+                self._positions[key] = position
+            self.endInsertRows()
+
+        self._refreshing = False
+        if self._refresh_again:
+            self._refresh_again = False
+            self.refresh()
+
+    def _remove_keys(self, keys):
+        positions = sorted((self._positions[key] for key in keys), reverse=True)
+
+        # Remove contiguous runs from the bottom up, so the positions left to remove stay valid
+        index = 0
+        while index < len(positions):
+            last = first = positions[index]
+            index += 1
+            while index < len(positions) and positions[index] == first - 1:
+                first = positions[index]
+                index += 1
+
+            self.beginRemoveRows(QModelIndex(), first, last)
+            for key in self._keys[first:last + 1]:
+                del self._rows[key]
+                del self._positions[key]
+            del self._keys[first:last + 1]
+            self.endRemoveRows()
+
+        for position in range(positions[-1], len(self._keys)):
+            self._positions[self._keys[position]] = position
+
+
+class DownloadsTableModel(QAbstractTableModel):
+    """
+    Table of the downloads of a peer node, one row per download.
+
+    Rows are updated one at a time from the download updates, so a progress tick only repaints its own row.
+    """
+    HEADERS = ["Filename", "Peer", "Progress", "Speed", "ETA", "State"]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._downloads = []
+        self._positions = {}  # download id -> row
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._downloads)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        download = self._downloads[index.row()]
+        column = index.column()
+        if column == 0:
+            return download["filename"]
+        if column == 1:
+            return f"{download['host']}:{download['port']}"
+        if column == 2:
+            if not download["size"]:
+                return format_bytes(download["received"])
+            return f"{download['received'] * 100 // download['size']}% of {format_bytes(download['size'])}"
+        if column == 3:
+            return f"{format_bytes(download['speed'])}/s" if download["speed"] else ""
+        if column == 4:
+            return "" if download["eta"] is None else f"{int(download['eta'])}s"
+        return download["error"] or download["state"]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def download_id_at(self, row: int) -> str:
+        return self._downloads[row]["id"]
+
+    @Slot(object)
+    def update_download(self, download: dict):
+        row = self._positions.get(download["id"])
+        if row is None:
+            row = len(self._downloads)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self._downloads.append(download)
+            self._positions[download["id"]] = row
+            self.endInsertRows()
+            return
+
+        self._downloads[row] = download
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.HEADERS) - 1))
+
+
+def format_bytes(size) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
@@ -0,0 +1,92 @@
+"""
+Memory benchmark for the DHT storage. Registers the same (file, provider) entries in the compact DHT and in the two
+nested dict layouts used before it, and reports the memory used by each one:
+    - tuple keys: {filename: {"providers": {(host, port): details}}}, the previous shared DHT.
+    - host/port keys: {filename: {"providers": {host: {str(port): {"details": details}}}}}, the small_app DHT.
+
+The reduction depends mostly on how many providers share each file, since every file pays a fixed overhead.
+
+Run it from the repository root:
+    python -m tests.scripts.bench_dht_memory --entries 1000000
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+
+from uwuFileShare.shared.models.dht import DHT
+
+
+def generate_registrations(entries: int, providers: int, files: int):
+    """
+    Yields one (host, port, files) registration per provider. Strings are built fresh for every registration, as they
+    would be when decoded from a JSON message, and generated while measuring so both storages pay for the ones they keep.
+    """
+    rng = random.Random(42)
+    per_provider = entries // providers
+    for index in range(providers):
+        host = ".".join(str(part) for part in (10, index >> 16 & 255, index >> 8 & 255, index & 255))
+        port = 5000 + index % 1000
+        names = [(f"shared_file_{rng.randrange(files)}.bin", "") for _ in range(per_provider)]
+        yield host, port, names
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    storage = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del storage
+    return size
+
+
+def build_tuple_keyed_dict(registrations):
+    dht = {}
+    for host, port, names in registrations:
+        for filename, details in names:
+            entry = dht.setdefault(filename, {"providers": {}})
+            entry["providers"][(host, port)] = details
+    return dht
+
+
+def build_host_keyed_dict(registrations):
+    dht = {}
+    for host, port, names in registrations:
+        for filename, details in names:
+            entry = dht.setdefault(filename, {"providers": {}})
+            entry["providers"].setdefault(host, {})[str(port)] = {"details": details}
+    return dht
+
+
+def build_compact_dht(registrations):
+    dht = DHT()
+    dht._notify_change = lambda: None  # Keep the benchmark quiet, nothing is listening anyway
+    for host, port, names in registrations:
+        dht.update_node_files(names, host, port)
+    return dht
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory of the nested dict and the compact DHT.")
+    parser.add_argument("--entries", type=int, default=1_000_000, help="Number of (file, provider) entries.")
+    parser.add_argument("--providers", type=int, default=10_000, help="Number of providers.")
+    parser.add_argument("--files", type=int, default=200_000, help="Number of distinct file names.")
+    args = parser.parse_args()
+
+    def registrations():
+        return generate_registrations(args.entries, args.providers, args.files)
+
+    compact = measure(lambda: build_compact_dht(registrations()))
+    tuple_keyed = measure(lambda: build_tuple_keyed_dict(registrations()))
+    host_keyed = measure(lambda: build_host_keyed_dict(registrations()))
+
+    print(f"Entries:          {args.entries:,} ({args.providers:,} providers, up to {args.files:,} files)")
+    print(f"Compact DHT:      {compact / 2**20:8.1f} MiB")
+    print(f"Tuple keys dict:  {tuple_keyed / 2**20:8.1f} MiB ({tuple_keyed / compact:.1f}x)")
+    print(f"Host/port dict:   {host_keyed / 2**20:8.1f} MiB ({host_keyed / compact:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
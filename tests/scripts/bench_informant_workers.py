@@ -0,0 +1,106 @@
+"""
+Throughput benchmark for the multi-process informant. Starts an informant with 1 to --max-workers processes sharing
+the port (SO_REUSEPORT), fills its DHT, and measures how many GET_DHT requests per second a pool of client processes
+gets served. On a machine with enough cores the throughput should grow close to linearly with the workers.
+
+The informant logs every message, its output is sent to /dev/null while measuring.
+
+Run it from the repository root:
+    python -m tests.scripts.bench_informant_workers --max-workers 4 --clients 8
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+from uwuFileShare.informant_node.models.informant_node import InformantNode
+from uwuFileShare.shared.services.uwu_protocol.enums import MessageType, RequestAction
+from uwuFileShare.shared.services.uwu_protocol.protocol import UWUProtocol
+
+HOST = "127.0.0.1"
+
+
+async def request(port: int, message: bytes) -> bytes:
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(message)
+    writer.write_eof()
+
+    # The informant does not close the connection after answering, read until the response is complete
+    response = b""
+    while chunk := await reader.read(65536):
+        response += chunk
+        try:
+            json.loads(response)
+            break
+        except ValueError:
+            continue
+    writer.close()
+    return response
+
+
+def run_client(port: int, duration: float, concurrency: int, results: multiprocessing.Queue):
+    message = UWUProtocol.create_message(MessageType.REQUEST, RequestAction.GET_DHT, {"host": HOST, "port": 0}, {})
+
+    async def worker(deadline: float) -> int:
+        done = 0
+        while time.monotonic() < deadline:
+            await request(port, message)
+            done += 1
+        return done
+
+    async def main() -> int:
+        deadline = time.monotonic() + duration
+        return sum(await asyncio.gather(*(worker(deadline) for _ in range(concurrency))))
+
+    results.put(asyncio.run(main()))
+
+
+def measure(port: int, workers: int, clients: int, concurrency: int, duration: float, files: int) -> float:
+    node = InformantNode(host=HOST, port=port, workers=workers)
+    with node.dht.batch():
+        for index in range(files):
+            node.dht.add_file(f"file_{index}.bin", "10.0.0.1", 5000 + index % 100)
+    node.run()
+    time.sleep(2 + workers)  # Let the worker processes import and bind
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_client, args=(port, duration, concurrency, results))
+                 for _ in range(clients)]
+    for process in processes:
+        process.start()
+    total = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+
+    node.stop()
+    node.runtime.stop()
+    return total / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--clients", type=int, default=8, help="Client processes generating load.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight per client process.")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds measured per worker count.")
+    parser.add_argument("--files", type=int, default=100, help="Files in the DHT served by GET_DHT.")
+    parser.add_argument("--port", type=int, default=7300)
+    args = parser.parse_args()
+
+    # Keep the real stdout for the results, the informant processes inherit /dev/null
+    results = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        rate = measure(args.port + workers, workers, args.clients, args.concurrency, args.duration, args.files)
+        baseline = baseline or rate
+        results.write(f"{workers} worker(s): {rate:10.0f} requests/s  ({rate / baseline:.2f}x)\n")
+        results.flush()
+
+
+if __name__ == "__main__":
+    main()
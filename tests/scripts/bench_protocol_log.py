@@ -0,0 +1,78 @@
+"""
+Cost of logging a received message on the hot path. Builds a REGISTER request carrying many files, then measures per
+message:
+    - print: the message printed as a whole, as the service did before (to /dev/null).
+    - f-string at INFO: logging.debug(f"... {message}") with logging at INFO, formatted though nothing is emitted.
+    - lazy at INFO: log.debug("... %s", Summary(message, raw)) with the category at INFO, a level check.
+    - lazy at DEBUG: the same line emitted (to /dev/null), the payload summarized by size and CRC32.
+    - rate limited: log.limited(...) at INFO, as the warnings that can come with every request.
+
+Run it from the repository root:
+    python -m tests.scripts.bench_protocol_log --files 10000 --count 200
+"""
+import argparse
+import contextlib
+import logging
+import os
+import time
+
+from uwuFileShare.shared.services.uwu_protocol import log as protocol_log
+from uwuFileShare.shared.services.uwu_protocol.enums import MessageType, RequestAction
+from uwuFileShare.shared.services.uwu_protocol.protocol import UWUProtocol
+
+
+def measure(function, count: int) -> float:
+    """
+    :return: Microseconds per call.
+    """
+    started = time.perf_counter()
+    for _ in range(count):
+        function()
+    return (time.perf_counter() - started) / count * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=10000, help="Files carried by the request.")
+    parser.add_argument("--count", type=int, default=200, help="Messages logged per measure.")
+    args = parser.parse_args()
+
+    raw = UWUProtocol.create_message(MessageType.REQUEST, RequestAction.REGISTER, {"host": "127.0.0.1", "port": 5000},
+                                     {"files": [[f"shared_file_{index}.bin", ""] for index in range(args.files)]})
+    message = UWUProtocol.parse_message(raw)
+    print(f"Request of {len(raw) / 1024:.1f} KiB, {args.files} files")
+
+    log = protocol_log.get_logger("bench")
+    devnull = open(os.devnull, "w")
+    handler = logging.StreamHandler(devnull)
+    log.logger.addHandler(handler)
+    log.logger.propagate = False
+    logging.getLogger().setLevel(logging.INFO)
+
+    def printed():
+        with contextlib.redirect_stdout(devnull):
+            print("[UWU_SERVICE] Message received:", message)
+
+    results = {
+        "print": measure(printed, args.count),
+        "f-string at INFO": measure(lambda: logging.debug(f"[UWU_SERVICE] Message received: {message}"), args.count),
+    }
+
+    protocol_log.set_level("bench", logging.INFO)
+    results["lazy at INFO"] = measure(
+        lambda: log.debug("[UWU_SERVICE] Message received: %s", protocol_log.Summary(message, raw)), args.count)
+    results["rate limited"] = measure(
+        lambda: log.limited(logging.WARNING, "bench", "[UWU_SERVICE] Overloaded, turning away %s request",
+                            message["action"]), args.count)
+
+    protocol_log.set_level("bench", logging.DEBUG)
+    results["lazy at DEBUG"] = measure(
+        lambda: log.debug("[UWU_SERVICE] Message received: %s", protocol_log.Summary(message, raw)), args.count)
+
+    for name, micros in results.items():
+        print(f"{name:>18}: {micros:10.2f} us per message")
+    devnull.close()
+
+
+if __name__ == "__main__":
+    main()
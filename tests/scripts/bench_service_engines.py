@@ -0,0 +1,117 @@
+"""
+Throughput benchmark of the transport engines of UWUService. Starts an informant with each engine, a handful of files
+in its DHT, and measures how many small GET_DHT requests per second a pool of client processes gets served.
+
+First every request opens its own connection and ends it by closing the client side, the way the nodes talk to each
+other today, so both engines get exactly the same traffic. On localhost the TCP handshake and teardown cost about as
+much as the rest of the request, which caps what any engine can gain there. Then the protocol engine is measured with
+one connection per client carrying newline delimited requests, which the streams engine can't parse since it reads a
+request until the end of the stream.
+
+The informant only logs requests at DEBUG (see uwu_protocol.log), its remaining output is sent to /dev/null while
+measuring.
+
+Run it from the repository root:
+    python -m tests.scripts.bench_service_engines --clients 4 --duration 5
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import time
+
+from uwuFileShare.informant_node.models.informant_node import InformantNode
+from uwuFileShare.shared.services.uwu_protocol.enums import MessageType, RequestAction, ServiceEngine
+from uwuFileShare.shared.services.uwu_protocol.protocol import UWUProtocol
+
+HOST = "127.0.0.1"
+
+
+def run_client(port: int, duration: float, results: multiprocessing.Queue):
+    message = UWUProtocol.create_message(MessageType.REQUEST, RequestAction.GET_DHT, {"host": HOST, "port": 0}, {})
+    done = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        with socket.create_connection((HOST, port)) as sock:
+            sock.sendall(message)
+            sock.shutdown(socket.SHUT_WR)
+            # Both engines close the connection once the response is sent
+            while sock.recv(65536):
+                pass
+        done += 1
+    results.put(done)
+
+
+def run_keep_alive_client(port: int, duration: float, results: multiprocessing.Queue):
+    message = UWUProtocol.create_message(MessageType.REQUEST, RequestAction.GET_DHT, {"host": HOST, "port": 0}, {})
+    message += b"\n"
+    decoder = json.JSONDecoder()
+    done = 0
+    deadline = time.monotonic() + duration
+    with socket.create_connection((HOST, port)) as sock:
+        # The responses are not delimited, split them where each JSON document ends
+        pending = ""
+        while time.monotonic() < deadline:
+            sock.sendall(message)
+            while True:
+                pending += sock.recv(65536).decode()
+                try:
+                    _, end = decoder.raw_decode(pending)
+                except ValueError:
+                    continue
+                pending = pending[end:]
+                break
+            done += 1
+    results.put(done)
+
+
+def measure(engine: ServiceEngine, port: int, clients: int, duration: float, files: int, client=run_client) -> float:
+    node = InformantNode(host=HOST, port=port, engine=engine)
+    with node.dht.batch():
+        for index in range(files):
+            node.dht.add_file(f"file_{index}.bin", "10.0.0.1", 5000 + index)
+    node.run()
+    node.uwu_service.server_ready.wait()
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client, args=(port, duration, results)) for _ in range(clients)]
+    for process in processes:
+        process.start()
+    total = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+
+    node.stop()
+    node.runtime.stop()
+    return total / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=4, help="Client processes generating load.")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds measured per engine.")
+    parser.add_argument("--files", type=int, default=10, help="Files in the DHT served by GET_DHT.")
+    parser.add_argument("--port", type=int, default=7400)
+    args = parser.parse_args()
+
+    # Keep the real stdout for the results
+    results = os.fdopen(os.dup(1), "w")
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+
+    runs = [
+        ("streams, connection per request", ServiceEngine.STREAMS, run_client),
+        ("protocol, connection per request", ServiceEngine.PROTOCOL, run_client),
+        ("protocol, connection per client", ServiceEngine.PROTOCOL, run_keep_alive_client),
+    ]
+    baseline = None
+    for offset, (name, engine, client) in enumerate(runs):
+        rate = measure(engine, args.port + offset, args.clients, args.duration, args.files, client)
+        baseline = baseline or rate
+        results.write(f"{name:>33}: {rate:10.0f} requests/s  ({rate / baseline:.2f}x)\n")
+        results.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+A batch that raises rolls back its own mutations, a nested one only its own: what the outer block did before it is
+still committed if the outer block catches the error.
+
+Run it from the repository root:
+    python -m tests.scripts.test_dht_batch
+"""
+from uwuFileShare.shared.models.dht import DHT
+
+
+def entries(dht: DHT) -> dict:
+    return {(filename, host, port): dht.get_details(filename, host, port)
+            for filename, host, port in dht.get_entries()[1]}
+
+
+def test_outer_batch_rolls_back():
+    dht = DHT()
+    dht.add_file("kept", "h", 1, "v1")
+    changes = []
+    dht.bind_on_change(changes.append)
+    try:
+        with dht.batch():
+            dht.add_file("new", "h", 1)
+            dht.add_file("kept", "h", 1, "v2")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert entries(dht) == {("kept", "h", 1): "v1"}
+    assert changes == []
+
+
+def test_nested_batch_rolls_back_only_its_mutations():
+    dht = DHT()
+    dht.add_file("kept", "h", 1, "v1")
+    dht.add_file("gone", "h", 1)
+    changes = []
+    dht.bind_on_change(changes.append)
+
+    with dht.batch():
+        dht.add_file("outer", "h", 1)
+        dht.add_file("kept", "h", 1, "v2")
+        try:
+            with dht.batch():
+                dht.add_file("inner", "h", 1)
+                dht.remove_file("outer", "h", 1)
+                dht.add_file("kept", "h", 1, "v3")
+                dht.remove_file("gone", "h", 1)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+    assert entries(dht) == {("kept", "h", 1): "v2", ("gone", "h", 1): None, ("outer", "h", 1): None}
+    assert len(changes) == 1
+    change = changes[0]
+    assert change.added == [("outer", "h", 1, None)]
+    assert change.updated == [("kept", "h", 1, "v2")]
+    assert change.removed == []
+
+
+if __name__ == "__main__":
+    test_outer_batch_rolls_back()
+    test_nested_batch_rolls_back_only_its_mutations()
+    print("OK")
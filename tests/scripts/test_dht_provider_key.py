@@ -0,0 +1,37 @@
+"""
+A node can give its port as a string (from a message) or as an int, the DHT has to find the same provider either way.
+
+Run it from the repository root:
+    python -m tests.scripts.test_dht_provider_key
+"""
+from uwuFileShare.shared.models.dht import DHT
+
+
+def test_remove_file_with_str_port():
+    dht = DHT()
+    dht.add_file("q", "h", "1")
+    dht.remove_file("q", "h", "1")
+    assert dht.get_providers("q") == []
+    assert dht.get_node_files("h", 1) == []
+
+
+def test_lookups_accept_str_and_int_ports():
+    dht = DHT()
+    dht.add_file("q", "h", "1", "details")
+    dht.add_file("r", "h", 1)
+    for port in ("1", 1):
+        assert dht.get_details("q", "h", port) == "details"
+        assert sorted(dht.get_node_files("h", port)) == ["q", "r"]
+    assert dht.get_providers("q") == [("h", 1)]
+
+    dht.update_node_files([("q", "details")], "h", "1")
+    assert dht.get_node_files("h", 1) == ["q"]
+
+    assert dht.remove_all_files_for_node("h", "1") == 1
+    assert dht.get_providers("q") == []
+
+
+if __name__ == "__main__":
+    test_remove_file_with_str_port()
+    test_lookups_accept_str_and_int_ports()
+    print("OK")
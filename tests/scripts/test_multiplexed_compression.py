@@ -0,0 +1,42 @@
+"""
+Responses on a multiplexed connection are newline delimited, so a GET_DHT request with an id that asks for a zlib
+response still gets a plain one carrying its id, and the requests in flight next to it are answered too.
+
+Run it from the repository root, it uses the port 7592 on localhost:
+    python -m tests.scripts.test_multiplexed_compression
+"""
+import asyncio
+
+from uwuFileShare.informant_node.models.informant_node import InformantNode
+from uwuFileShare.shared.services.uwu_protocol.client import UWUClient
+from uwuFileShare.shared.services.uwu_protocol.enums import RequestAction, ResponseAction
+
+
+async def get_dht_concurrently(client: UWUClient, count: int) -> list:
+    try:
+        return await asyncio.gather(*(client.request(RequestAction.GET_DHT, {"compression": "zlib"}, timeout=5)
+                                      for _ in range(count)))
+    finally:
+        await client.close()
+
+
+def test_compressed_get_dht_on_multiplexed_connection():
+    informant = InformantNode(port=7592)
+    informant.dht.add_file("shared.txt", "127.0.0.1", 7593)
+    informant.run()
+    informant.uwu_service.server_ready.wait()
+    try:
+        client = UWUClient("127.0.0.1", 7592, {"host": "127.0.0.1", "port": 7593})
+        responses = asyncio.run(get_dht_concurrently(client, 4))
+    finally:
+        informant.stop()
+
+    assert len(responses) == 4
+    for response in responses:
+        assert response["action"] == ResponseAction.GET_DHT
+        assert "shared.txt" in response["data"]["dht"]
+
+
+if __name__ == "__main__":
+    test_compressed_get_dht_on_multiplexed_connection()
+    print("OK")
@@ -0,0 +1,50 @@
+"""
+A peer that stops sends PEER_LEFT to its informants, which drop its files right away.
+
+Run it from the repository root, it uses the ports 7590 and 7591 on localhost:
+    python -m tests.scripts.test_peer_left
+"""
+import os
+import tempfile
+import time
+
+from uwuFileShare.informant_node.models.informant_node import InformantNode
+from uwuFileShare.peer_node.models.peer_node import PeerNode
+
+
+def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+def test_informant_drops_a_peer_that_left():
+    informant = InformantNode(port=7590)
+    informant.run()
+    informant.uwu_service.server_ready.wait()
+
+    shared_dir = tempfile.mkdtemp()
+    with open(os.path.join(shared_dir, "left.txt"), "w") as file:
+        file.write("uwu")
+
+    peer = PeerNode(port=7591, informants=[("127.0.0.1", 7590)], shared_dir=shared_dir)
+    peer.run()
+    try:
+        assert wait_for(lambda: informant.dht.get_node_files("127.0.0.1", 7591) == ["left.txt"])
+
+        try:
+            peer.stop()
+        except SystemExit:
+            pass
+        assert wait_for(lambda: informant.dht.get_node_files("127.0.0.1", 7591) == [], timeout=2.0)
+        assert informant.dht.get_providers("left.txt") == []
+    finally:
+        informant.stop()
+
+
+if __name__ == "__main__":
+    test_informant_drops_a_peer_that_left()
+    print("OK")
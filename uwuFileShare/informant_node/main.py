@@ -5,13 +5,15 @@ import argparse
 
 from uwuFileShare.informant_node.models.informant_node import InformantNode
 from uwuFileShare.informant_node.viewmodels import ViewModelFactory
+from uwuFileShare.shared.services.uwu_protocol.enums import ServiceEngine
 
 from uwuFileShare.shared.views.gui_setup import GUI
 
 
 class MainApp:
-    def __init__(self):
-        self.node = InformantNode()
+    def __init__(self, workers=1, engine=ServiceEngine.PROTOCOL, metrics_port=None, max_connections_per_peer=None):
+        self.node = InformantNode(workers=workers, engine=engine, metrics_port=metrics_port,
+                                  max_connections_per_peer=max_connections_per_peer)
         self.gui = None
 
     def start_cli(self):
@@ -111,9 +113,39 @@ def main():
         help="Start the Informant Node in CLI mode.",
     )
 
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes serving the informant port (SO_REUSEPORT), one DHT writer and read replicas.",
+    )
+
+    arg_parser.add_argument(
+        "--engine",
+        choices=[engine.value for engine in ServiceEngine],
+        default=ServiceEngine.PROTOCOL.value,
+        help="Transport engine of the uwu service, streams reads a single request per connection.",
+    )
+
+    arg_parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the metrics of the node in the Prometheus format on http://127.0.0.1:<port>/metrics.",
+    )
+
+    arg_parser.add_argument(
+        "--max-connections-per-peer",
+        type=int,
+        default=None,
+        help="Connections a single address may keep open at the same time, no limit by default. The peers run on one "
+             "machine share its address.",
+    )
+
     args = arg_parser.parse_args()
 
-    app = MainApp()
+    app = MainApp(workers=args.workers, engine=args.engine, metrics_port=args.metrics_port,
+                  max_connections_per_peer=args.max_connections_per_peer)
     app.start(cli=args.cli, gui=args.gui)
 
 
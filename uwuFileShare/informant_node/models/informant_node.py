@@ -2,26 +2,69 @@
 import asyncio
 import threading
 from uwuFileShare.shared.services.uwu_protocol.service import UWUService
+from uwuFileShare.shared.services.uwu_protocol.enums import ServiceEngine
+from uwuFileShare.shared.services.runtime import NodeRuntime
+from uwuFileShare.shared.services.metrics import MetricsRegistry
+from uwuFileShare.shared.services.rate_limit import PeerLimiter
 from uwuFileShare.shared.models.dht import DHT
 
 from uwuFileShare.informant_node.services.uwu_protocol.handler import Handler
+from uwuFileShare.informant_node.services.cluster import InformantCluster
 
 
 class InformantNode:
-    def __init__(self, host="127.0.0.1", port=6000):
+    def __init__(self, host="127.0.0.1", port=6000, workers: int = 1, dht: DHT = None, reuse_port: bool = False,
+                 engine: ServiceEngine = ServiceEngine.PROTOCOL, rate_limits: dict = None,
+                 max_connections_per_peer: int = None, metrics_port: int = None,
+                 metrics: MetricsRegistry = None):
+        """
+        :param workers: Number of processes serving the port. Above 1, this process becomes the DHT writer and
+        workers - 1 worker processes serve next to it from read replicas.
+        :param dht: DHT to serve, a new one if None.
+        :param reuse_port: Bind with SO_REUSEPORT, set on worker processes.
+        :param engine: Transport engine of the uwu service, the PROTOCOL engine lets peers send many requests on one
+        connection.
+        :param rate_limits: Action -> (requests per second, burst) allowed to each peer, overriding
+        rate_limit.DEFAULT_RATE_LIMITS. Each worker process keeps its own buckets.
+        :param max_connections_per_peer: Connections open at the same time from a single address, None for no limit.
+        The peers run on one machine share its address, the limit must leave room for all of them.
+        :param metrics_port: Port of the Prometheus endpoint of the node on localhost, none if None. Only this process
+        serves it, the workers of a cluster answer STATS requests with their own metrics.
+        :param metrics: Registry of the node, shared by its DHT, service and runtime, a new one if None. A DHT given
+        to the node records in its own registry.
+        """
         self.host = host
         self.port = port
-        self.dht = DHT()
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.dht = dht if dht is not None else DHT(metrics=self.metrics)
         self.uwu_service = None
+        self.workers = workers
+        self.reuse_port = reuse_port or workers > 1
+        self.engine = ServiceEngine(engine)
+        self.cluster = None
+        self.rate_limits = rate_limits
+        self.max_connections_per_peer = max_connections_per_peer
+        self.metrics_port = metrics_port
+        # One peer can't send REGISTERs or open connections without limit and take the capacity of the others
+        self.peer_limits = PeerLimiter(rate_limits, max_connections=max_connections_per_peer)
+
+        # Single event loop of the node, the GUI and the CLI reach it through submit()
+        self.runtime = NodeRuntime(name=f"informant_node_{port}", metrics=self.metrics)
 
     @property
     def nodes_connected(self):
         """
         Returns a list of connected nodes, consider a node connected if it has a file in the DHT
-        :return: List of connected nodes
+        :return: List of connected nodes as (host, port, files count)
         """
-        print("[INFORMANT] Getting connected nodes: ", self.dht.get_nodes())
-        return self.dht.get_nodes()
+        return self.dht.get_node_file_counts()
+
+    def submit(self, coro):
+        """
+        Runs a coroutine on the node runtime, from any thread.
+        :return: A concurrent.futures.Future with the result of the coroutine
+        """
+        return self.runtime.submit(coro)
 
     def run(self):
         """
@@ -33,11 +76,21 @@ class InformantNode:
         self.uwu_service = UWUService(
             host=self.host,
             port=self.port,
-            handler=handler
+            handler=handler,
+            runtime=self.runtime,
+            reuse_port=self.reuse_port,
+            engine=self.engine,
+            peer_limits=self.peer_limits,
+            metrics=self.metrics,
+            metrics_port=self.metrics_port,
         )
         print("[INFORMANT] Starting the UWU service...")
         self.uwu_service.start_service()
 
+        if self.workers > 1:
+            self.cluster = InformantCluster(self, self.workers - 1)
+            self.cluster.start()
+
     def stop(self):
         """
         Stops the Informant Node. Shuts down the uwu service
@@ -49,3 +102,5 @@ class InformantNode:
 
         print("[INFORMANT] Stopping the service...")
         self.uwu_service.stop_service()
+        if self.cluster is not None:
+            self.cluster.stop()
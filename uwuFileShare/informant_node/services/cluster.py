@@ -0,0 +1,200 @@
+import multiprocessing
+import queue
+import socket
+import threading
+from typing import List, Optional
+
+from uwuFileShare.shared.models.dht import DHT, DHTChange
+from uwuFileShare.shared.services.metrics import MetricsRegistry
+
+# DHT methods the workers may ask the writer to run
+WRITE_METHODS = {"add_file", "remove_file", "update_node_files", "remove_all_files_for_node"}
+# Changes queued for a worker at most, a worker that falls that far behind is restarted from a snapshot
+MAX_PENDING_CHANGES = 10000
+# Seconds between two checks of the worker processes, a dead one is restarted
+SUPERVISE_INTERVAL = 1.0
+
+
+class ReplicaDHT(DHT):
+    """
+    Read replica of the DHT of the writer process, used by the informant worker processes.
+
+    Reads are served from the local copy. Mutations are not applied locally, they are sent to the writer process,
+    which applies them to the authoritative DHT and streams the resulting DHTChanges back to every replica. A worker
+    therefore sees its own writes shortly after making them, once the change comes back.
+    """
+    def __init__(self, commands: multiprocessing.Queue, metrics: MetricsRegistry = None):
+        super().__init__(metrics=metrics)
+        self._commands = commands
+
+    def add_file(self, filename: str, host: str, port: int, details: str = None):
+        self._commands.put(("add_file", (filename, host, port, details)))
+
+    def remove_file(self, filename, host, port):
+        self._commands.put(("remove_file", (filename, host, port)))
+
+    def update_node_files(self, files: list, host: str, port: int):
+        self._commands.put(("update_node_files", (files, host, port)))
+
+    def remove_all_files_for_node(self, host: str, port: int) -> int:
+        self._commands.put(("remove_all_files_for_node", (host, port)))
+        return len(self.get_node_files(host, port))
+
+
+def run_worker(host: str, port: int, index: int, commands: multiprocessing.Queue, changes: multiprocessing.Queue,
+               engine: str = "protocol", rate_limits: dict = None, max_connections_per_peer: int = None):
+    """
+    Entry point of an informant worker process. Serves the protocol on the shared port from a ReplicaDHT, kept up to
+    date from the changes queue: first a ("snapshot", version, data) message, then DHTChanges in order, and None to
+    stop.
+    """
+    # Imported here, the node module imports this one
+    from uwuFileShare.informant_node.models.informant_node import InformantNode
+
+    metrics = MetricsRegistry()
+    dht = ReplicaDHT(commands, metrics=metrics)
+    _, version, data = changes.get()
+    dht.load_snapshot(version, data)
+
+    node = InformantNode(host=host, port=port, dht=dht, reuse_port=True, engine=engine, rate_limits=rate_limits,
+                         max_connections_per_peer=max_connections_per_peer, metrics=metrics)
+    node.run()
+    print(f"[CLUSTER] Worker {index} serving {host}:{port} from DHT version {version}.")
+
+    while (change := changes.get()) is not None:
+        dht.apply_change(change)
+
+    node.stop()
+
+
+class InformantCluster:
+    """
+    Runs extra informant worker processes next to the node, all listening on the node's port with SO_REUSEPORT, so
+    request handling scales with the cores instead of being bound to one GIL.
+
+    The node process is the single writer: it owns the authoritative DHT, applies the mutations the workers forward
+    to it (one thread, in arrival order) and streams every DHTChange to the workers' read replicas.
+
+    The queue of changes of a worker is bounded. A worker that died, or fell MAX_PENDING_CHANGES changes behind, stops
+    getting changes, and a supervisor thread restarts it from a fresh snapshot.
+    """
+    def __init__(self, node: "InformantNode", workers: int):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError("[CLUSTER] Worker processes need SO_REUSEPORT, not available on this platform.")
+
+        self.node = node
+        self.workers = workers
+        # Spawned, not forked, the node process already runs threads (runtime, GUI)
+        self._context = multiprocessing.get_context("spawn")
+        self._commands = self._context.Queue()
+        # By worker, the queue of changes is None once the worker stopped getting them. Both are only replaced under
+        # the DHT lock
+        self._replicas: List[Optional[multiprocessing.Queue]] = []
+        self._processes: List[multiprocessing.Process] = []
+        self._stopping = threading.Event()
+        self._supervising = threading.Lock()  # Held while a worker is restarted, stop() waits for it
+
+        self.node.dht.bind_on_change(self.__publish)
+
+    def start(self):
+        self._stopping.clear()
+        for index in range(self.workers):
+            self._replicas.append(None)
+            self._processes.append(None)
+            self.__spawn(index)
+
+        threading.Thread(target=self.__apply_commands, name="informant_writer", daemon=True).start()
+        threading.Thread(target=self.__supervise, name="informant_supervisor", daemon=True).start()
+        print(f"[CLUSTER] Started {self.workers} worker processes on port {self.node.port}.")
+
+    def stop(self):
+        self._stopping.set()
+        with self._supervising, self.node.dht.batch():
+            for changes in self._replicas:
+                if changes is not None:
+                    try:
+                        changes.put_nowait(None)
+                    except queue.Full:
+                        pass  # Terminated below
+            self._commands.put(None)
+            for process in self._processes:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+            self._replicas.clear()
+            self._processes.clear()
+
+    def __spawn(self, index: int):
+        """
+        Starts the worker of an index, its replica loaded from a snapshot.
+        """
+        changes = self._context.Queue(MAX_PENDING_CHANGES)
+
+        # Inside a (empty) transaction no change can be committed, so the snapshot and the stream line up
+        with self.node.dht.batch():
+            version, data = self.node.dht.get_snapshot()
+            changes.put(("snapshot", version, data))
+            self._replicas[index] = changes
+
+        process = self._context.Process(
+            target=run_worker,
+            args=(self.node.host, self.node.port, index + 1, self._commands, changes, self.node.engine.value,
+                  self.node.rate_limits, self.node.max_connections_per_peer),
+            name=f"informant_worker_{index + 1}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[index] = process
+
+    def __drop(self, index: int, reason: str):
+        """
+        Stops sending changes to a worker, the supervisor restarts it. Called under the DHT lock.
+        """
+        changes, self._replicas[index] = self._replicas[index], None
+        changes.cancel_join_thread()
+        changes.close()
+        print(f"[CLUSTER] Worker {index + 1} {reason}, it will be restarted from a snapshot.")
+
+    def __publish(self, change: DHTChange):
+        # Called under the DHT lock, so the changes reach every replica in version order
+        for index, changes in enumerate(self._replicas):
+            if changes is None:
+                continue
+            if not self._processes[index].is_alive():
+                self.__drop(index, "died")
+                continue
+            try:
+                changes.put_nowait(change)
+            except queue.Full:
+                self.__drop(index, f"is {MAX_PENDING_CHANGES} changes behind")
+
+    def __supervise(self):
+        """
+        Restarts the workers that died or were dropped.
+        """
+        while not self._stopping.wait(SUPERVISE_INTERVAL):
+            with self._supervising:
+                for index, process in enumerate(self._processes):
+                    if self._stopping.is_set():
+                        return
+                    if self._replicas[index] is not None and process.is_alive():
+                        continue
+                    if process.is_alive():
+                        process.terminate()
+                    process.join(timeout=5)
+                    with self.node.dht.batch():
+                        if self._replicas[index] is not None:
+                            self.__drop(index, f"exited with code {process.exitcode}")
+                    print(f"[CLUSTER] Restarting worker {index + 1}.")
+                    self.__spawn(index)
+
+    def __apply_commands(self):
+        while (command := self._commands.get()) is not None:
+            method, args = command
+            if method not in WRITE_METHODS:
+                print(f"[CLUSTER] Ignoring unknown command {method} from a worker.")
+                continue
+            try:
+                getattr(self.node.dht, method)(*args)
+            except Exception as e:
+                print(f"[CLUSTER] Failed to apply {method} from a worker: {e}")
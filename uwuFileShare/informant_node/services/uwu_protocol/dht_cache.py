@@ -0,0 +1,65 @@
+import asyncio
+from typing import Dict, Tuple
+
+from uwuFileShare.shared.models.dht import DHT
+from uwuFileShare.shared.services.uwu_protocol.protocol import UWUProtocol
+from uwuFileShare.shared.services.uwu_protocol.enums import (
+    ResponseAction, MessageType, Codec, Compression
+)
+
+
+class DHTResponseCache:
+    """
+    Keeps the encoded GET_DHT response for the current DHT version, one entry per (codec, compression) pair. Since
+    peers poll the DHT far more often than it changes, most requests are served with the cached bytes and only the
+    first request after a change pays for the serialization.
+
+    Concurrent requests for the same version and settings share a single in-flight encode.
+    """
+    def __init__(self, dht: DHT, peer_info: dict):
+        self._dht = dht
+        self._peer_info = peer_info
+        self._encoded: Dict[Tuple[Codec, Compression], Tuple[int, bytes]] = {}
+        self._in_flight: Dict[Tuple[Codec, Compression, int], asyncio.Task] = {}
+
+    async def get(self, codec: Codec = Codec.JSON, compression: Compression = Compression.NONE) -> bytes:
+        """
+        Returns the encoded GET_DHT response for the current DHT version.
+        :param codec: Serialization format of the response.
+        :param compression: Compression applied to the response.
+        :return: The encoded response, ready to be written to the socket.
+        """
+        version = self._dht.version
+        cached = self._encoded.get((codec, compression))
+        if cached and cached[0] == version:
+            return cached[1]
+
+        key = (codec, compression, version)
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._encode(codec, compression))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+
+        # Shield so a client that disconnects does not cancel the encode other requests are waiting on
+        return await asyncio.shield(task)
+
+    async def _encode(self, codec: Codec, compression: Compression) -> bytes:
+        version, files = self._dht.get_snapshot()
+
+        message = {
+            "type": MessageType.RESPONSE.value,
+            "action": ResponseAction.GET_DHT.value,
+            "peer_info": self._peer_info,
+            "data": {"dht": files, "version": version},
+        }
+
+        # The snapshot is a private copy, so serializing it off the loop is safe
+        encoded = await asyncio.to_thread(UWUProtocol.encode, message, codec, compression)
+
+        # Only store it if no newer version has been cached meanwhile
+        cached = self._encoded.get((codec, compression))
+        if cached is None or cached[0] <= version:
+            self._encoded[(codec, compression)] = (version, encoded)
+
+        return encoded
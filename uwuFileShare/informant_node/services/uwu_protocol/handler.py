@@ -1,18 +1,30 @@
-from uwuFileShare.shared.services.uwu_protocol.base_handler import UWUHandlerBase
+import logging
+
+from uwuFileShare.shared.services.uwu_protocol.base_handler import UWUHandlerBase, read_only
+from uwuFileShare.shared.services.uwu_protocol.log import get_logger
 from uwuFileShare.shared.services.uwu_protocol.protocol import UWUProtocol
 from uwuFileShare.shared.services.uwu_protocol.enums import (
-    RequestAction, ResponseAction, MessageType
+    RequestAction, ResponseAction, MessageType, EventAction, Compression, Lane
 )
 
+from .dht_cache import DHTResponseCache
+from .poll_advisor import PollAdvisor
+
+log = get_logger("handler")
+
 
 class Handler(UWUHandlerBase):
     def __init__(self, node: "InformantNode"):
         self.node = node
+        self.dht_cache = DHTResponseCache(node.dht, {"host": node.host, "port": node.port})
+        self.poll_advisor = PollAdvisor(node.dht)
 
     def bind(self):
         return {
-            (MessageType.REQUEST, ResponseAction.REGISTER): self.on_register_request,
-            (MessageType.REQUEST, ResponseAction.GET_DHT): self.on_get_dht_request,
+            (MessageType.REQUEST, ResponseAction.REGISTER): (self.on_register_request, Lane.CONTROL),
+            (MessageType.REQUEST, ResponseAction.GET_DHT): (self.on_get_dht_request, Lane.BULK),
+            (MessageType.REQUEST, RequestAction.GET_PROVIDERS): (self.on_get_providers_request, Lane.LOOKUP),
+            (MessageType.EVENT, EventAction.PEER_LEFT): (self.on_peer_left_event, Lane.CONTROL),
         }
 
     async def on_register_request(self, message: dict, reader, writer):
@@ -20,21 +32,25 @@ class Handler(UWUHandlerBase):
         This method handles a CLIENT REQUEST for register, and sends a response back to the client. Register is an action
         that is used to register a new peer in the informant node, the peer sends all the files available by itself and the
         informant node stores that information in its DHT.
+
+        Peers register on every poll, so the response also tells them when to poll next, see PollAdvisor.
         :param message:
         :param reader:
         :param writer:
         :return:
         """
-        print("[UWU_HANDLER] Register response request received.")
+        log.debug("[UWU_HANDLER] Register response request received.")
+        self.poll_advisor.record_poll()
+        poll = self.poll_advisor.advice()
         data = message.get("data")
 
         if not data:
-            print("[UWU_HANDLER] Invalid register request.")
+            log.limited(logging.WARNING, "invalid_register", "[UWU_HANDLER] Invalid register request.")
             response = UWUProtocol.create_message(
                 MessageType.RESPONSE,
                 ResponseAction.REGISTER,
                 {"host": self.node.host, "port": self.node.port},
-                {"message": "Invalid register request."}
+                {"message": "Invalid register request.", "poll": poll}
             )
             writer.write(response)
             await writer.drain()
@@ -45,52 +61,83 @@ class Handler(UWUHandlerBase):
 
         files = data.get("files", [])
 
-        if not files:
-            print("[UWU_HANDLER] Invalid register request.")
-            response = UWUProtocol.create_message(
-                MessageType.RESPONSE,
-                ResponseAction.REGISTER,
-                {"host": self.node.host, "port": self.node.port},
-                {"message": "The peer node does not have any file to share."}
-            )
-            writer.write(response)
-            await writer.drain()
-            return
-
-        # Register the peer and its files in the DHT
-        print("[UWU_HANDLER] Calling update node files")
+        # Register the peer and its files in the DHT. A peer that shares nothing anymore is removed from every file
         self.node.dht.update_node_files(files, host, port)
 
         response = UWUProtocol.create_message(
             MessageType.RESPONSE,
             ResponseAction.REGISTER,
             {"host": self.node.host, "port": self.node.port},
-            {"message": "Peer registered successfully."}
+            {"message": "Peer registered successfully.", "poll": poll}
         )
 
-        print("[UWU_HANDLER] New dht:", self.node.dht.get_all_files())
+        log.sampled(logging.INFO, "registered", "[UWU_HANDLER] Registered %d files of %s:%s, DHT version %d",
+                    len(files), host, port, self.node.dht.version)
 
         writer.write(response)
         await writer.drain()
 
+    @read_only
     async def on_get_dht_request(self, message: dict, reader, writer):
         """
-        THis method handles a CLIENT REQUEST and sends a response back to the client.
+        THis method handles a CLIENT REQUEST and sends a response back to the client. The encoded response is cached
+        per DHT version, so an unchanged DHT is not serialized again. The client may ask for a compressed response with
+        {"compression": "zlib"} in the request data, unless the request has an id: responses on a multiplexed
+        connection are newline delimited, which a zlib stream can't be.
         :param message:
         :param reader:
         :param writer:
         :return:
         """
+        try:
+            compression = Compression((message.get("data") or {}).get("compression", Compression.NONE))
+        except ValueError:
+            compression = Compression.NONE
+        if message.get("id") is not None:
+            compression = Compression.NONE
 
-        dht = self.node.dht.get_all_files()
+        response = await self.dht_cache.get(compression=compression)
+
+        writer.write(response)
+        await writer.drain()
+
+    @read_only
+    async def on_get_providers_request(self, message: dict, reader, writer):
+        """
+        This method handles a CLIENT REQUEST for the providers of a single file, a lookup much cheaper than fetching
+        the whole DHT. Peers usually send many of them at once on the same connection.
+        :param message:
+        :param reader:
+        :param writer:
+        :return:
+        """
+        filename = (message.get("data") or {}).get("filename")
+        providers = self.node.dht.get_providers(filename) if filename else []
 
         response = UWUProtocol.create_message(
             MessageType.RESPONSE,
-            ResponseAction.GET_DHT,
+            ResponseAction.GET_PROVIDERS,
             {"host": self.node.host, "port": self.node.port},
-            {"dht": dht}
+            {"filename": filename, "providers": providers}
         )
 
         writer.write(response)
         await writer.drain()
 
+    async def on_peer_left_event(self, message: dict, reader, writer):
+        """
+        This method handles a PEER LEFT event, sent by a peer that is shutting down. All the files of the peer are
+        removed from the DHT. Events are not answered.
+        :param message:
+        :param reader:
+        :param writer:
+        :return:
+        """
+        host, port = message.get("peer_info", {}).get("host"), message.get("peer_info", {}).get("port")
+
+        if host is None or port is None:
+            log.limited(logging.WARNING, "invalid_peer_left", "[UWU_HANDLER] Invalid peer left event.")
+            return
+
+        removed = self.node.dht.remove_all_files_for_node(host, port)
+        log.info("[UWU_HANDLER] Peer %s:%s left, removed %d files.", host, port, removed)
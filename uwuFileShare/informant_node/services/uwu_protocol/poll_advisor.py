@@ -0,0 +1,71 @@
+import time
+from collections import deque
+
+from uwuFileShare.shared.models.dht import DHT
+
+
+class PollAdvisor:
+    """
+    Suggests to the peers when to poll the informant next, so the polls spread evenly instead of arriving in waves.
+
+    The interval grows with the poll rate the informant sees, above target_rate polls per second it is stretched so the
+    rate comes back to the target, and shrinks, down to half, while the DHT changes quickly so peers see the changes
+    sooner. Peers wait the interval plus a random part of the jitter window. The window is half the interval, and a
+    whole one during the first warmup seconds after the informant started, when every peer reconnects at once.
+    """
+    def __init__(self, dht: DHT, base_interval: float = 5.0, min_interval: float = 2.0, max_interval: float = 60.0,
+                 target_rate: float = 100.0, target_churn: float = 1.0, window: float = 10.0, warmup: float = 30.0):
+        """
+        :param base_interval: Interval suggested to an idle informant, in seconds.
+        :param target_rate: Polls per second the informant is comfortable with.
+        :param target_churn: DHT changes per second at which the interval is shortened by half.
+        :param window: Seconds over which the poll rate and the churn are measured.
+        """
+        self.dht = dht
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_rate = target_rate
+        self.target_churn = target_churn
+        self.window = window
+        self.warmup = warmup
+        self.started = time.monotonic()
+        self._polls = deque()
+        self._versions = deque([(self.started, dht.version)])
+
+    def record_poll(self):
+        self._polls.append(time.monotonic())
+
+    def poll_rate(self) -> float:
+        """
+        Polls per second over the last window.
+        """
+        self.__trim(time.monotonic())
+        return len(self._polls) / self.window
+
+    def churn_rate(self) -> float:
+        """
+        DHT changes per second over the last window.
+        """
+        now = time.monotonic()
+        self.__trim(now)
+        self._versions.append((now, self.dht.version))
+        since, version = self._versions[0]
+        return (self.dht.version - version) / max(now - since, 1.0)
+
+    def advice(self) -> dict:
+        """
+        :return: {"interval": seconds, "jitter": seconds}, sent to the peers in the REGISTER responses.
+        """
+        load = max(1.0, self.poll_rate() / self.target_rate)
+        churn = 1.0 + min(1.0, self.churn_rate() / self.target_churn)
+        interval = min(self.max_interval, max(self.min_interval, self.base_interval * load / churn))
+        warming_up = time.monotonic() - self.started < self.warmup
+        return {"interval": round(interval, 3), "jitter": round(interval if warming_up else interval / 2, 3)}
+
+    def __trim(self, now: float):
+        while self._polls and self._polls[0] < now - self.window:
+            self._polls.popleft()
+        # The oldest version sample inside the window is kept as the reference
+        while len(self._versions) > 1 and self._versions[1][0] < now - self.window:
+            self._versions.popleft()
@@ -1,47 +1,98 @@
-from PySide6.QtCore import QAbstractListModel, Qt, QModelIndex, QByteArray, QMetaObject, Slot
-from uwuFileShare.shared.models.dht import DHT
+import threading
+from collections import deque
+
+from PySide6.QtCore import (
+    QAbstractListModel, Qt, QModelIndex, QByteArray, QMetaObject, QTimer, Signal, Slot
+)
+from uwuFileShare.shared.models.dht import DHT, DHTChange
+
+# Rows handed to the view on every fetchMore
+FETCH_BATCH_SIZE = 256
+# Changes are applied at most once per frame
+FLUSH_INTERVAL_MS = 16
+# Above this many rows to locate, a single O(rows) pass over the rows beats one lookup per row
+LINEAR_LOOKUP_LIMIT = 32
 
 
 class DHTViewModel(QAbstractListModel):
+    """
+    List model of the DHT entries, one row per (file, provider).
+
+    Rows are only (filename, host, port) tuples, everything else is read on demand. The row list itself is a copy,
+    taken from DHT.get_entries() on every query, so a query costs O(entries) time and memory; only the strings are
+    shared with the DHT. The view gets the rows in batches through canFetchMore/fetchMore, so delegates are only
+    created for what is scrolled into view.
+
+    DHT changes arrive as DHTChanges and are applied with precise row inserts, removals and dataChanged, coalesced to
+    at most one update per frame. Filtering and sorting are computed on a worker thread and swapped in with a reset.
+    """
     FileNameRole = Qt.UserRole + 1
     HostRole = Qt.UserRole + 2
     PortRole = Qt.UserRole + 3
     DetailsRole = Qt.UserRole + 4
 
+    # Position of each sortable role inside a row tuple
+    SORT_COLUMNS = {"fileName": 0, "host": 1, "port": 2}
+
+    _query_finished = Signal(int, int, object)
+
     def __init__(self, dht: DHT):
         super().__init__()
         self._dht: DHT = dht
-        self._entries = self._build_entries()
-        self._dht.bind_on_change(self.on_dht_changed)
+        self._rows = []
+        self._fetched = 0
+        self._version = -1
+
+        self._filter_text = ""
+        self._sort_column = None
+        self._ascending = True
+
+        # Background queries (initial load, filter, sort), only the latest generation is applied
+        self._query_generation = 0
+        self._query_in_flight = False
+        self._query_finished.connect(self._on_query_finished)
 
-    def _build_entries(self):
-        print("[DHT_VM] Building entries: ", self._dht.get_all_files())
-        entries = []
-        for filename, data in self._dht.get_all_files().items():
-            for (host, port), details in data.get("providers", {}).items():
-                entries.append({
-                    "fileName": filename,
-                    "host": host,
-                    "port": port,
-                    "details": details,
-                })
-        return entries
+        # Changes coming from the DHT thread, applied on the next frame
+        self._pending_changes = deque()
+        self._flush_requested = False
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(FLUSH_INTERVAL_MS)
+        self._flush_timer.timeout.connect(self._flush)
+
+        self._dht.bind_on_change(self.on_dht_changed)
+        self._start_query()
 
     def rowCount(self, parent=QModelIndex()):
-        return len(self._entries)
+        if parent.isValid():
+            return 0
+        return self._fetched
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._fetched < len(self._rows)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(FETCH_BATCH_SIZE, len(self._rows) - self._fetched)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._fetched, self._fetched + count - 1)
+        self._fetched += count
+        self.endInsertRows()
 
     def data(self, index, role=Qt.DisplayRole):
-        if not index.isValid():
+        if not index.isValid() or index.row() >= self._fetched:
             return None
-        entry = self._entries[index.row()]
+        filename, host, port = self._rows[index.row()]
         if role == self.FileNameRole:
-            return entry["fileName"]
+            return filename
         if role == self.HostRole:
-            return entry["host"]
+            return host
         if role == self.PortRole:
-            return entry["port"]
+            return port
         if role == self.DetailsRole:
-            return entry["details"]
+            return self._dht.get_details(filename, host, port)
         return None
 
     def roleNames(self):
@@ -52,13 +103,209 @@ class DHTViewModel(QAbstractListModel):
             self.DetailsRole: QByteArray(b"details"),
         }
 
-    def on_dht_changed(self):
-        print("[DHT_VM] DHT change received, scheduling GUI update from asyncio...")
-        QMetaObject.invokeMethod(self, "_refresh_model", Qt.QueuedConnection)
+    @Slot(str)
+    def setFilterText(self, text: str):
+        """
+        Only shows the rows whose file name contains the text (case insensitive).
+        """
+        if text == self._filter_text:
+            return
+        self._filter_text = text
+        self._start_query()
+
+    @Slot(str)
+    def sortByRole(self, role_name: str):
+        """
+        Sorts the rows by fileName, host or port. Sorting again by the same role flips the order.
+        """
+        column = self.SORT_COLUMNS.get(role_name)
+        if column is None:
+            return
+        self._ascending = not self._ascending if column == self._sort_column else True
+        self._sort_column = column
+        self._start_query()
+
+    def on_dht_changed(self, change: DHTChange = None):
+        """
+        Called from the DHT thread, so it only queues the change and asks the Qt thread for a flush.
+        """
+        if change is None:
+            return
+        self._pending_changes.append(change)
+        if not self._flush_requested:
+            self._flush_requested = True
+            QMetaObject.invokeMethod(self, "_schedule_flush", Qt.QueuedConnection)
 
     @Slot()
-    def _refresh_model(self):
-        print("[DHT_VM] Refreshing model in Qt thread...")
+    def _schedule_flush(self):
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    @Slot()
+    def _flush(self):
+        self._flush_requested = False
+
+        # A query result will replace the rows, the pending changes are applied on top of it
+        if self._query_in_flight:
+            return
+
+        # Rows appended by consecutive changes are inserted together
+        appended = []
+
+        while self._pending_changes:
+            change = self._pending_changes.popleft()
+            if change.version <= self._version:
+                continue
+
+            if appended and (change.removed or change.updated):
+                self._insert_rows(len(self._rows), appended)
+                appended = []
+
+            self._apply_change(change, appended)
+            self._version = change.version
+
+        if appended:
+            self._insert_rows(len(self._rows), appended)
+
+    def _apply_change(self, change: DHTChange, appended: list):
+        """
+        Applies the removals and updates of a change, and inserts its added rows. Without sorting, added rows go to the
+        end of the model, so they are collected in appended instead.
+        """
+        if change.removed:
+            self._remove_rows(change.removed)
+
+        if change.updated:
+            for row in self._find_rows([entry[:3] for entry in change.updated]):
+                if row < self._fetched:
+                    index = self.index(row)
+                    self.dataChanged.emit(index, index, [self.DetailsRole])
+
+        added = [entry[:3] for entry in change.added if self._accepts(entry[0])]
+
+        if self._sort_column is None:
+            appended.extend(added)
+        else:
+            for row in added:
+                self._insert_rows(self._insert_position(row), [row])
+
+    def _accepts(self, filename: str) -> bool:
+        return not self._filter_text or self._filter_text.lower() in filename.lower()
+
+    def _find_rows(self, rows: list) -> list:
+        """
+        Returns the positions of the given rows, skipping the ones not in the model.
+        """
+        if len(rows) > LINEAR_LOOKUP_LIMIT:
+            wanted = set(rows)
+            return [position for position, row in enumerate(self._rows) if row in wanted]
+
+        positions = []
+        for row in rows:
+            position = self._find_row(row)
+            if position is not None:
+                positions.append(position)
+        return positions
+
+    def _find_row(self, row: tuple):
+        if self._sort_column is None:
+            try:
+                return self._rows.index(row)
+            except ValueError:
+                return None
+
+        # Sorted rows: binary search the first row with the same sort key, then look among the equal ones
+        position = self._insert_position(row, before_equal=True)
+        key = row[self._sort_column]
+        while position < len(self._rows) and self._rows[position][self._sort_column] == key:
+            if self._rows[position] == row:
+                return position
+            position += 1
+        return None
+
+    def _insert_position(self, row: tuple, before_equal: bool = False) -> int:
+        key = row[self._sort_column]
+        low, high = 0, len(self._rows)
+        while low < high:
+            middle = (low + high) // 2
+            middle_key = self._rows[middle][self._sort_column]
+            if before_equal:
+                goes_after = middle_key < key if self._ascending else middle_key > key
+            else:
+                goes_after = middle_key <= key if self._ascending else middle_key >= key
+            if goes_after:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _insert_rows(self, position: int, rows: list):
+        # Rows past the fetched window are not visible yet, the view gets them through fetchMore
+        if position > self._fetched or (position == self._fetched and self._fetched < len(self._rows)):
+            self._rows[position:position] = rows
+            return
+
+        self.beginInsertRows(QModelIndex(), position, position + len(rows) - 1)
+        self._rows[position:position] = rows
+        self._fetched += len(rows)
+        self.endInsertRows()
+
+    def _remove_rows(self, rows: list):
+        positions = sorted(self._find_rows(rows), reverse=True)
+
+        # Remove contiguous runs from the bottom up, so the positions left to remove stay valid
+        index = 0
+        while index < len(positions):
+            last = first = positions[index]
+            index += 1
+            while index < len(positions) and positions[index] == first - 1:
+                first = positions[index]
+                index += 1
+
+            if first >= self._fetched:
+                del self._rows[first:last + 1]
+                continue
+
+            visible_last = min(last, self._fetched - 1)
+            self.beginRemoveRows(QModelIndex(), first, visible_last)
+            del self._rows[first:last + 1]
+            self._fetched -= visible_last - first + 1
+            self.endRemoveRows()
+
+    def _start_query(self):
+        """
+        Rebuilds the rows with the current filter and sort on a worker thread.
+        """
+        self._query_generation += 1
+        self._query_in_flight = True
+        threading.Thread(
+            target=self._run_query,
+            args=(self._query_generation, self._filter_text, self._sort_column, self._ascending),
+            daemon=True,
+        ).start()
+
+    def _run_query(self, generation: int, filter_text: str, sort_column, ascending: bool):
+        version, rows = self._dht.get_entries()
+
+        if filter_text:
+            needle = filter_text.lower()
+            rows = [row for row in rows if needle in row[0].lower()]
+        if sort_column is not None:
+            rows.sort(key=lambda row: row[sort_column], reverse=not ascending)
+
+        self._query_finished.emit(generation, version, rows)
+
+    @Slot(int, int, object)
+    def _on_query_finished(self, generation: int, version: int, rows: list):
+        if generation != self._query_generation:
+            return
+
         self.beginResetModel()
-        self._entries = self._build_entries()
+        self._rows = rows
+        self._fetched = min(FETCH_BATCH_SIZE, len(rows))
+        self._version = version
+        self._query_in_flight = False
         self.endResetModel()
+
+        # Changes that arrived while querying, the ones already in the result are skipped by version
+        self._flush()
@@ -31,10 +31,10 @@ class ConnectedNodesModel(QAbstractListModel):
 
     def data(self, index, role=Qt.DisplayRole):
         if not index.isValid(): return None
-        entry = self._entries[index.row()]
-        if role == self.HostRole:       return entry["host"]
-        if role == self.PortRole:       return entry["port"]
-        if role == self.FilesCountRole: return entry["files"]
+        host, port, files_count = self._entries[index.row()]
+        if role == self.HostRole:       return host
+        if role == self.PortRole:       return port
+        if role == self.FilesCountRole: return files_count
         return None
 
     def roleNames(self):
@@ -48,10 +48,8 @@ class ConnectedNodesModel(QAbstractListModel):
         """
         Call this whenever `node.nodes_connected` changes.
         """
-        new_data = [
-            {"host": host, "port": port, "files": len(files)}
-            for host, port, files in self._node.nodes_connected
-        ]
+        # (host, port, files count) tuples straight from the DHT node index
+        new_data = self._node.nodes_connected
         self.beginResetModel()
         self._entries = new_data
         self.endResetModel()
\ No newline at end of file
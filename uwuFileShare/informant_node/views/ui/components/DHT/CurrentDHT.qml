@@ -33,6 +33,15 @@ Rectangle {
                 Layout.alignment: Qt.AlignHCenter
                 spacing: 8
 
+                // Filtering runs on a worker thread in the view model
+                TextField {
+                    id: filterField
+                    Layout.fillWidth: true
+                    placeholderText: "Filter by file name"
+                    onTextChanged: DHTViewModel.setFilterText(text)
+                }
+
+                // Click a header to sort by it, click again to flip the order
                 RowLayout {
                     Layout.fillWidth: true
                     spacing: 10
@@ -42,17 +51,32 @@ Rectangle {
                         font.bold: true
                         Layout.preferredWidth: column_width
                         color: ThemeManager.getColor("text")
+
+                        MouseArea {
+                            anchors.fill: parent
+                            onClicked: DHTViewModel.sortByRole("fileName")
+                        }
                     }
                     Label {
                         text: "Host"
                         font.bold: true
                         Layout.preferredWidth: column_width
                         color: ThemeManager.getColor("text")
+
+                        MouseArea {
+                            anchors.fill: parent
+                            onClicked: DHTViewModel.sortByRole("host")
+                        }
                     }
                     Label { text: "Port"
                         font.bold: true
                         Layout.preferredWidth: column_width
                         color: ThemeManager.getColor("text")
+
+                        MouseArea {
+                            anchors.fill: parent
+                            onClicked: DHTViewModel.sortByRole("port")
+                        }
                     }
                 }
 
@@ -70,6 +94,8 @@ Rectangle {
                     model: DHTViewModel
                     clip: true
                     spacing: 4
+                    // Delegates are recycled instead of recreated while the DHT churns
+                    reuseItems: true
 
                     delegate: RowLayout {
                         Layout.fillWidth: true
@@ -1,4 +1,5 @@
 import asyncio
+import concurrent.futures
 import json
 import os
 import threading
@@ -7,18 +8,34 @@ from enum import Enum
 from typing import List, Tuple
 
 from uwuFileShare.shared.models.dht import DHT
+from uwuFileShare.shared.services.metrics import MetricsRegistry
 from uwuFileShare.shared.services.uwu_protocol.service import UWUService
+from uwuFileShare.shared.services.runtime import NodeRuntime
 
-from uwuFileShare.peer_node.services.uwu_protocol.handler import Handler
+from uwuFileShare.peer_node.services.uwu_protocol.handler import Handler, INFORMANT_TIMEOUT
+
+# Seconds stop() waits for each shutdown step, telling the informants and closing the connections to them
+CLOSE_TIMEOUT = 2.0
 
 class PeerNode:
-    def __init__(self, host="127.0.0.1", port=5000, informants: List[Tuple[str, int]] = None, shared_dir="shared_files"):
+    def __init__(self, host="127.0.0.1", port=5000, informants: List[Tuple[str, int]] = None, shared_dir="shared_files",
+                 metrics_port: int = None):
+        """
+        :param metrics_port: Port of the Prometheus endpoint of the node on localhost, none if None.
+        """
         self.host = host
         self.port = port
-        self.dht = DHT()
+        # Metrics of the node, shared by its DHT, service and runtime
+        self.metrics = MetricsRegistry()
+        self.dht = DHT(metrics=self.metrics)
         self.uwu_service = None
+        self.handler = None
+
+        # Single event loop of the node, the GUI and the CLI reach it through submit()
+        self.runtime = NodeRuntime(name=f"peer_node_{port}", metrics=self.metrics)
         self.informants = informants if informants else []
         self.shared_dir = shared_dir
+        self.metrics_port = metrics_port
 
     def get_informants(self) -> List[Tuple[str, int]]:
         """
@@ -37,24 +54,60 @@ class PeerNode:
 
         return [f for f in os.listdir(self.shared_dir) if os.path.isfile(os.path.join(self.shared_dir, f))]
 
+    def submit(self, coro):
+        """
+        Runs a coroutine on the node runtime, from any thread.
+        :return: A concurrent.futures.Future with the result of the coroutine
+        """
+        return self.runtime.submit(coro)
+
+    def lookup(self, filenames: List[str], hedge: bool = True):
+        """
+        Asks the informants for the providers of files, from any thread.
+        :return: A concurrent.futures.Future with {filename: [(host, port)]}
+        """
+        return self.submit(self.handler.lookup(filenames, hedge))
+
+    def fetch_dht(self):
+        """
+        Fetches the DHT from the fastest informant, from any thread.
+        :return: A concurrent.futures.Future, done once the DHT is loaded
+        """
+        return self.submit(self.handler.fetch_dht())
+
     def run(self):
         """
         Starts the Peer Node. Initializes the uwu service
         :return:
         """
-        handler = Handler(self)
+        self.handler = Handler(self)
         self.uwu_service = UWUService(
             host=self.host,
             port=self.port,
-            handler=handler,
-            periodical_tasks_cbk=(handler.periodical_tasks, 5)
+            handler=self.handler,
+            runtime=self.runtime,
+            metrics=self.metrics,
+            metrics_port=self.metrics_port,
         )
+        # Follows the interval advised by the informants, a sync that hangs is given up before the next one
+        self.uwu_service.schedule("sync", self.handler.periodical_tasks, 5, timeout=2 * INFORMANT_TIMEOUT)
 
         self.uwu_service.start_service()
 
+    def __wait(self, coro, what: str):
+        """
+        Runs a shutdown step on the runtime, waiting for it at most CLOSE_TIMEOUT seconds.
+        """
+        try:
+            self.submit(coro).result(timeout=CLOSE_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            print(f"[PEER] Could not {what} within {CLOSE_TIMEOUT}s, going on.")
+        except Exception as e:
+            print(f"[PEER] Could not {what}: {e}")
+
     def stop(self):
         """
-        Stops the Peer Node. Shuts down the uwu service
+        Stops the Peer Node. Shuts down the uwu service and tells the informants the node is leaving
         :return:
         """
         if not self.uwu_service.is_running():
@@ -63,5 +116,8 @@ class PeerNode:
 
         print("[PEER] Stopping the service...")
         self.uwu_service.stop_service()
+        # The informants drop the files of the node first, on the connections about to be closed
+        self.__wait(self.handler.leave(), "tell the informants the node is leaving")
+        self.__wait(self.handler.close_clients(), "close the informant connections")
 
         sys.exit(0)
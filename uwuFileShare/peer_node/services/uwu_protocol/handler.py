@@ -1,17 +1,56 @@
 import asyncio
-from typing import List, Tuple
+import logging
+import math
+import random
+import time
+from typing import Dict, List, Tuple
 
+from uwuFileShare.shared.services.circuit_breaker import CircuitBreaker, BreakerState
+from uwuFileShare.shared.services.latency import LatencyTracker
 from uwuFileShare.shared.services.uwu_protocol.base_handler import UWUHandlerBase
+from uwuFileShare.shared.services.uwu_protocol.client import UWUClient
+from uwuFileShare.shared.services.uwu_protocol.lanes import Overloaded
+from uwuFileShare.shared.services.uwu_protocol.log import get_logger
 from uwuFileShare.shared.services.uwu_protocol.protocol import UWUProtocol
 from uwuFileShare.shared.services.uwu_protocol.enums import (
     RequestAction, ResponseAction, MessageType, EventAction
 )
 
+log = get_logger("peer")
+
+# Seconds an informant has to answer a periodic sync or a lookup
+INFORMANT_TIMEOUT = 3.0
+# Share of the informants asked that must have answered before a sync cycle ends
+SYNC_QUORUM = 0.5
+# Informants asked at the same time by a hedged read
+HEDGE_FANOUT = 2
+
+
+def _drain(task: asyncio.Task):
+    """
+    Retrieves the outcome of a request given up on, so its failure isn't reported as never retrieved.
+    """
+    if not task.cancelled():
+        task.exception()
+
 
 class Handler(UWUHandlerBase):
     def __init__(self, node: "PeerNode"):
         self.node = node
-        self.pending_responses = {}
+        # One multiplexed connection per informant, (host, port) -> UWUClient
+        self.clients: Dict[Tuple[str, int], UWUClient] = {}
+        # Version and content of the DHT last loaded from each informant, the DHT of the node is their union. An
+        # informant whose circuit breaker opens is dropped from it
+        self.dht_versions: Dict[Tuple[str, int], int] = {}
+        self.dht_snapshots: Dict[Tuple[str, int], dict] = {}
+        # Health of each informant, a failing one is skipped with a growing backoff
+        self.breakers: Dict[Tuple[str, int], CircuitBreaker] = {}
+        # Response times of each informant, hedged reads use their p95
+        self.latencies: Dict[Tuple[str, int], LatencyTracker] = {}
+        # Last poll advice of each informant, {"interval": seconds, "jitter": seconds}
+        self.poll_advice: Dict[Tuple[str, int], dict] = {}
+        # Syncs still running, possibly after the end of the cycle that started them
+        self._syncing: Dict[Tuple[str, int], asyncio.Task] = {}
 
     def bind(self):
         return {
@@ -19,31 +58,277 @@ class Handler(UWUHandlerBase):
             (MessageType.REQUEST, RequestAction.GET_DHT): self.on_get_dht_request, # Get DHT from informants
         }
 
-    async def periodical_tasks(self):
+    def client(self, host: str, port: int) -> UWUClient:
         """
-        Periodical tasks used by the peer node. Tries tasks and adds a timeout to them.
+        Returns the client of an informant, the requests to it share one connection.
         """
-        print("[UWU] Periodical tasks running...")
+        client = self.clients.get((host, port))
+        if client is None:
+            client = UWUClient(host, port, {"host": self.node.host, "port": self.node.port})
+            self.clients[(host, port)] = client
+        return client
+
+    async def leave(self):
+        """
+        Tells every informant the node is leaving with a PEER_LEFT event, so they drop its files right away instead of
+        once it stops registering. An informant that can't be reached is skipped.
+        """
+        async def notify(informant: Tuple[str, int]):
+            await asyncio.wait_for(self.client(*informant).send_event(EventAction.PEER_LEFT, {}), INFORMANT_TIMEOUT)
+
+        informants = self.node.get_informants()
+        results = await asyncio.gather(*(notify(informant) for informant in informants), return_exceptions=True)
+        for informant, result in zip(informants, results):
+            if isinstance(result, Exception):
+                print(f"[UWU] Could not tell {informant} the node is leaving: {result!r}")
+
+    async def close_clients(self):
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            await client.close()
+
+    def breaker(self, informant: Tuple[str, int]) -> CircuitBreaker:
+        breaker = self.breakers.get(informant)
+        if breaker is None:
+            breaker = self.breakers[informant] = CircuitBreaker()
+        return breaker
 
+    def latency(self, informant: Tuple[str, int]) -> LatencyTracker:
+        latency = self.latencies.get(informant)
+        if latency is None:
+            latency = self.latencies[informant] = LatencyTracker()
+        return latency
+
+    def available_informants(self, exclude=()) -> List[Tuple[str, int]]:
+        """
+        Returns the informants that may be asked now, the ones whose circuit breaker is open are left out. An informant
+        in half-open state is returned to a single caller, which must then ask it through call_informant.
+        :param exclude: Informants not to consider at all.
+        """
+        available = []
         for informant in self.node.get_informants():
-            try:
-                reader, writer = await asyncio.open_connection(informant[0], informant[1])
-            except Exception as e:
-                print(f"[UWU] Failed to connect to {informant}: {e}")
+            if informant in exclude:
                 continue
+            if self.breaker(informant).allow():
+                available.append(informant)
+            else:
+                log.limited(logging.INFO, f"skip_{informant}", "[UWU] Skipping informant %s, retry in %.1fs", informant,
+                            self.breaker(informant).backoff())
+        return available
+
+    async def call_informant(self, informant: Tuple[str, int], request):
+        """
+        Runs request(client) with the client of an informant, and records the outcome on its circuit breaker and the
+        response time on its latency tracker. A request that failed or was cancelled records the time it waited, so an
+        informant that never answers doesn't keep a low latency.
+        """
+        breaker = self.breaker(informant)
+        started = time.perf_counter()
+        try:
+            result = await request(self.client(*informant))
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Overloaded as e:
+            # Healthy but busy, left alone for as long as it asked
+            breaker.defer(e.retry_after)
+            raise
+        except Exception:
+            breaker.record_failure()
+            if breaker.state == BreakerState.OPEN:
+                self.__forget_dht(informant)
+            raise
+        finally:
+            self.latency(informant).record(time.perf_counter() - started)
+        breaker.record_success()
+        return result
+
+    async def hedged(self, request, fanout: int = HEDGE_FANOUT):
+        """
+        Runs a read-only request(client) on the informants, fastest first. When the informant asked last hasn't
+        answered within its p95 latency, the request is also sent to the next one, up to fanout at the same time, and
+        right away when one fails. The first answer wins and the requests still running are cancelled, so a slow
+        informant costs at most its usual p95 instead of its worst latency. The cancelled requests are not waited for,
+        their outcome is retrieved once they are done.
+        :return: (informant, result) of the first answer.
+        """
+        candidates = sorted(self.node.get_informants(), key=lambda informant: self.latency(informant).p95())
+        in_flight: Dict[asyncio.Task, Tuple[str, int]] = {}
+        errors = []
+        last = None
+
+        def start_next():
+            nonlocal last
+            while candidates:
+                informant = candidates.pop(0)
+                if self.breaker(informant).allow():
+                    in_flight[asyncio.create_task(self.call_informant(informant, request))] = informant
+                    last = informant
+                    return
+
+        try:
+            start_next()
+            while in_flight:
+                can_hedge = candidates and len(in_flight) < fanout
+                done, _ = await asyncio.wait(in_flight, timeout=self.latency(last).p95() if can_hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    log.limited(logging.INFO, "hedge", "[UWU] No answer from %s within its p95, hedging", last)
+                    start_next()
+                    continue
+
+                for task in done:
+                    informant = in_flight.pop(task)
+                    if task.exception() is None:
+                        return informant, task.result()
+                    errors.append((informant, task.exception()))
+                start_next()
+        finally:
+            for task in in_flight:
+                task.cancel()
+                task.add_done_callback(_drain)
+
+        raise ConnectionError(f"[UWU] No informant answered: {errors}")
+
+    async def fetch_dht(self):
+        """
+        Fetches the DHT with a hedged read and loads it.
+        """
+        request = lambda client: client.request(RequestAction.GET_DHT, {}, INFORMANT_TIMEOUT)
+        informant, response = await self.hedged(request)
+        self.__load_dht(informant, response)
 
-            try:
-                # Set a timeout for the register request (e.g., 3 seconds)
-                await asyncio.wait_for(self.on_register_request(None, reader, writer), timeout=3.0)
-            except asyncio.TimeoutError:
-                print(f"[UWU] Timeout waiting for response from {writer.get_extra_info('peername')}")
-            except Exception as e:
-                print(f"[UWU] Error communicating with {writer.get_extra_info('peername')}: {e}")
-            finally:
-                writer.close()
-                await writer.wait_closed()
+    async def lookup(self, filenames: List[str], hedge: bool = True) -> Dict[str, List[Tuple[str, int]]]:
+        """
+        Asks the informants which nodes provide each file. Each informant gets all the lookups in a single BATCH
+        request, one round trip however many files are looked up.
+        :param hedge: Take the answer of the first informant to answer, with a hedged read. Otherwise all the
+        informants are asked at once and their answers are merged.
+        :return: {filename: [(host, port)]}
+        """
+        providers = {filename: set() for filename in filenames}
+        requests = [UWUProtocol.create_sub_request(MessageType.REQUEST, RequestAction.GET_PROVIDERS, {"filename": filename})
+                    for filename in filenames]
+
+        if hedge:
+            _, responses = await self.hedged(lambda client: client.batch(requests, INFORMANT_TIMEOUT))
+            for filename, response in zip(filenames, responses):
+                providers[filename].update(tuple(provider) for provider in (response or {}).get("data", {}).get("providers", []))
+            return {filename: sorted(found) for filename, found in providers.items()}
+
+        async def ask(informant: Tuple[str, int]):
+            responses = await self.call_informant(informant, lambda client: client.batch(requests, INFORMANT_TIMEOUT))
+            for filename, response in zip(filenames, responses):
+                for host, port in (response or {}).get("data", {}).get("providers", []):
+                    providers[filename].add((host, port))
+
+        informants = self.available_informants()
+        results = await asyncio.gather(*(ask(informant) for informant in informants), return_exceptions=True)
+        for informant, result in zip(informants, results):
+            if isinstance(result, Exception):
+                log.limited(logging.WARNING, f"lookup_{informant}", "[UWU] Lookup failed on %s: %r", informant, result)
+
+        return {filename: sorted(found) for filename, found in providers.items()}
+
+    async def periodical_tasks(self):
+        """
+        Periodical tasks used by the peer node. Registers the shared files and fetches the DHT of every informant, both
+        in one BATCH request.
+
+        All the informants are synced at once and the cycle ends as soon as SYNC_QUORUM of them answered, a slow or dead
+        informant doesn't hold it up: its sync goes on in the background until its timeout, and it is not synced again
+        while it is still running. Informants that keep failing are skipped by their circuit breaker.
+        :return: Seconds before the next cycle, the longest interval advised by the informants plus a random part of
+        their jitter window, so the peers of a network don't poll in waves. None to keep the default interval.
+        """
+        print("[UWU] Periodical tasks running...")
+
+        files: List[Tuple[str, str]] = [(filename, "") for filename in self.node.get_shared_files()]
+        if not files:
+            print("[UWU] No files to register.")
+        # Registered first, the DHT that comes back already has the files. Sent even without files, the response
+        # carries the poll advice.
+        requests = [UWUProtocol.create_sub_request(MessageType.REQUEST, RequestAction.REGISTER, {"files": files}),
+                    UWUProtocol.create_sub_request(MessageType.REQUEST, RequestAction.GET_DHT, {})]
+
+        informants = self.available_informants(exclude=self._syncing)
+        for informant in informants:
+            task = asyncio.create_task(self.__sync(informant, requests))
+            self._syncing[informant] = task
+            task.add_done_callback(lambda _, informant=informant: self._syncing.pop(informant, None))
+
+        pending = {self._syncing[informant] for informant in informants}
+        quorum = math.ceil(len(pending) * SYNC_QUORUM)
+        synced = 0
+        while pending and synced < quorum:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # A sync task cancelled (on shutdown) or failed past __sync's own handling is not counted
+            synced += sum(1 for task in done if not task.cancelled() and task.exception() is None and task.result())
+
+        print(f"[UWU] Periodical tasks finished, {synced}/{len(informants)} informants synced, {len(pending)} still running.")
+        return self.next_poll_delay()
+
+    def next_poll_delay(self):
+        """
+        Seconds before the next poll following the advice of the informants, None if none gave one.
+        """
+        advice = [self.poll_advice[informant] for informant in self.node.get_informants() if informant in self.poll_advice]
+        if not advice:
+            return None
+        interval = max(poll["interval"] for poll in advice)
+        jitter = max(poll["jitter"] for poll in advice)
+        return interval + random.uniform(0, jitter)
+
+    async def __sync(self, informant: Tuple[str, int], requests: List[dict]) -> bool:
+        try:
+            responses = await self.call_informant(informant, lambda client: client.batch(requests, INFORMANT_TIMEOUT))
+        except asyncio.TimeoutError:
+            print(f"[UWU] Timeout waiting for response from {informant}")
+            return False
+        except Exception as e:
+            print(f"[UWU] Error communicating with {informant}: {e}")
+            return False
+
+        registered = (responses[0] or {}).get("data", {})
+        print(f"[UWU] Informant {informant}: {registered.get('message')}")
+        poll = registered.get("poll")
+        if isinstance(poll, dict) and {"interval", "jitter"} <= poll.keys():
+            self.poll_advice[informant] = poll
+        self.__load_dht(informant, responses[-1])
+        return True
+
+    def __load_dht(self, informant: Tuple[str, int], response: dict):
+        """
+        Keeps the DHT an informant sent and loads the union of the last DHT of every informant, a file registered on
+        a single informant is not lost when another one answers.
+        """
+        data = (response or {}).get("data", {})
+        version = data.get("version")
+        if "dht" not in data or version is None or self.dht_versions.get(informant) == version:
+            return
+        self.dht_versions[informant] = version
+        self.dht_snapshots[informant] = data["dht"]
+        self.__merge_dht()
+
+    def __forget_dht(self, informant: Tuple[str, int]):
+        """
+        Drops the DHT of an informant whose circuit breaker opened, its providers are not offered any longer. It is
+        loaded again once the informant answers a sync.
+        """
+        if self.dht_snapshots.pop(informant, None) is None:
+            return
+        self.dht_versions.pop(informant, None)
+        print(f"[UWU] Informant {informant} is down, dropping its DHT.")
+        self.__merge_dht()
 
-        print("[UWU] Periodical tasks finished...")
+    def __merge_dht(self):
+        merged = {}
+        for snapshot in self.dht_snapshots.values():
+            for filename, entry in snapshot.items():
+                providers = merged.setdefault(filename, {"providers": {}})["providers"]
+                for host, ports in entry.get("providers", {}).items():
+                    providers.setdefault(host, {}).update(ports)
+        self.node.dht.load_snapshot(max(self.dht_versions.values(), default=self.node.dht.version), merged)
 
     async def on_register_request(self, message: dict, reader, writer):
         """
@@ -77,9 +362,9 @@ class Handler(UWUHandlerBase):
             await writer.drain()
 
         except asyncio.TimeoutError:
-            print(f"[UWU] Timeout waiting for response from {writer.get_extra_info("peername")}")
+            print(f"[UWU] Timeout waiting for response from {writer.get_extra_info('peername')}")
         except Exception as e:
-            print(f"[UWU] Error communicating with informant {writer.get_extra_info("peername")}: {e}")
+            print(f"[UWU] Error communicating with informant {writer.get_extra_info('peername')}: {e}")
         finally:
             writer.close()
             await writer.wait_closed()
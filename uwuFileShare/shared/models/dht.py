@@ -1,28 +1,161 @@
+import functools
 import json
 import os
-from threading import Lock
+import sys
+import time
+from array import array
+from contextlib import contextmanager
+from threading import RLock
 import logging
-from typing import Tuple
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ..services.metrics import MetricsRegistry
+from ..services.uwu_protocol.log import get_logger
+
+log = get_logger("dht")
 
 PERSISTENCE_DEFAULT_FILE = os.path.join(os.path.dirname(__file__), "data", "dht_persistence.json")
 
+
+def _timed(operation: str):
+    """
+    Records the duration of a DHT method in the operation histogram of its DHT, the time waited for the lock included.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._operation_seconds.labels(operation=operation).observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+class _FileRecord:
+    """
+    Compact entry of a file in the DHT. Providers are stored as interned provider ids in an array, details are only
+    stored for the providers that sent any, since most peers register files without details.
+    """
+    __slots__ = ("name", "providers", "details")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.providers = array("I")
+        self.details: Optional[Dict[int, str]] = None
+
+    def get_details(self, provider_id: int):
+        return self.details.get(provider_id) if self.details else None
+
+    def set_provider(self, provider_id: int, details) -> bool:
+        """
+        Adds or updates a provider of the file.
+        :return: True if the provider was not already providing the file.
+        """
+        is_new = provider_id not in self.providers
+        if is_new:
+            self.providers.append(provider_id)
+
+        if details:
+            if self.details is None:
+                self.details = {}
+            self.details[provider_id] = details
+        elif self.details:
+            self.details.pop(provider_id, None)
+
+        return is_new
+
+    def remove_provider(self, provider_id: int) -> bool:
+        """
+        Removes a provider of the file.
+        :return: True if the provider was providing the file.
+        """
+        try:
+            self.providers.remove(provider_id)
+        except ValueError:
+            return False
+
+        if self.details:
+            self.details.pop(provider_id, None)
+        return True
+
+
+class DHTChange:
+    """
+    Coalesced diff of a DHT transaction, passed to the change listeners. Added and updated entries are
+    (filename, host, port, details), removed entries are (filename, host, port). An entry added and removed within the
+    same transaction does not show up at all.
+    """
+    __slots__ = ("version", "added", "updated", "removed")
+
+    def __init__(self, version: int, added: list = None, updated: list = None, removed: list = None):
+        self.version = version
+        self.added: List[Tuple[str, str, int, str]] = added or []
+        self.updated: List[Tuple[str, str, int, str]] = updated or []
+        self.removed: List[Tuple[str, str, int]] = removed or []
+
+    def __bool__(self):
+        return bool(self.added or self.updated or self.removed)
+
+    def __reduce__(self):
+        # Sent as is to the read replicas of a multi-process informant
+        return DHTChange, (self.version, self.added, self.updated, self.removed)
+
+    def __repr__(self):
+        return (f"DHTChange(version={self.version}, added={len(self.added)}, updated={len(self.updated)}, "
+                f"removed={len(self.removed)})")
+
+
+# States of an entry in a pending transaction
+_ADDED, _UPDATED, _REMOVED = range(3)
+
+
 class DHT:
     """
-    This class represents a Distributed Hash Table (DHT) for file sharing. This DHT has this structure:
+    This class represents a Distributed Hash Table (DHT) for file sharing. The public API exposes this structure:
     {
         "filename": {
             "providers": {
-                ("host", "port"): { "details": "details" },
+                ("host", "port"): "details",
                 ...
             }
         }
     }
+
+    Internally, providers are interned into integer ids and every file is a _FileRecord holding an array of provider
+    ids, so a (file, provider) entry costs a few bytes instead of a tuple and a dict slot. Each provider also keeps an
+    array of its file ids, so per node queries (files of a node, counts, removal) only touch that node's entries. The
+    dict shape is only built by get_all_files and get_snapshot. Empty details are not stored, they are returned as None.
+
+    Every mutation runs in a transaction (see batch), which bumps the version, persists and notifies the listeners once
+    with a DHTChange, and only if something actually changed.
+
+    The duration of the main operations, the entries changed and the size of the DHT are recorded in a metrics registry.
     """
-    def __init__(self, persistence_file=None):
-        self._dht = {}
-        self._lock = Lock()
+    def __init__(self, persistence_file=None, metrics: MetricsRegistry = None):
+        """
+        :param persistence_file: JSON file the DHT is loaded from and saved to on every change, none if None.
+        :param metrics: Registry of the node the DHT records its metrics in, a registry of its own if None.
+        """
+        self._lock = RLock()
         self.persistence_file = persistence_file
-        self._on_change = None  # ← Hook for ViewModel
+        self._on_change: List[Callable[[DHTChange], None]] = []  # ← Hooks for ViewModels
+        self._version = 0  # Bumped on every change, lets readers cache derived data
+
+        # Transaction state: nesting depth and (filename, host, port) -> (state, details, previous details)
+        self._batch_depth = 0
+        self._pending: Optional[Dict[Tuple[str, str, int], tuple]] = None
+        self.__clear()
+
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        self._operation_seconds = metrics.histogram("uwu_dht_operation_seconds", "Duration of the DHT operations",
+                                                    ("operation",))
+        self._changes = metrics.counter("uwu_dht_changes_total", "DHT entries added, updated and removed", ("change",))
+        metrics.gauge("uwu_dht_version", "Version of the DHT").labels().set_function(lambda: self._version)
+        metrics.gauge("uwu_dht_files", "Files in the DHT").labels().set_function(lambda: len(self._file_ids))
+        metrics.gauge("uwu_dht_providers", "Nodes providing files in the DHT").labels().set_function(
+            lambda: len(self._provider_ids))
 
         logging.basicConfig(level=logging.INFO)
 
@@ -30,113 +163,427 @@ class DHT:
             print(f"[INFO] Initializing persistence file: {self.persistence_file}")
             self._load_persistent_data()
 
+    def __clear(self):
+        # Files: filename -> file id, and file id -> record (None for free ids)
+        self._file_ids: Dict[str, int] = {}
+        self._files: List[Optional[_FileRecord]] = []
+        self._free_file_ids: List[int] = []
+
+        # Providers: (host, port) -> provider id, provider id -> (host, port) and the file ids of each provider
+        self._provider_ids: Dict[Tuple[str, int], int] = {}
+        self._providers: List[Optional[Tuple[str, int]]] = []
+        self._provider_files: List[Optional[array]] = []
+        self._free_provider_ids: List[int] = []
+
     def _load_persistent_data(self):
         if os.path.exists(self.persistence_file):
             try:
                 with open(self.persistence_file, "r") as file:
-                    self._dht = json.load(file)
-                    logging.info("[DHT] Loaded persistent data.")
-            except (json.JSONDecodeError, IOError):
+                    data = json.load(file)
+                self.__load_snapshot(data)
+                logging.info("[DHT] Loaded persistent data.")
+            except (json.JSONDecodeError, IOError, AttributeError, ValueError):
                 logging.warning("[DHT] Failed to load persistent data. Starting fresh.")
-                self._dht = {}
+                self.__clear()
+
+    def __load_snapshot(self, data: dict):
+        for filename, entry in data.items():
+            for host, ports in entry.get("providers", {}).items():
+                for port, provider in ports.items():
+                    self.__set_provider(filename, host, int(port), provider.get("details"))
 
+    @_timed("persist")
     def _save_persistent_data(self):
         try:
             with open(self.persistence_file, "w") as file:
-                json.dump(self._dht, file, indent=4)
+                json.dump(self.__build_snapshot(), file, indent=4)
                 logging.info("[DHT] Saved persistent data.")
         except IOError as e:
             logging.error(f"[DHT] Failed to save persistent data: {e}")
 
-    def bind_on_change(self, callback):
-        self._on_change = callback
-
-    def _notify_change(self):
-        print("[DHT] DHT changed, notifying...")
-        if self._on_change:
-            self._on_change()
+    def bind_on_change(self, callback: Callable[[DHTChange], None]):
+        """
+        Adds a listener called with a DHTChange after every transaction that changed the DHT. Listeners are called
+        while the DHT lock is held, so they must not block.
+        """
+        self._on_change.append(callback)
 
-    def __create_file_entry(self, filename: str, host: str, port: int, details: str = None) -> dict:
+    @property
+    def version(self) -> int:
         """
-        Creates a new file entry in the DHT.
-        :param filename: Name of the file.
-        :param host: Host where the file is located.
-        :param port: Port where the file is located.
-        :param details: Optional details about the file.
-        :return: A dictionary representing the file entry.
+        Monotonic counter increased every time the DHT changes.
+        :return: The current version of the DHT.
         """
-        self._dht[filename] = {
-            "providers": {
-                (host, port): details
-            }
-        }
+        return self._version
+
+    def _notify_change(self, change: DHTChange):
+        log.limited(logging.INFO, "changed", "[DHT] DHT changed, notifying... %s", change)
+        for callback in self._on_change:
+            callback(change)
+
+    @contextmanager
+    def batch(self):
+        """
+        Applies several mutations as one transaction, under a single lock acquisition:
+
+            with dht.batch():
+                dht.add_file("a.txt", host, port)
+                dht.remove_file("b.txt", host, port)
 
-    def add_file(self, filename: str, host: str, port: int, details: str = None) -> bool:
+        When the outermost batch exits, the DHT is persisted once and the listeners get a single DHTChange with the
+        net diff. If the block raises, the mutations made in it are rolled back. Batches can be nested, only the
+        outermost one commits: a nested batch that raises only rolls back its own mutations, the ones made before it
+        stay pending if the outer block goes on.
+        """
         with self._lock:
-            entry = self._dht.get(filename)
+            self._batch_depth += 1
+            if self._batch_depth == 1:
+                self._pending = {}
+            savepoint = dict(self._pending)
+
+            try:
+                yield self
+            except BaseException:
+                self.__rollback(savepoint)
+                raise
+            finally:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    pending, self._pending = self._pending, None
+                    self.__commit(pending)
 
-            if entry:
-                provider = (host, port)
+    def __record(self, filename: str, host: str, port: int, state: int, details=None, previous=None):
+        """
+        Records a mutation in the pending transaction, coalescing it with earlier mutations of the same entry.
+        """
+        if self._pending is None:
+            return
 
-                # Update or create new details (both cases can be handled automatically)
-                entry["providers"][provider] = details
+        key = (filename, host, port)
+        earlier = self._pending.get(key)
 
+        if earlier is None:
+            self._pending[key] = (state, details, previous)
+        elif state == _REMOVED:
+            if earlier[0] == _ADDED:
+                del self._pending[key]  # Added and removed in the same transaction, nothing happened
             else:
-                self.__create_file_entry(filename, host, port, details)
+                self._pending[key] = (_REMOVED, None, earlier[2])
+        elif earlier[0] == _ADDED:
+            self._pending[key] = (_ADDED, details, None)
+        else:
+            # Removed or updated earlier in the transaction, so the entry existed before it
+            if earlier[2] == details:
+                del self._pending[key]
+            else:
+                self._pending[key] = (_UPDATED, details, earlier[2])
 
-            self._notify_change()
+    def __commit(self, pending: dict):
+        if not pending:
+            return
 
-    def remove_file(self, filename, host, port):
-        with self._lock:
-            if filename in self._dht:
-                # Check if the host and port are in the providers
-                if (host, port) in self._dht[filename]["providers"]:
-                    del self._dht[filename]["providers"][(host, port)]
+        self._version += 1
+        change = DHTChange(self._version)
+        for (filename, host, port), (state, details, _) in pending.items():
+            if state == _ADDED:
+                change.added.append((filename, host, port, details))
+            elif state == _UPDATED:
+                change.updated.append((filename, host, port, details))
+            else:
+                change.removed.append((filename, host, port))
+
+        self._changes.labels(change="added").inc(len(change.added))
+        self._changes.labels(change="updated").inc(len(change.updated))
+        self._changes.labels(change="removed").inc(len(change.removed))
+
+        if self.persistence_file:
+            self._save_persistent_data()
+
+        self._notify_change(change)
+
+    def __rollback(self, savepoint: dict):
+        """
+        Undoes the mutations made since savepoint, the pending transaction as it was when the batch started.
+        """
+        pending = self._pending
+        for key in set(pending) | set(savepoint):
+            now, then = pending.get(key), savepoint.get(key)
+            if now == then:
+                continue
+            if then is not None:
+                present, details = then[0] != _REMOVED, then[1]
+            else:
+                # Untouched at the savepoint, the entry goes back to what it was before the transaction
+                present, details = now[0] != _ADDED, now[2]
+
+            filename, host, port = key
+            if present:
+                self.__set_provider(filename, host, port, details)
+            else:
+                self.__remove_provider(filename, host, port)
+        self._pending = savepoint
+
+    @staticmethod
+    def __provider_key(host: str, port: int) -> Tuple[str, int]:
+        """
+        Key of a provider in _provider_ids, the port of a node can come as a string from a message.
+        """
+        return sys.intern(host), int(port)
+
+    def __intern_provider(self, host: str, port: int) -> int:
+        """
+        Returns the id of a provider, assigning a new one if it is not known yet.
+        """
+        key = self.__provider_key(host, port)
+        provider_id = self._provider_ids.get(key)
+        if provider_id is not None:
+            return provider_id
+
+        if self._free_provider_ids:
+            provider_id = self._free_provider_ids.pop()
+            self._providers[provider_id] = key
+            self._provider_files[provider_id] = array("I")
+        else:
+            provider_id = len(self._providers)
+            self._providers.append(key)
+            self._provider_files.append(array("I"))
+
+        self._provider_ids[key] = provider_id
+        return provider_id
+
+    def __release_provider(self, provider_id: int):
+        """
+        Frees the id of a provider once it does not provide any file.
+        """
+        del self._provider_ids[self._providers[provider_id]]
+        self._providers[provider_id] = None
+        self._provider_files[provider_id] = None
+        self._free_provider_ids.append(provider_id)
+
+    def __create_file_entry(self, filename: str) -> int:
+        """
+        Creates a new, empty file entry in the DHT.
+        :param filename: Name of the file.
+        :return: The id of the new file.
+        """
+        record = _FileRecord(filename)
+        if self._free_file_ids:
+            file_id = self._free_file_ids.pop()
+            self._files[file_id] = record
+        else:
+            file_id = len(self._files)
+            self._files.append(record)
+
+        self._file_ids[filename] = file_id
+        return file_id
+
+    def __set_provider(self, filename: str, host: str, port: int, details=None):
+        file_id = self._file_ids.get(filename)
+        if file_id is None:
+            file_id = self.__create_file_entry(filename)
+
+        provider_id = self.__intern_provider(host, port)
+        host, port = self._providers[provider_id]
+        record = self._files[file_id]
+        previous = record.get_details(provider_id)
+        details = details or None
 
-                if self.persistence_file:
-                    self._save_persistent_data()
+        if record.set_provider(provider_id, details):
+            self._provider_files[provider_id].append(file_id)
+            self.__record(filename, host, port, _ADDED, details)
+        elif previous != details:
+            self.__record(filename, host, port, _UPDATED, details, previous)
 
+    def __remove_provider(self, filename: str, host: str, port: int) -> bool:
+        """
+        Removes a provider of a file, releasing the provider once it has no files left.
+        :return: True if the provider was providing the file.
+        """
+        file_id = self._file_ids.get(filename)
+        provider_id = self._provider_ids.get(self.__provider_key(host, port))
+        if file_id is None or provider_id is None or provider_id not in self._files[file_id].providers:
+            return False
+
+        self.__unset_provider(file_id, provider_id)
+        self._provider_files[provider_id].remove(file_id)
+        if not self._provider_files[provider_id]:
+            self.__release_provider(provider_id)
+        return True
+
+    def __unset_provider(self, file_id: int, provider_id: int):
+        """
+        Removes a provider from a file, freeing the file id once nobody provides it. The caller is in charge of updating
+        the file ids of the provider and releasing it.
+        """
+        record = self._files[file_id]
+        host, port = self._providers[provider_id]
+        self.__record(record.name, host, port, _REMOVED, previous=record.get_details(provider_id))
+        record.remove_provider(provider_id)
+
+        if not record.providers:
+            del self._file_ids[record.name]
+            self._files[file_id] = None
+            self._free_file_ids.append(file_id)
+
+    def add_file(self, filename: str, host: str, port: int, details: str = None):
+        with self.batch():
+            self.__set_provider(filename, host, port, details)
+
+    def remove_file(self, filename, host, port):
+        with self.batch():
+            if self.__remove_provider(filename, host, port):
                 logging.info(f"[DHT] File '{filename}' removed from DHT.")
-                self._notify_change()  # ← Notify ViewModel
 
+    @_timed("update_node_files")
     def update_node_files(self, files: list[Tuple[str, str]], host: str, port: int):
-        with self._lock:
-            filenames = [filename for filename, _ in files]
-            detail_of_filename = {filename: detail for filename, detail in files}
+        """
+        Replaces the files provided by a node. Everything is applied in one transaction, so a node registering
+        thousands of files produces a single notification, and none if its files did not change.
+        """
+        with self.batch():
+            filenames = set()
 
             # First, add or update files
-            for filename in filenames:
-                if filename not in self._dht.keys():
-                    self.__create_file_entry(filename, host, port, detail_of_filename[filename])
-                    continue
-                self._dht[filename]["providers"][(host, port)] = detail_of_filename[filename]
+            for filename, details in files:
+                filenames.add(filename)
+                self.__set_provider(filename, host, port, details)
 
-            # Then, prepare to remove old files
-            to_remove = []
-            for filename, value in self._dht.items():
-                if (host, port) in value["providers"]:
-                    if filename not in filenames:
-                        to_remove.append(filename)
+            # Then, remove the files the node does not share anymore
+            provider_id = self._provider_ids.get(self.__provider_key(host, port))
+            if provider_id is not None:
+                kept, to_remove = array("I"), []
+                for file_id in self._provider_files[provider_id]:
+                    (kept if self._files[file_id].name in filenames else to_remove).append(file_id)
 
-            for filename in to_remove:
-                if len(self._dht[filename]["providers"]) == 1:
-                    del self._dht[filename]
-                else:
-                    del self._dht[filename]["providers"][(host, port)]
+                if to_remove:
+                    for file_id in to_remove:
+                        self.__unset_provider(file_id, provider_id)
+                    self._provider_files[provider_id] = kept
+                    if not kept:
+                        self.__release_provider(provider_id)
 
-            if self.persistence_file:
-                self._save_persistent_data()
+    @_timed("remove_all_files_for_node")
+    def remove_all_files_for_node(self, host: str, port: int) -> int:
+        """
+        Removes a node from every file it provides, e.g. when it leaves the network. Only the files of the node are
+        visited, through its file ids.
+        :return: The number of files the node was providing.
+        """
+        with self.batch():
+            provider_id = self._provider_ids.get(self.__provider_key(host, port))
+            if provider_id is None:
+                return 0
 
-            self._notify_change()
+            file_ids = self._provider_files[provider_id]
+            for file_id in file_ids:
+                self.__unset_provider(file_id, provider_id)
+            self.__release_provider(provider_id)
 
+            logging.info(f"[DHT] Removed {len(file_ids)} files of node {host}:{port}.")
+            return len(file_ids)
+
+    @_timed("load_snapshot")
+    def load_snapshot(self, version: int, data: dict):
+        """
+        Replaces the content of the DHT with a snapshot taken by get_snapshot on another DHT, and takes its version.
+        Used by read replicas, together with apply_change. Listeners are not notified.
+        """
+        with self._lock:
+            self.__clear()
+            self.__load_snapshot(data)
+            self._version = version
+
+    @_timed("apply_change")
+    def apply_change(self, change: DHTChange):
+        """
+        Applies a DHTChange produced by another DHT, keeping its version, and notifies the listeners with it. Changes
+        must be applied in order, starting right after the snapshot the DHT was loaded with.
+        """
+        with self._lock:
+            if change.version <= self._version:
+                return
+            if change.version != self._version + 1:
+                logging.warning(f"[DHT] Applying change {change.version} on top of version {self._version}.")
+
+            for filename, host, port in change.removed:
+                self.__remove_provider(filename, host, port)
+            for filename, host, port, details in change.added + change.updated:
+                self.__set_provider(filename, host, port, details)
+
+            self._version = change.version
+            self._notify_change(change)
+
+    @_timed("get_all_files")
     def get_all_files(self) -> dict[str: dict[str: dict[Tuple[str, int]: str]]]:
         """
         Returns all files in the DHT.
         :return:
         """
         with self._lock:
-            print(f"[DHT] Getting all files: {self._dht}")
-            return self._dht.copy()
+            files = {}
+            for record in self._files:
+                if record is None:
+                    continue
+                files[record.name] = {
+                    "providers": {
+                        self._providers[provider_id]: record.get_details(provider_id)
+                        for provider_id in record.providers
+                    }
+                }
+            return files
+
+    def get_entries(self) -> Tuple[int, List[Tuple[str, str, int]]]:
+        """
+        Returns every (filename, host, port) entry in storage order, together with the version they were read at, so a
+        reader can apply the DHTChanges that come after it.
+        :return: Tuple (version, entries).
+        """
+        with self._lock:
+            providers = self._providers
+            entries = [(record.name, *providers[provider_id])
+                       for record in self._files if record is not None
+                       for provider_id in record.providers]
+            return self._version, entries
+
+    def get_details(self, filename: str, host: str, port: int):
+        """
+        Returns the details a provider sent for a file, None if it sent none or does not provide the file.
+        """
+        with self._lock:
+            file_id = self._file_ids.get(filename)
+            provider_id = self._provider_ids.get(self.__provider_key(host, port))
+            if file_id is None or provider_id is None:
+                return None
+            return self._files[file_id].get_details(provider_id)
+
+    @_timed("get_snapshot")
+    def get_snapshot(self) -> Tuple[int, dict]:
+        """
+        Returns the DHT in a JSON serializable shape together with the version it was taken at. Providers are keyed by
+        host and then by port (as string), the same shape used on the wire:
+        {
+            "filename": {
+                "providers": {
+                    "host": { "port": { "details": "details" } }
+                }
+            }
+        }
+        :return: Tuple (version, files).
+        """
+        with self._lock:
+            return self._version, self.__build_snapshot()
+
+    def __build_snapshot(self) -> dict:
+        files = {}
+        for record in self._files:
+            if record is None:
+                continue
+            providers = {}
+            for provider_id in record.providers:
+                host, port = self._providers[provider_id]
+                providers.setdefault(host, {})[str(port)] = {"details": record.get_details(provider_id)}
+            files[record.name] = {"providers": providers}
+        return files
 
     def get_nodes(self):
         """
@@ -144,10 +591,38 @@ class DHT:
         :return:
         """
         with self._lock:
-            nodes = set()
-            for filename, data in self._dht.items():
-                for (host, port), details in data.get("providers", {}).items():
-                    nodes.add((host, port))
+            nodes = list(self._provider_ids.keys())
+            print(f"[DHT] Getting nodes: {len(nodes)}")
+            return nodes
+
+    def get_node_file_counts(self) -> List[Tuple[str, int, int]]:
+        """
+        Retrieve all nodes in the DHT with the number of files each one provides.
+        :return: List of (host, port, files count).
+        """
+        with self._lock:
+            return [(host, port, len(self._provider_files[provider_id]))
+                    for (host, port), provider_id in self._provider_ids.items()]
 
-            print(f"[DHT] Getting nodes: {nodes}")
-            return list(nodes)
\ No newline at end of file
+    def get_node_files(self, host: str, port: int) -> List[str]:
+        """
+        Retrieve the names of the files provided by a node.
+        :return: List of filenames, empty if the node is unknown.
+        """
+        with self._lock:
+            provider_id = self._provider_ids.get(self.__provider_key(host, port))
+            if provider_id is None:
+                return []
+            return [self._files[file_id].name for file_id in self._provider_files[provider_id]]
+
+    @_timed("get_providers")
+    def get_providers(self, filename: str) -> List[Tuple[str, int]]:
+        """
+        Retrieve the nodes providing a file.
+        :return: List of (host, port), empty if the file is unknown.
+        """
+        with self._lock:
+            file_id = self._file_ids.get(filename)
+            if file_id is None:
+                return []
+            return [self._providers[provider_id] for provider_id in self._files[file_id].providers]
@@ -0,0 +1,91 @@
+import random
+import time
+from enum import Enum
+
+
+class BreakerState(str, Enum):
+    CLOSED = "closed"  # Healthy, requests go through
+    OPEN = "open"  # Failing, requests are skipped until the backoff delay is over
+    HALF_OPEN = "half_open"  # Backoff over, a single probe request decides
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of a remote node, so a node that keeps failing is left alone instead of being retried at full
+    rate and slowing down every cycle.
+
+    After failure_threshold failures in a row the breaker opens, and requests are skipped for a backoff delay that
+    doubles on every failed probe, from base_delay up to max_delay. The delay is jittered, so the peers of a network
+    don't all come back to a recovered node at the same moment. Once it is over, the breaker lets one probe request
+    through: its success closes the breaker, its failure opens it again for longer.
+    """
+    def __init__(self, failure_threshold: int = 3, base_delay: float = 1.0, max_delay: float = 60.0, jitter: float = 0.5):
+        """
+        :param jitter: Share of the delay that is random, 0.5 waits between half and all of the delay.
+        """
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.opened = 0  # Times opened since it was last closed
+        self.retry_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be sent now. In half-open state, only one request is let through until it is recorded.
+        """
+        if self.state == BreakerState.CLOSED:
+            return True
+        if self.state == BreakerState.OPEN:
+            if time.monotonic() < self.retry_at:
+                return False
+            self.state = BreakerState.HALF_OPEN
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == BreakerState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.__open()
+
+    def defer(self, seconds: float):
+        """
+        Skips the node for the next seconds without counting a failure, for a node that asked to be left alone for a
+        while because it is overloaded.
+        """
+        self.state = BreakerState.OPEN
+        self.retry_at = max(self.retry_at, time.monotonic() + seconds)
+        self._probing = False
+
+    def release(self):
+        """
+        Gives the probe back without an outcome, for a request that was cancelled before it could tell anything.
+        """
+        self._probing = False
+
+    def backoff(self) -> float:
+        """
+        Seconds left before the next probe, 0 if requests may be sent.
+        """
+        if self.state != BreakerState.OPEN:
+            return 0.0
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def __open(self):
+        delay = min(self.max_delay, self.base_delay * 2 ** self.opened)
+        delay *= 1 - self.jitter * random.random()
+        self.opened += 1
+        self.state = BreakerState.OPEN
+        self.retry_at = time.monotonic() + delay
@@ -0,0 +1,385 @@
+import asyncio
+import math
+import threading
+import time
+from array import array
+from typing import Callable, Dict, Optional, Tuple
+
+# Histograms record durations in microseconds, with 2^PRECISION_BITS buckets per power of two: a value is known within
+# 1 / 2^PRECISION_BITS of itself, 6% for 4 bits, whatever its magnitude
+PRECISION_BITS = 4
+# Longest duration a histogram tells apart, about 134 seconds, longer ones are recorded as this
+HIGHEST_MICROSECONDS = (1 << 27) - 1
+# Upper bounds of the buckets exported in the Prometheus format, in seconds
+PROMETHEUS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                      5.0, 10.0, 30.0)
+# Quantiles reported for each histogram in collect()
+QUANTILES = (0.5, 0.9, 0.99)
+# Port of the Prometheus endpoint when a node is asked for one without a port
+DEFAULT_METRICS_PORT = 9100
+# Longest time the metrics endpoint waits for the head of an HTTP request, in seconds
+HTTP_READ_TIMEOUT = 5.0
+
+_LINEAR_BUCKETS = 1 << (PRECISION_BITS + 1)
+
+
+def _bucket_index(microseconds: int) -> int:
+    """
+    Bucket of a value: values below 2^(PRECISION_BITS + 1) have a bucket each, above that every power of two is cut
+    into 2^PRECISION_BITS buckets, indexed by the top PRECISION_BITS + 1 bits of the value.
+    """
+    if microseconds < _LINEAR_BUCKETS:
+        return microseconds
+    shift = microseconds.bit_length() - PRECISION_BITS - 1
+    return (shift << PRECISION_BITS) + (microseconds >> shift)
+
+
+def _bucket_bounds(index: int) -> Tuple[int, int]:
+    """
+    :return: (lowest value, highest value + 1) of a bucket, in microseconds.
+    """
+    if index < _LINEAR_BUCKETS:
+        return index, index + 1
+    shift = (index >> PRECISION_BITS) - 1
+    top = index - (shift << PRECISION_BITS)
+    return top << shift, (top + 1) << shift
+
+
+_BUCKETS = _bucket_index(HIGHEST_MICROSECONDS) + 1
+# Buckets counted in each Prometheus bucket: those entirely under its bound
+_PROMETHEUS_CUTS = tuple(_bucket_index(int(bound * 1_000_000)) for bound in PROMETHEUS_BUCKETS)
+
+
+def _label_value(value) -> str:
+    return str(getattr(value, "value", value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class CounterValue:
+    """
+    A counter of a metric, for one set of label values.
+    """
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class GaugeValue:
+    """
+    A gauge of a metric, for one set of label values. Its value is either set, or read from a function when the metric
+    is collected.
+    """
+    __slots__ = ("_value", "_function", "_lock")
+
+    def __init__(self):
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> float:
+        return self._function() if self._function is not None else self._value
+
+    def set(self, value: float):
+        self._value = value
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Reads the value from function() on every collection, for values the owner already keeps.
+        """
+        self._function = function
+
+    def snapshot(self):
+        return self.value
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_started")
+
+    def __init__(self, histogram: "HistogramValue"):
+        self._histogram = histogram
+        self._started = 0.0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started)
+        return False
+
+
+class HistogramValue:
+    """
+    A latency histogram of a metric, for one set of label values, in the manner of HdrHistogram: fixed log-linear
+    buckets from a microsecond to about two minutes, so recording is a few integer operations, the memory doesn't
+    depend on the number of values and any quantile is known within the same relative precision.
+    """
+    __slots__ = ("counts", "count", "sum", "max", "_lock")
+
+    def __init__(self):
+        self.counts = array("q", bytes(8 * _BUCKETS))
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        seconds = max(0.0, seconds)
+        index = _bucket_index(min(int(seconds * 1_000_000), HIGHEST_MICROSECONDS))
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def time(self) -> _Timer:
+        """
+        Records the duration of a with block.
+        """
+        return _Timer(self)
+
+    def quantile(self, q: float) -> float:
+        """
+        :return: The q quantile in seconds, rounded up to its bucket, 0 if nothing was recorded.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_bounds(index)[1] / 1_000_000, self.max)
+        return self.max
+
+    def cumulative_counts(self) -> list:
+        """
+        :return: Values under each of PROMETHEUS_BUCKETS, a bound that falls inside a bucket leaves it out.
+        """
+        counts, total, start = [], 0, 0
+        for cut in _PROMETHEUS_CUTS:
+            total += sum(self.counts[start:cut])
+            start = cut
+            counts.append(total)
+        return counts
+
+    def snapshot(self) -> dict:
+        stats = {"count": self.count, "sum": self.sum, "max": self.max}
+        for q in QUANTILES:
+            stats[f"p{round(q * 100)}"] = self.quantile(q)
+        return stats
+
+
+class Metric:
+    """
+    A named metric, with a value per set of label values.
+    """
+    type = ""
+    value_class = CounterValue
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values, **labels):
+        """
+        Returns the value of a set of labels, given in the order of labelnames or by name. Enum labels are taken by
+        value.
+        """
+        key = tuple(_label_value(labels[name]) for name in self.labelnames) if labels \
+            else tuple(_label_value(value) for value in values)
+        value = self._values.get(key)
+        if value is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes the labels {self.labelnames}")
+            with self._lock:
+                value = self._values.setdefault(key, self.value_class())
+        return value
+
+    def items(self):
+        return list(self._values.items())
+
+
+class Counter(Metric):
+    type = "counter"
+    value_class = CounterValue
+
+    def inc(self, amount: float = 1.0, **labels):
+        self.labels(**labels).inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+    value_class = GaugeValue
+
+    def set(self, value: float, **labels):
+        self.labels(**labels).set(value)
+
+
+class Histogram(Metric):
+    type = "histogram"
+    value_class = HistogramValue
+
+    def observe(self, seconds: float, **labels):
+        self.labels(**labels).observe(seconds)
+
+
+class MetricsRegistry:
+    """
+    The metrics of a node, by name. Asking for a metric that exists returns it, so every component registers what it
+    needs without knowing who else does: a node hands its registry to its DHT, service and runtime, and each process
+    of an informant cluster has its own. Nodes don't share a registry, the gauges a component reads from itself would
+    be taken over by the next one registering them.
+
+    Values are read with collect(), which the STATS request returns, or with render_prometheus() for a scraper.
+    """
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.__get(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self.__get(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Histogram:
+        return self.__get(Histogram, name, help, labelnames)
+
+    def __get(self, metric_class, name: str, help: str, labelnames: Tuple[str, ...]):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, help, labelnames)
+            elif type(metric) is not metric_class or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} already exists as a {metric.type} of labels {metric.labelnames}")
+            return metric
+
+    def collect(self) -> Dict[str, dict]:
+        """
+        :return: {name: {"type", "help", "values": [{"labels": {name: value}, "value": number or histogram stats}]}},
+        histogram stats are the count, sum, max and QUANTILES of the values, in seconds.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            metric.name: {
+                "type": metric.type,
+                "help": metric.help,
+                "values": [
+                    {"labels": dict(zip(metric.labelnames, key)), "value": value.snapshot()}
+                    for key, value in metric.items()
+                ],
+            }
+            for metric in metrics
+        }
+
+    def render_prometheus(self) -> str:
+        """
+        :return: The metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for key, value in metric.items():
+                if metric.type != "histogram":
+                    lines.append(f"{metric.name}{_format_labels(metric.labelnames, key)} {_format_number(value.value)}")
+                    continue
+                for bound, count in zip(PROMETHEUS_BUCKETS + (math.inf,), value.cumulative_counts() + [value.count]):
+                    labels = _format_labels(metric.labelnames, key, f'le="{_format_number(bound)}"')
+                    lines.append(f"{metric.name}_bucket{labels} {count}")
+                labels = _format_labels(metric.labelnames, key)
+                lines.append(f"{metric.name}_sum{labels} {_format_number(value.sum)}")
+                lines.append(f"{metric.name}_count{labels} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Minimal HTTP endpoint serving a registry in the Prometheus text format on GET /metrics. It listens on localhost by
+    default: the metrics tell who is connected and how busy the node is, a scraper on another host should go through
+    a proxy or a tunnel.
+    """
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = DEFAULT_METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        """
+        Starts listening, on the running loop.
+        """
+        self.server = await asyncio.start_server(self.__handle, self.host, self.port)
+        print(f"[METRICS] Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_READ_TIMEOUT)
+            method, path, *_ = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ") + ["", ""]
+            if method != "GET":
+                status, body = "405 Method Not Allowed", "Only GET is supported\n"
+            elif path.split("?", 1)[0] not in ("/", "/metrics"):
+                status, body = "404 Not Found", "Metrics are served on /metrics\n"
+            else:
+                status, body = "200 OK", self.registry.render_prometheus()
+
+            payload = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode() + payload
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
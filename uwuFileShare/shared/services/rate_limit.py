@@ -0,0 +1,207 @@
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from .uwu_protocol.enums import RequestAction, EventAction
+
+# Action -> (requests per second, burst) allowed to each peer
+DEFAULT_RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    RequestAction.REGISTER: (2.0, 10),
+    RequestAction.GET_DHT: (5.0, 20),
+    RequestAction.GET_PROVIDERS: (200.0, 1000),
+    EventAction.PEER_LEFT: (1.0, 5),
+}
+# Limit of the actions missing from the table above
+DEFAULT_RATE_LIMIT = (50.0, 100)
+# Bucket the requests of unknown actions are charged to, so the actions a client makes up don't each get a bucket
+INVALID_ACTION = "invalid"
+KNOWN_ACTIONS = frozenset(action.value for action in (*RequestAction, *EventAction))
+# Advertised ports of an address given buckets of their own, the requests of the ones past it share the buckets of
+# the address
+MAX_PORTS_PER_ADDRESS = 64
+# Seconds after which the buckets of an address that sent nothing are forgotten
+IDLE_TTL = 300.0
+
+
+class RequestTooLarge(Exception):
+    """
+    Raised when a request needs more tokens than a bucket holds, it would never be admitted, however long its sender
+    waited.
+    """
+    def __init__(self, action: str, count: int, capacity: float):
+        super().__init__(f"{count} {action} requests at once, at most {capacity:g} are allowed")
+        self.action = action
+
+
+class TokenBucket:
+    """
+    Token bucket of rate requests per second, holding at most capacity requests.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def delay(self, amount: float, now: float) -> float:
+        """
+        Seconds to wait before amount tokens can be taken, 0 if they can be taken now.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        missing = amount - self.tokens
+        return 0.0 if missing <= 0 else missing / self.rate
+
+    def consume(self, amount: float):
+        self.tokens -= amount
+
+
+class PeerLimiter:
+    """
+    Limits what a single peer can ask from a node, so one misbehaving or buggy peer can't take the capacity of the
+    others.
+
+    Each (peer, action) pair has a token bucket, a request is throttled when the bucket of its action is empty. The
+    sub-requests of a BATCH are paid for in the buckets of their own actions, all or nothing, so batching doesn't get
+    around the limits. A request carrying more requests of an action than its bucket holds is refused for good.
+    Requests of unknown actions all share the INVALID_ACTION bucket of their peer, see action_key.
+
+    A peer is the address of the socket, never the host a client claims, together with the port it advertises in its
+    peer_info: peers run side by side on one address, like the peers of a localhost network, get their own buckets.
+    An address gets at most MAX_PORTS_PER_ADDRESS of them, so claiming new ports doesn't buy new buckets forever.
+
+    A limit on the connections an address keeps open at the same time can be turned on with max_connections. It
+    can only count by address, which several peers may share, so it is off by default.
+    """
+    def __init__(self, rate_limits: Dict[str, Tuple[float, float]] = None, default_rate_limit=DEFAULT_RATE_LIMIT,
+                 max_connections: int = None, idle_ttl: float = IDLE_TTL):
+        """
+        :param rate_limits: Action -> (requests per second, burst), overrides DEFAULT_RATE_LIMITS.
+        :param default_rate_limit: (requests per second, burst) of the other actions.
+        :param max_connections: Connections open at the same time from a single address, None for no limit.
+        """
+        self.rate_limits = {**DEFAULT_RATE_LIMITS, **(rate_limits or {})}
+        self.default_rate_limit = default_rate_limit
+        self.max_connections = max_connections
+        self.idle_ttl = idle_ttl
+        self.throttled = Counter()  # action -> requests throttled
+        self.too_large = Counter()  # action -> requests refused for good
+        self.refused_connections = 0
+        self._buckets: Dict[Tuple[Tuple[str, Optional[int]], str], TokenBucket] = {}
+        self._ports: Dict[str, set] = {}  # address -> advertised ports with buckets of their own
+        self._connections = Counter()  # address -> connections open
+        self._last_sweep = time.monotonic()
+
+    def open_connection(self, address: str) -> bool:
+        """
+        Counts a new connection of an address.
+        :return: False if the address has too many connections open already, the connection must then be closed
+        without calling close_connection.
+        """
+        if self.max_connections is not None and self._connections[address] >= self.max_connections:
+            self.refused_connections += 1
+            return False
+        self._connections[address] += 1
+        return True
+
+    def close_connection(self, address: str):
+        self._connections[address] -= 1
+        if self._connections[address] <= 0:
+            del self._connections[address]
+
+    def admit(self, peer: Tuple[str, Optional[int]], actions: Counter) -> float:
+        """
+        Takes the tokens of a request from the buckets of a peer.
+        :param peer: (address, advertised port or None), see peer_of.
+        :param actions: Action -> number of requests, several for a BATCH.
+        :return: 0 if the request is admitted, else the seconds after which it would be.
+        :raises RequestTooLarge: The request needs more tokens than a bucket holds, it is never admitted.
+        """
+        now = time.monotonic()
+        self.__sweep(now)
+
+        peer = self.__peer_key(peer)
+        if not actions.keys() <= KNOWN_ACTIONS:
+            normalized = Counter()
+            for action, count in actions.items():
+                normalized[self.action_key(action)] += count
+            actions = normalized
+        buckets = {action: self.__bucket(peer, action) for action in actions}
+        for action, bucket in buckets.items():
+            if actions[action] > bucket.capacity:
+                self.too_large.update(actions)
+                raise RequestTooLarge(action, actions[action], bucket.capacity)
+
+        delay = max(bucket.delay(actions[action], now) for action, bucket in buckets.items())
+        if delay > 0:
+            self.throttled.update(actions)
+            return delay
+        for action, bucket in buckets.items():
+            bucket.consume(actions[action])
+        return 0.0
+
+    def stats(self) -> dict:
+        return {
+            "throttled": {str(action): count for action, count in self.throttled.items()},
+            "too_large": {str(action): count for action, count in self.too_large.items()},
+            "refused_connections": self.refused_connections,
+            "connections": sum(self._connections.values()),
+            "addresses": len(self._connections),
+        }
+
+    def __peer_key(self, peer: Tuple[str, Optional[int]]) -> Tuple[str, Optional[int]]:
+        address, port = peer
+        if port is None:
+            return peer
+        ports = self._ports.setdefault(address, set())
+        if port not in ports:
+            if len(ports) >= MAX_PORTS_PER_ADDRESS:
+                return address, None
+            ports.add(port)
+        return peer
+
+    def __bucket(self, peer: Tuple[str, Optional[int]], action: str) -> TokenBucket:
+        bucket = self._buckets.get((peer, action))
+        if bucket is None:
+            rate, burst = self.rate_limits.get(action, self.default_rate_limit)
+            bucket = self._buckets[(peer, action)] = TokenBucket(rate, burst)
+        return bucket
+
+    def __sweep(self, now: float):
+        if now - self._last_sweep < self.idle_ttl:
+            return
+        self._last_sweep = now
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket.updated < self.idle_ttl}
+        self._ports = {}
+        for (address, port), _ in self._buckets:
+            if port is not None:
+                self._ports.setdefault(address, set()).add(port)
+
+    @staticmethod
+    def action_key(action) -> str:
+        """
+        The bucket a request of an action is charged to, INVALID_ACTION for anything that isn't a known action, a
+        list or a made up string as well.
+        """
+        return action if isinstance(action, str) and action in KNOWN_ACTIONS else INVALID_ACTION
+
+    @staticmethod
+    def address_of(writer) -> Optional[str]:
+        peername = writer.get_extra_info("peername")
+        return peername[0] if peername else None
+
+    @staticmethod
+    def peer_of(writer, message: dict) -> Tuple[Optional[str], Optional[int]]:
+        """
+        The peer a request is counted against: the address of the socket and the port advertised in its peer_info,
+        None if it gives none.
+        """
+        peer_info = message.get("peer_info")
+        port = peer_info.get("port") if isinstance(peer_info, dict) else None
+        try:
+            port = int(port) if port is not None else None
+        except (TypeError, ValueError):
+            port = None
+        return PeerLimiter.address_of(writer), port
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import zlib
+from typing import List, Optional
+
+from .enums import MessageType, RequestAction
+from .protocol import UWUProtocol
+from .log import get_logger
+
+# Sub-requests accepted in a single BATCH request
+MAX_BATCH_SIZE = 1000
+
+log = get_logger("service")
+
+
+class CaptureWriter:
+    """
+    Writer given to the handler of a sub-request of a batch, it keeps what the handler writes instead of sending it.
+    """
+    __slots__ = ("_writer", "_parts")
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._parts = []
+
+    def write(self, data: bytes):
+        self._parts.append(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def is_closing(self) -> bool:
+        return self._writer.is_closing()
+
+    def get_extra_info(self, name, default=None):
+        return self._writer.get_extra_info(name, default)
+
+    def response(self) -> Optional[bytes]:
+        """
+        The plain JSON response the handler wrote, None if it wrote nothing.
+        """
+        if not self._parts:
+            return None
+        raw = b"".join(self._parts)
+        if UWUProtocol.is_compressed(raw):
+            raw = zlib.decompress(raw)
+        return raw.strip()
+
+
+class BatchRunner:
+    """
+    Runs the sub-requests of a BATCH request with the handlers of a service and builds the combined response.
+
+    The sub-requests are taken in order. Consecutive read-only ones (see base_handler.read_only) run concurrently, any
+    other one is a barrier: it starts once the reads before it are done, and the requests after it wait for it. So a
+    REGISTER followed by lookups sees its own files, while a run of lookups costs about as much as the slowest one.
+    """
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+
+    async def run(self, message: dict, writer) -> bytes:
+        requests = (message.get("data") or {}).get("requests")
+        peer_info = message.get("peer_info", {})
+        if not isinstance(requests, list) or len(requests) > MAX_BATCH_SIZE:
+            return UWUProtocol.create_message(
+                MessageType.RESPONSE, RequestAction.BATCH, peer_info,
+                {"error": f"A batch carries a list of at most {MAX_BATCH_SIZE} requests"}
+            )
+
+        responses: List[Optional[bytes]] = [None] * len(requests)
+        reads = []
+        for index, request in enumerate(requests):
+            sub_message = {
+                "type": request.get("type") if isinstance(request, dict) else None,
+                "action": request.get("action") if isinstance(request, dict) else None,
+                "peer_info": peer_info,
+                "data": request.get("data", {}) if isinstance(request, dict) else {},
+            }
+            handler = self.__find_handler(sub_message)
+            if handler is None:
+                responses[index] = self.__error(sub_message, "No handler for this request")
+                continue
+
+            if getattr(handler, "uwu_read_only", False):
+                reads.append(self.__run(handler, sub_message, index, responses, writer))
+                continue
+
+            if reads:
+                await asyncio.gather(*reads)
+                reads = []
+            await self.__run(handler, sub_message, index, responses, writer)
+
+        if reads:
+            await asyncio.gather(*reads)
+
+        return UWUProtocol.create_batch_response(peer_info, responses)
+
+    def __find_handler(self, message: dict):
+        if not UWUProtocol.is_valid(message) or message["action"] == RequestAction.BATCH:
+            return None
+        return self.handlers.get((message["type"], message["action"]))
+
+    async def __run(self, handler, message: dict, index: int, responses: list, writer):
+        capture = CaptureWriter(writer)
+        try:
+            await handler(message, None, capture)
+            responses[index] = capture.response()
+        except Exception as e:
+            log.limited(logging.ERROR, "batch_error", "[UWU_SERVICE] Error in batched %s request: %s", message["action"], e)
+            responses[index] = self.__error(message, str(e))
+
+    @staticmethod
+    def __error(message: dict, error: str) -> bytes:
+        return UWUProtocol.create_message(MessageType.RESPONSE, str(message.get("action")), message["peer_info"],
+                                          {"error": error})
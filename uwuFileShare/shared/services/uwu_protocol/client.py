@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from .enums import MessageType, EventAction, RequestAction, ResponseAction
+from .lanes import Overloaded
+from .protocol import UWUProtocol, FRAME_DELIMITER
+from .protocol_engine import MAX_FRAME_SIZE
+from .log import get_logger
+
+log = get_logger("client")
+
+
+class UWUClient:
+    """
+    A connection to a node that carries many requests at the same time.
+
+    Each request gets an id and a future in pending_responses, and is written ended by a newline without waiting for
+    the previous ones to be answered. A single reader task resolves the futures as the responses arrive, in whatever
+    order the node completes them. The node must run the PROTOCOL engine, the STREAMS engine reads one request per
+    connection.
+
+    The client connects on the first request and again after the connection was lost. It must be used from the loop
+    it was first used on.
+    """
+    def __init__(self, host: str, port: int, peer_info: dict, timeout: float = 10):
+        """
+        :param peer_info: Sent with every request, {"host": ..., "port": ...} of this node.
+        :param timeout: Default time to wait for a connection or a response, in seconds.
+        """
+        self.host = host
+        self.port = port
+        self.peer_info = peer_info
+        self.timeout = timeout
+        self.pending_responses: Dict[int, asyncio.Future] = {}
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connect_lock = asyncio.Lock()
+
+    def is_connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.is_connected():
+                return
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, limit=MAX_FRAME_SIZE), self.timeout
+            )
+            self._read_task = asyncio.create_task(self.__read_responses(self._reader, self._writer))
+
+    async def request(self, action: str, data: dict, timeout: float = None) -> dict:
+        """
+        Sends a request and waits for its response. The timeout is sent with the request, so the node doesn't work on
+        it once the client stopped waiting.
+        :param timeout: Time to wait for the response, the client default if None.
+        :return: The response message.
+        :raises Overloaded: The node turned the request away, overloaded or over the rate it allows this client, it
+        may be retried after e.retry_after seconds.
+        :raises asyncio.TimeoutError: No response in time, or the node couldn't handle it in time.
+        """
+        await self.connect()
+        timeout = timeout or self.timeout
+        request_id = UWUProtocol.next_request_id()
+        message = UWUProtocol.create_message(MessageType.REQUEST, action, self.peer_info, data, request_id=request_id,
+                                             timeout=timeout)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending_responses[request_id] = future
+        try:
+            self._writer.write(message + FRAME_DELIMITER)
+            await self._writer.drain()
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending_responses.pop(request_id, None)
+
+        if response.get("action") in (ResponseAction.OVERLOADED, ResponseAction.THROTTLED):
+            raise Overloaded(response.get("data", {}).get("retry_after", 1.0))
+        if response.get("action") == ResponseAction.DEADLINE_EXCEEDED:
+            raise asyncio.TimeoutError(f"{action} request not handled in time by {self.host}:{self.port}")
+        return response
+
+    async def batch(self, requests: List[dict], timeout: float = None) -> List[Optional[dict]]:
+        """
+        Sends many requests in a single BATCH request, one round trip for all of them.
+        :param requests: Built with UWUProtocol.create_sub_request.
+        :return: The response of each request in the same order, None for events.
+        """
+        response = await self.request(RequestAction.BATCH, {"requests": requests}, timeout)
+        data = response.get("data", {})
+        if "error" in data:
+            raise ValueError(f"[UWU_CLIENT] Batch refused by {self.host}:{self.port}: {data['error']}")
+        return data["responses"]
+
+    async def send_event(self, action: EventAction, data: dict):
+        """
+        Sends an event, events are not answered.
+        """
+        await self.connect()
+        self._writer.write(UWUProtocol.create_message(MessageType.EVENT, action, self.peer_info, data) + FRAME_DELIMITER)
+        await self._writer.drain()
+
+    async def close(self):
+        writer, read_task = self._writer, self._read_task
+        self._writer = self._reader = self._read_task = None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+        if read_task is not None:
+            read_task.cancel()
+            try:
+                await read_task
+            except asyncio.CancelledError:
+                pass
+        self.__fail_pending(ConnectionError(f"Connection to {self.host}:{self.port} closed"))
+
+    async def __read_responses(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        error = None
+        try:
+            while True:
+                frame = await reader.readuntil(FRAME_DELIMITER)
+                try:
+                    message = UWUProtocol.parse_message(frame)
+                except ValueError as e:
+                    log.limited(logging.WARNING, "invalid", "[UWU_CLIENT] Invalid response from %s:%s: %s", self.host,
+                                self.port, e)
+                    continue
+
+                future = self.pending_responses.pop(message.get("id"), None)
+                if future is None:
+                    # Its request timed out meanwhile
+                    log.limited(logging.INFO, "unknown", "[UWU_CLIENT] Response to unknown request %s from %s:%s",
+                                message.get("id"), self.host, self.port)
+                elif not future.done():
+                    future.set_result(message)
+        except asyncio.IncompleteReadError:
+            error = ConnectionError(f"Connection to {self.host}:{self.port} closed by the node")
+        except (asyncio.LimitOverrunError, OSError) as e:
+            error = ConnectionError(f"Connection to {self.host}:{self.port} failed: {e}")
+        finally:
+            writer.close()
+            if error is not None:
+                self.__fail_pending(error)
+
+    def __fail_pending(self, error: Exception):
+        pending, self.pending_responses = self.pending_responses, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
@@ -10,6 +10,9 @@ class RequestAction(str, Enum):
     REGISTER = "register"
     GET_DHT = "get_dht"
     GET_FILE = "get_file"
+    GET_PROVIDERS = "get_providers"
+    BATCH = "batch"
+    STATS = "stats"
 
 
 class ResponseAction(str, Enum):
@@ -18,7 +21,13 @@ class ResponseAction(str, Enum):
     """
     GET_DHT = "get_dht"
     GET_FILE = "get_file"
+    GET_PROVIDERS = "get_providers"
     REGISTER = "register"
+    BATCH = "batch"
+    STATS = "stats"
+    OVERLOADED = "overloaded"  # Turned away before it started, data["retry_after"] tells when to try again
+    THROTTLED = "throttled"  # Over the rate allowed to the sender, data["retry_after"] tells when to try again
+    DEADLINE_EXCEEDED = "deadline_exceeded"  # Not done before the timeout of the request
 
 class EventAction(str, Enum):
     """
@@ -26,4 +35,36 @@ class EventAction(str, Enum):
     to the informant node.
     """
     PEER_JOINED = "peer_joined"
-    PEER_LEFT = "peer_left"
\ No newline at end of file
+    PEER_LEFT = "peer_left"
+
+
+class Codec(str, Enum):
+    """
+    Serialization format of a message payload.
+    """
+    JSON = "json"
+
+
+class Compression(str, Enum):
+    """
+    Compression applied to an encoded message, requested by the client in the request data.
+    """
+    NONE = "none"
+    ZLIB = "zlib"
+
+
+class ServiceEngine(str, Enum):
+    """
+    Transport engine of a UWUService.
+    """
+    STREAMS = "streams"  # asyncio.start_server, a StreamReader/StreamWriter and a coroutine per connection
+    PROTOCOL = "protocol"  # asyncio.Protocol, frames parsed as they arrive and handlers dispatched directly
+
+
+class Lane(str, Enum):
+    """
+    Scheduling lane of a handler, declared in bind(). Each lane has its own concurrency limit and weight.
+    """
+    CONTROL = "control"  # Registrations, membership events
+    LOOKUP = "lookup"  # Small latency sensitive reads
+    BULK = "bulk"  # Large responses and transfers
@@ -4,30 +4,125 @@ This module defines the UWU protocol for communication between nodes in the netw
 UWUProtocol has RequestTypes and ResponseTypes enums to define the types of requests and responses that can be sent.
 It provides methods to create requests and responses, parse incoming messages, and validate the format of requests and responses.
 
-The protocol uses JSON for message formatting, and all messages are encoded to bytes before transmission.
+The protocol uses JSON for message formatting, and all messages are encoded to bytes before transmission. Encoded
+messages may optionally be compressed with zlib, parse_message detects it by the zlib header since a plain JSON message
+always starts with "{". A plain JSON message never contains a raw newline, so requests can also be delimited by one.
+
+Requests and events carry an "id", and a response carries the id of the request it answers. A client can then send many
+requests on one connection, each ended by a newline, and match the responses as they come back in any order.
+
+A request may carry a "timeout", the seconds its sender waits for the response. The receiver doesn't start it once
+they are over, and answers an OVERLOADED response with data["retry_after"] (seconds) when it has too much work queued.
+
+A BATCH request carries an ordered list of sub-requests in data["requests"], each {"type", "action", "data"}, and is
+answered by a single response with their responses in the same order in data["responses"] (null for events).
 
 Each request and response function/callback is defined in the RequestFunctions class, which is responsible for handling
 specific request types (defined by the user).
 """
-from .enums import MessageType, RequestAction, ResponseAction, EventAction
+from .enums import MessageType, RequestAction, ResponseAction, EventAction, Codec, Compression
+import itertools
 import json
+import zlib
+
+ZLIB_HEADER = 0x78
+# Ends a message on a connection that carries several of them
+FRAME_DELIMITER = b"\n"
+
+_request_ids = itertools.count(1)
 
 
 class UWUProtocol:
     @staticmethod
-    def create_message(msg_type: MessageType, action: str, peer_info: dict, data: dict) -> bytes:
-        return json.dumps({
+    def create_message(msg_type: MessageType, action: str, peer_info: dict, data: dict,
+                       codec: Codec = Codec.JSON, compression: Compression = Compression.NONE,
+                       request_id: int = None, timeout: float = None) -> bytes:
+        """
+        Builds and encodes a message.
+        :param request_id: Id of the message, requests and events get a new one if None. A response takes the id of
+        the request it answers.
+        :param timeout: Seconds the sender of a request waits for its response, the deadline of the request.
+        """
+        message = {
             "type": msg_type.value,
             "action": action,
             "peer_info": peer_info,
             "data": data
-        }).encode()
+        }
+        if request_id is None and msg_type in (MessageType.REQUEST, MessageType.EVENT):
+            request_id = UWUProtocol.next_request_id()
+        if request_id is not None:
+            message["id"] = request_id
+        if timeout is not None:
+            message["timeout"] = timeout
+        return UWUProtocol.encode(message, codec, compression)
+
+    @staticmethod
+    def create_sub_request(msg_type: MessageType, action: str, data: dict) -> dict:
+        """
+        Builds an entry of the requests list of a BATCH request.
+        """
+        return {"type": msg_type.value, "action": action, "data": data}
+
+    @staticmethod
+    def create_batch_response(peer_info: dict, responses: list) -> bytes:
+        """
+        Encodes the response of a BATCH request.
+        :param responses: The encoded plain JSON response of each sub-request, or None. They are embedded as they are,
+        not parsed and serialized again.
+        """
+        envelope = UWUProtocol.create_message(MessageType.RESPONSE, ResponseAction.BATCH, peer_info,
+                                              {"responses": None})
+        # "data" is the last key and "responses" its only one, so the envelope ends with the placeholder
+        head = envelope[:envelope.rindex(b"null")]
+        body = b", ".join(b"null" if response is None else response for response in responses)
+        return head + b"[" + body + b"]}}"
+
+    @staticmethod
+    def next_request_id() -> int:
+        return next(_request_ids)
+
+    @staticmethod
+    def with_request_id(raw: bytes, request_id: int) -> bytes:
+        """
+        Sets the id of an encoded JSON message without parsing it again, for responses that are encoded once and
+        served to many requests. The id is added as the last key, so it replaces any id the message already had.
+        """
+        return raw[:raw.rindex(b"}")] + b', "id": ' + json.dumps(request_id).encode() + b"}"
+
+    @staticmethod
+    def is_compressed(raw: bytes) -> bool:
+        return bool(raw) and raw[0] == ZLIB_HEADER
+
+    @staticmethod
+    def encode(message: dict, codec: Codec = Codec.JSON, compression: Compression = Compression.NONE) -> bytes:
+        """
+        Encodes an already built message to bytes.
+        :param message: Message dict (type, action, peer_info, data).
+        :param codec: Serialization format.
+        :param compression: Compression applied after serializing.
+        :return: The encoded message.
+        """
+        if codec != Codec.JSON:
+            raise ValueError(f"[PROTOCOL] Unsupported codec: {codec}")
+
+        raw = json.dumps(message).encode()
+
+        if compression == Compression.ZLIB:
+            return zlib.compress(raw)
+        return raw
 
     @staticmethod
-    def parse_message(raw: bytes) -> dict:
+    def parse_message(raw) -> dict:
+        """
+        Parses a received message.
+        :param raw: Any bytes-like object, a memoryview over a receive buffer is decoded without copying it first.
+        """
         try:
-            return json.loads(raw.decode())
-        except json.JSONDecodeError:
+            if UWUProtocol.is_compressed(raw):
+                raw = zlib.decompress(raw)
+            return json.loads(str(raw, "utf-8"))
+        except (UnicodeDecodeError, json.JSONDecodeError, zlib.error):
             raise ValueError("[PROTOCOL] Invalid JSON format")
 
     @staticmethod
@@ -38,6 +133,7 @@ class UWUProtocol:
             "action" in msg and
             "data" in msg and
             "peer_info" in msg and
+            isinstance(msg["type"], str) and isinstance(msg["action"], str) and
             msg["type"] in MessageType._value2member_map_ and
             UWUProtocol._is_valid_action(msg["action"])
         )
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+
+from .log import get_logger
+
+# Longest request accepted, a client sending more without ending the frame is disconnected
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+log = get_logger("service")
+
+
+class TransportWriter:
+    """
+    The writer handed to the handlers by the protocol engine. It has the part of the asyncio.StreamWriter interface the
+    handlers use, on top of the transport of the connection.
+    """
+    __slots__ = ("_protocol", "transport")
+
+    def __init__(self, protocol: "UWUServerProtocol", transport: asyncio.Transport):
+        self._protocol = protocol
+        self.transport = transport
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writelines(self, data):
+        self.transport.writelines(data)
+
+    def can_write_eof(self) -> bool:
+        return self.transport.can_write_eof()
+
+    def write_eof(self):
+        self.transport.write_eof()
+
+    def close(self):
+        self.transport.close()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    async def wait_closed(self):
+        await self._protocol.closed
+
+    async def drain(self):
+        if self.transport.is_closing():
+            # Let the connection_lost callback run, as StreamWriter.drain does
+            await asyncio.sleep(0)
+        await self._protocol.wait_writable()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+
+class UWUServerProtocol(asyncio.Protocol):
+    """
+    Connection of the protocol engine of a UWUService.
+
+    The bytes received are buffered and cut into frames as they arrive: a frame ends at a newline, or at the end of the
+    stream for a client that sends a single request and then closes its side. Frames are parsed from memoryviews over
+    the receive buffer and their handler is scheduled right away, there is no reader coroutine per connection, so the
+    requests of a connection run concurrently and their responses go out as they complete. Handlers get None as
+    reader. The connection is closed once the client finished sending and every handler of it is done.
+    """
+    def __init__(self, service):
+        self._service = service
+        self._loop = asyncio.get_running_loop()
+        self._transport = None
+        self._writer = None
+        self._buffer = bytearray()
+        self._scanned = 0  # Bytes of the buffer already searched for a newline
+        self._pending = 0  # Handlers still running
+        self._eof = False
+        self._paused = False
+        self._drain_waiters = []
+        self._admitted = False
+        self.closed = self._loop.create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+        self._writer = TransportWriter(self, transport)
+        self._admitted = self._service.admit_connection(self._writer)
+        if not self._admitted:
+            transport.close()
+
+    def data_received(self, data: bytes):
+        buffer = self._buffer
+        if buffer:
+            buffer += data
+            data = buffer
+        scan_from = self._scanned if data is buffer else 0
+
+        start = 0
+        with memoryview(data) as view:
+            while (end := data.find(b"\n", scan_from)) != -1:
+                if end > start:
+                    with view[start:end] as frame:
+                        self.__dispatch(frame)
+                start = scan_from = end + 1
+
+            if data is not buffer and start < len(data):
+                buffer += view[start:]
+
+        if data is buffer:
+            del buffer[:start]
+        self._scanned = len(buffer)
+
+        if len(buffer) > MAX_FRAME_SIZE:
+            log.limited(logging.WARNING, "frame_size", "[UWU_SERVICE] Frame over %d bytes, closing the connection",
+                        MAX_FRAME_SIZE)
+            buffer.clear()
+            self._transport.close()
+
+    def eof_received(self):
+        self._eof = True
+        if self._buffer:
+            with memoryview(self._buffer) as frame:
+                self.__dispatch(frame)
+            self._buffer.clear()
+            self._scanned = 0
+        # Keep the connection half open while the handlers answer
+        return self._pending > 0
+
+    def connection_lost(self, exc):
+        if self._admitted:
+            self._admitted = False
+            self._service.connection_closed(self._writer)
+        if not self.closed.done():
+            self.closed.set_result(None)
+        self._paused = False
+        self.__wake_writers(exc)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self.__wake_writers(None)
+
+    async def wait_writable(self):
+        if self._transport.is_closing() and self.closed.done():
+            raise ConnectionResetError("Connection lost")
+        if not self._paused:
+            return
+        waiter = self._loop.create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    def __wake_writers(self, exc):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(ConnectionResetError(str(exc)))
+
+    def __dispatch(self, frame: memoryview):
+        try:
+            route = self._service.route(frame)
+        except Exception as e:
+            log.limited(logging.ERROR, "error", "[UWU_SERVICE] Error handling client: %s", e)
+            return
+        if route is None:
+            return
+
+        handler, message = route
+        self._pending += 1
+        task = self._loop.create_task(
+            self._service.dispatch(handler, message, None, self._service.reply_writer(message, self._writer))
+        )
+        task.add_done_callback(self.__on_handler_done)
+
+    def __on_handler_done(self, task: asyncio.Task):
+        self._pending -= 1
+        if not task.cancelled() and task.exception() is not None:
+            log.limited(logging.ERROR, "error", "[UWU_SERVICE] Error handling client: %s", task.exception())
+        if self._eof and not self._pending:
+            self._transport.close()
@@ -1,19 +1,140 @@
 import json
 import asyncio
+import logging
 import threading
-from typing import Tuple
+import time
+import zlib
+from collections import Counter
+from typing import Optional, Tuple
+
+from .protocol import UWUProtocol, FRAME_DELIMITER
+from .base_handler import UWUHandlerBase, read_only
+from .enums import ServiceEngine, MessageType, RequestAction, ResponseAction, Lane
+from .batch import BatchRunner
+from .protocol_engine import UWUServerProtocol
+from .lanes import LaneScheduler, Overloaded, LANE_URGENCY, MAX_CONCURRENT, MAX_QUEUED
+from .log import get_logger, Summary
+from ..runtime import NodeRuntime
+from ..scheduler import PeriodicScheduler, Overlap
+from ..rate_limit import PeerLimiter, RequestTooLarge
+from ..metrics import MetricsRegistry, MetricsServer
+
+log = get_logger("service")
+
+class ReplyWriter:
+    """
+    Writer given to the handler of a request that has an id. Every write is taken as one response message: the id of
+    the request is set on it and it is ended with a newline, so a client with many requests in flight on the same
+    connection can tell the responses apart. The connection belongs to the service, close() only ends the reply.
+
+    A compressed response can't carry the id nor be delimited, since the delimiter may appear in the zlib stream, so
+    it is decompressed and written as plain JSON. Handlers should not compress a response to a request with an id.
+    """
+    __slots__ = ("_writer", "request_id", "sent")
+
+    def __init__(self, writer, request_id: int):
+        self._writer = writer
+        self.request_id = request_id
+        self.sent = 0  # Bytes written
+
+    def write(self, data: bytes):
+        if UWUProtocol.is_compressed(data):
+            data = zlib.decompress(data)
+        data = UWUProtocol.with_request_id(data, self.request_id) + FRAME_DELIMITER
+        self.sent += len(data)
+        self._writer.write(data)
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def is_closing(self) -> bool:
+        return self._writer.is_closing()
+
+    def get_extra_info(self, name, default=None):
+        return self._writer.get_extra_info(name, default)
+
+
+class CountingWriter:
+    """
+    Writer given to the handler of a request without an id, it writes straight to the connection and counts the bytes
+    written.
+    """
+    __slots__ = ("_writer", "sent")
+
+    def __init__(self, writer):
+        self._writer = writer
+        self.sent = 0  # Bytes written
+
+    def write(self, data: bytes):
+        self.sent += len(data)
+        self._writer.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+class ServiceMetrics:
+    """
+    The metrics a service records around the dispatch of its requests, see metrics.MetricsRegistry.
+    """
+    def __init__(self, registry: MetricsRegistry, lanes: LaneScheduler):
+        self.requests = registry.counter("uwu_requests_total", "Requests received, by action and lane",
+                                         ("action", "lane"))
+        self.errors = registry.counter("uwu_request_errors_total", "Handlers that raised, by action", ("action",))
+        self.timeouts = registry.counter("uwu_request_timeouts_total",
+                                         "Requests not done before their deadline, by action", ("action",))
+        self.rejected = registry.counter("uwu_requests_rejected_total",
+                                         "Requests turned away before they ran, by action and reason",
+                                         ("action", "reason"))
+        self.latency = registry.histogram("uwu_request_seconds", "Time spent in the handlers, by action", ("action",))
+        self.queue_wait = registry.histogram("uwu_queue_wait_seconds", "Time waited for a handler slot, by lane",
+                                             ("lane",))
+        self.received = registry.counter("uwu_received_bytes_total", "Bytes of the requests received, by action",
+                                         ("action",))
+        self.sent = registry.counter("uwu_sent_bytes_total", "Bytes of the responses sent, by action", ("action",))
+        self.connections = registry.gauge("uwu_connections_open", "Client connections open").labels()
+
+        queued = registry.gauge("uwu_queue_depth", "Requests waiting for a handler slot, by lane", ("lane",))
+        running = registry.gauge("uwu_requests_in_flight", "Handlers running, by lane", ("lane",))
+        for lane in lanes.limits:
+            queued.labels(lane=lane).set_function(lambda lane=lane: lanes.waiting(lane))
+            running.labels(lane=lane).set_function(lambda lane=lane: lanes.active[lane])
 
-from .protocol import UWUProtocol
-from .base_handler import UWUHandlerBase
 
 class UWUService:
-    def __init__(self, host="0.0.0.0", port=6000, handler: UWUHandlerBase = None, periodical_tasks_cbk: Tuple[callable, int] = None):
+    def __init__(self, host="0.0.0.0", port=6000, handler: UWUHandlerBase = None, periodical_tasks_cbk: Tuple[callable, int] = None,
+                 runtime: NodeRuntime = None, reuse_port: bool = False, engine: ServiceEngine = ServiceEngine.STREAMS,
+                 lanes: dict = None, max_in_flight: int = MAX_CONCURRENT, max_queued: int = MAX_QUEUED, backlog: int = 100,
+                 peer_limits: PeerLimiter = None, metrics: MetricsRegistry = None, metrics_port: int = None,
+                 metrics_host: str = "127.0.0.1"):
         """
         Initializes the UWUService with the given parameters.
         :param host:
         :param port:
         :param handler:
-        :param periodical_tasks_cbk: A tuple containing a callback function and an interval in seconds.
+        :param periodical_tasks_cbk: A tuple containing a callback function and an interval in seconds. The callback
+        may return the delay before its next run instead.
+        :param runtime: Runtime of the node, the server runs on its loop. A runtime of its own is created if None.
+        :param reuse_port: Bind with SO_REUSEPORT, so several processes can listen on the same port and the kernel
+        spreads the connections between them.
+        :param engine: Transport engine. STREAMS reads each connection with a coroutine until the client closes its
+        side, PROTOCOL parses newline or end of stream delimited requests as they arrive on an asyncio.Protocol and
+        dispatches them straight to the handlers, which is much cheaper for small requests.
+        :param lanes: Lane -> (concurrency limit, weight) of the lanes the handlers declare in bind(), overriding
+        lanes.DEFAULT_LANES.
+        :param max_in_flight: Requests handled at the same time.
+        :param max_queued: Requests waiting for a handler slot, the ones past it get an OVERLOADED response.
+        :param backlog: Connections the kernel keeps waiting to be accepted.
+        :param peer_limits: Request rates and connections allowed to each client address, no limit if None.
+        :param metrics: Registry of the node the service records its metrics in, a registry of its own if None.
+        :param metrics_port: Port of an HTTP endpoint serving the metrics in the Prometheus format on metrics_host,
+        none if None. The STATS request returns them in any case.
         """
         if handler is None:
             raise ValueError("Handler must be provided.")
@@ -21,12 +142,45 @@ class UWUService:
         self.host = host
         self.port = port
         self.server = None
-        self.loop = None
+        self.runtime = runtime or NodeRuntime(name=f"uwu_service_{port}")
+        self.reuse_port = reuse_port
+        self.engine = ServiceEngine(engine)
         self.server_ready = threading.Event()
         self.handler = handler
-        self.handlers = self.handler.bind()
+        # bind() maps a request to its handler, or to (handler, Lane)
+        self.handlers = {}
+        self.handler_lanes = {}
+        for key, bound in self.handler.bind().items():
+            self.handlers[key], self.handler_lanes[key] = bound if isinstance(bound, tuple) else (bound, Lane.CONTROL)
+        self.lanes = LaneScheduler(lanes, max_concurrent=max_in_flight, max_queued=max_queued)
+        self.backlog = backlog
+        self.peer_limits = peer_limits
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.stats = ServiceMetrics(self.metrics, self.lanes)
+        self.metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port) if metrics_port else None
+        # Every service answers BATCH and STATS requests, with the handlers above
+        self.batches = BatchRunner(self.handlers)
+        self.handlers.setdefault((MessageType.REQUEST, RequestAction.BATCH), self.handle_batch)
+        self.handlers.setdefault((MessageType.REQUEST, RequestAction.STATS), self.handle_stats)
+        # Periodic tasks of the node, run on the service loop while the server is up
+        self.scheduler = PeriodicScheduler()
         self.periodical_tasks = periodical_tasks_cbk[0] if periodical_tasks_cbk is not None else None
         self.periodical_interval = 0 if periodical_tasks_cbk is None else periodical_tasks_cbk[1]
+        if self.periodical_tasks and self.periodical_interval > 0:
+            self.schedule("periodical_tasks", self.periodical_tasks, self.periodical_interval)
+
+    def schedule(self, name: str, callback, interval: float, jitter: float = 0.0, overlap: Overlap = Overlap.SKIP,
+                 timeout: float = None):
+        """
+        Runs callback() every interval seconds while the server is up, see PeriodicScheduler.add. Once the service is
+        running, it must be called from its loop.
+        """
+        self.scheduler.add(name, callback, interval, jitter=jitter, overlap=overlap, timeout=timeout)
+        print(f"[UWU_SERVICE] Periodic task {name} scheduled every {interval} seconds.")
+
+    @property
+    def loop(self):
+        return self.runtime.loop
 
     def is_running(self):
         """
@@ -35,32 +189,221 @@ class UWUService:
         """
         return self.server is not None and self.server.is_serving()
 
-    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    def route(self, data) -> Optional[Tuple[callable, dict]]:
+        """
+        Parses a received request and finds its handler.
+        :param data: The request, any bytes-like object.
+        :return: (handler, message), or None if the message is invalid or nothing handles it.
+        """
+        # Message is the unit of communication (so the data needs to be decoded from bytes to json)
+        message = UWUProtocol.parse_message(data)
+
+        if not UWUProtocol.is_valid(message):
+            log.limited(logging.WARNING, "invalid", "[UWU_SERVICE] Invalid message received: %s", Summary(data))
+            return None
+
+        log.debug("[UWU_SERVICE] Message received: %s", Summary(message, data))
+
+        handler = self.handlers.get((message["type"], message["action"]))
+
+        if not handler:
+            log.limited(logging.WARNING, "no_handler", "[UWU_SERVICE] No handler for message type: %s",
+                        (message["type"], message["action"]))
+            return None
+
+        self.stats.received.labels(action=message["action"]).inc(len(data))
 
-        print(f"[UWU_SERVICE] Handling client connection")
+        return handler, message
+
+    def lane_of(self, message: dict) -> Lane:
+        """
+        Returns the lane of a request, the least urgent lane of its sub-requests for a BATCH.
+        """
+        key = (message["type"], message["action"])
+        if key in self.handler_lanes:
+            return self.handler_lanes[key]
+        if message["action"] != RequestAction.BATCH:
+            return Lane.CONTROL
+
+        lanes = {Lane.LOOKUP}
+        for request in (message.get("data") or {}).get("requests") or []:
+            if isinstance(request, dict) and UWUProtocol.is_valid({"data": None, "peer_info": None, **request}):
+                lanes.add(self.handler_lanes.get((request["type"], request["action"]), Lane.CONTROL))
+        return max(lanes, key=LANE_URGENCY.index)
+
+    async def dispatch(self, handler, message: dict, reader, writer):
+        """
+        Runs the handler of a request once its lane has a free slot, within the timeout of the request if it has one.
 
+        A request is answered right away with OVERLOADED when too many requests wait already, and with
+        DEADLINE_EXCEEDED when its timeout is over before it starts or before its handler is done, the handler is then
+        cancelled: its client has given up on it.
+
+        Every request is counted in the metrics of the service, with the time it waited and the time its handler took.
+        """
+        action = message["action"]
+        lane = self.lane_of(message)
+        stats = self.stats
+        stats.requests.labels(action=action, lane=lane).inc()
         try:
-            data = await reader.read()
-            if not data:
-                return
+            if self.peer_limits is not None:
+                peer = PeerLimiter.peer_of(writer, message)
+                try:
+                    retry_after = self.peer_limits.admit(peer, self.__actions_of(message))
+                except RequestTooLarge as e:
+                    log.limited(logging.WARNING, "too_large", "[UWU_SERVICE] Refusing %s request from %s: %s", action,
+                                peer, e)
+                    stats.rejected.labels(action=action, reason="too_large").inc()
+                    await self.__reject(message, writer, action, {"error": str(e)})
+                    return
+                if retry_after:
+                    log.limited(logging.WARNING, "throttled", "[UWU_SERVICE] Throttling %s request from %s", action,
+                                peer)
+                    stats.rejected.labels(action=action, reason=ResponseAction.THROTTLED).inc()
+                    await self.__reject(message, writer, ResponseAction.THROTTLED, {"retry_after": round(retry_after, 3)})
+                    return
 
-            # Message is the unit of communication (so the data needs to be decoded from bytes to json)
-            message = UWUProtocol.parse_message(data)
+            timeout = message.get("timeout")
+            deadline = time.monotonic() + timeout if isinstance(timeout, (int, float)) else None
 
-            if not UWUProtocol.is_valid(message):
-                print("[UWU_SERVICE] Invalid message received")
+            queued = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.lanes.acquire(lane), self.__remaining(deadline))
+            except Overloaded as e:
+                log.limited(logging.WARNING, "overloaded", "[UWU_SERVICE] Overloaded, turning away %s request", action)
+                stats.rejected.labels(action=action, reason=ResponseAction.OVERLOADED).inc()
+                await self.__reject(message, writer, ResponseAction.OVERLOADED, {"retry_after": e.retry_after})
+                return
+            except asyncio.TimeoutError:
+                log.limited(logging.WARNING, "expired", "[UWU_SERVICE] %s request expired while queued", action)
+                stats.timeouts.labels(action=action).inc()
+                await self.__reject(message, writer, ResponseAction.DEADLINE_EXCEEDED, {})
                 return
 
-            print("[UWU_SERVICE] Message received:", message)
+            started = time.perf_counter()
+            stats.queue_wait.labels(lane=lane).observe(started - queued)
+            try:
+                return await asyncio.wait_for(handler(message, reader, writer), self.__remaining(deadline))
+            except asyncio.TimeoutError:
+                log.limited(logging.WARNING, "deadline", "[UWU_SERVICE] %s request not done before its deadline",
+                            action)
+                stats.timeouts.labels(action=action).inc()
+                await self.__reject(message, writer, ResponseAction.DEADLINE_EXCEEDED, {})
+            except Exception:
+                stats.errors.labels(action=action).inc()
+                raise
+            finally:
+                self.lanes.release(lane)
+                stats.latency.labels(action=action).observe(time.perf_counter() - started)
+        finally:
+            stats.sent.labels(action=action).inc(getattr(writer, "sent", 0))
 
-            handler = self.handlers.get((message["type"], message["action"]))
+    @staticmethod
+    def __actions_of(message: dict) -> Counter:
+        """
+        Counts the requests a message carries by action, the sub-requests for a BATCH. The actions of the sub-requests
+        come from the client as they are, unknown ones are counted as rate_limit.INVALID_ACTION.
+        """
+        if message["action"] != RequestAction.BATCH:
+            return Counter({PeerLimiter.action_key(message["action"]): 1})
+        requests = (message.get("data") or {}).get("requests")
+        actions = Counter(PeerLimiter.action_key(request.get("action")) for request in requests
+                          if isinstance(request, dict)) if isinstance(requests, list) else Counter()
+        actions[RequestAction.BATCH.value] += 1
+        return actions
 
-            if not handler:
-                print(f"[UWU_SERVICE] No handler for message type: {message['type'], message['action']}")
+    def admit_connection(self, writer) -> bool:
+        """
+        Counts a new connection against the limits of its address.
+        :return: False if it must be closed right away.
+        """
+        if self.peer_limits is None:
+            self.stats.connections.inc()
+            return True
+        address = PeerLimiter.address_of(writer)
+        if self.peer_limits.open_connection(address):
+            self.stats.connections.inc()
+            return True
+        log.limited(logging.WARNING, "connections", "[UWU_SERVICE] Too many connections from %s, refusing a new one",
+                    address)
+        return False
+
+    def connection_closed(self, writer):
+        """
+        Ends a connection accepted by admit_connection.
+        """
+        self.stats.connections.dec()
+        if self.peer_limits is not None:
+            self.peer_limits.close_connection(PeerLimiter.address_of(writer))
+
+    @staticmethod
+    def __remaining(deadline: Optional[float]) -> Optional[float]:
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    @staticmethod
+    async def __reject(message: dict, writer, action: ResponseAction, data: dict):
+        """
+        Answers a request that wasn't handled, events are not answered.
+        """
+        if message["type"] != MessageType.REQUEST or writer.is_closing():
+            return
+        data = {"request": message["action"], **data}
+        writer.write(UWUProtocol.create_message(MessageType.RESPONSE, action, message.get("peer_info", {}), data))
+        await writer.drain()
+
+    async def handle_batch(self, message: dict, reader, writer):
+        """
+        Runs the sub-requests of a BATCH request and answers them with a single response.
+        """
+        response = await self.batches.run(message, writer)
+        writer.write(response)
+        await writer.drain()
+
+    @read_only
+    async def handle_stats(self, message: dict, reader, writer):
+        """
+        Answers a STATS request with the metrics of the node (see MetricsRegistry.collect), the state of the
+        lanes, the periodic tasks and the peer limits of the service, and the last stalls of its loop.
+        """
+        data = {
+            "metrics": self.metrics.collect(),
+            "lanes": self.lanes.stats(),
+            "periodic": self.scheduler.stats(),
+            "peer_limits": self.peer_limits.stats() if self.peer_limits is not None else None,
+            "loop": self.runtime.watchdog.stats() if self.runtime.watchdog is not None else None,
+        }
+        writer.write(UWUProtocol.create_message(MessageType.RESPONSE, ResponseAction.STATS, message.get("peer_info", {}),
+                                                data))
+        await writer.drain()
+
+    @staticmethod
+    def reply_writer(message: dict, writer):
+        """
+        Returns the writer the handler of a message answers with, both count the bytes written.
+        """
+        request_id = message.get("id")
+        return CountingWriter(writer) if request_id is None else ReplyWriter(writer, request_id)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+
+        log.debug("[UWU_SERVICE] Handling client connection")
+
+        if not self.admit_connection(writer):
+            writer.close()
+            return
+
+        try:
+            data = await reader.read()
+            if not data:
                 return
 
+            route = self.route(data)
+            if route is None:
+                return
+            handler, message = route
+
             # Once we have a handler we need to pass the message, reader and writer to it
-            result = await handler(message, reader, writer)
+            result = await self.dispatch(handler, message, reader, self.reply_writer(message, writer))
 
             # Once we have a result we need to do something with it, we should pass that result upper in the app layers,
             # maybe to the node cli or gui, etc. This action is defined on the type of message we are handling. If request
@@ -78,13 +421,25 @@ class UWUService:
             return
 
         except Exception as e:
-            print(f"[UWU_SERVICE] Error handling client: {e}")
+            log.limited(logging.ERROR, "error", "[UWU_SERVICE] Error handling client: %s", e)
+
+        finally:
+            # The response is complete once the handler returns, closing tells the client so
+            if not writer.is_closing():
+                writer.close()
+            self.connection_closed(writer)
 
     async def get_server(self):
         """
         Starts the server and returns it.
         """
-        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        if self.engine == ServiceEngine.PROTOCOL:
+            loop = asyncio.get_running_loop()
+            return await loop.create_server(lambda: UWUServerProtocol(self), self.host, self.port,
+                                            reuse_port=self.reuse_port or None, backlog=self.backlog)
+
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, reuse_port=self.reuse_port or None,
+                                            backlog=self.backlog)
         return server
 
     async def __start_server(self):
@@ -99,10 +454,12 @@ class UWUService:
         for key in self.handlers.keys():
             print(f"  - {key}")
 
-        # Schedule periodic task loop (customize interval)
-        if self.periodical_tasks and self.periodical_interval > 0:
-            print(f"[UWU_SERVICE] Periodic tasks scheduled every {self.periodical_interval} seconds.")
-            periodic_task = asyncio.create_task(self.__run_periodical_tasks_loop(interval=self.periodical_interval))
+        self.scheduler.start()
+        if self.metrics_server is not None:
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                print(f"[UWU_SERVICE] Metrics endpoint not started: {e}")
 
         try:
             async with self.server:
@@ -112,11 +469,10 @@ class UWUService:
         except Exception as e:
             print(f"[UWU_SERVICE] Exception in server loop: {e}")
         finally:
-            periodic_task.cancel()
-            try:
-                await periodic_task
-            except asyncio.CancelledError:
-                print("[UWU_SERVICE] Periodic tasks cancelled.")
+            await self.scheduler.stop()
+            print("[UWU_SERVICE] Periodic tasks cancelled.")
+            if self.metrics_server is not None:
+                await self.metrics_server.stop()
 
     async def __shutdown_server(self):
         """
@@ -128,43 +484,23 @@ class UWUService:
             await self.server.wait_closed()
             print("[UWU_SERVICE] Server shut down.")
 
-    def __server_thread_func(self):
-        """
-        Thread function to run the server loop.
-        """
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
-        try:
-            self.loop.run_until_complete(self.__start_server())
-        except Exception as e:
-            print(f"[ERROR] Server loop exception: {e}")
-        finally:
-            self.loop.close()
-
-    async def __run_periodical_tasks_loop(self, interval: int):
-        """
-        Runs the periodical_tasks() method every `interval` seconds.
-        """
-        print(f"[UWU_SERVICE] Periodic task loop started with interval = {interval}s")
-        try:
-            while True:
-                await asyncio.sleep(interval)
-                await self.periodical_tasks()
-        except asyncio.CancelledError:
-            print("[UWU_SERVICE] Periodic task loop cancelled.")
-
-
     def stop_service(self):
         """
         Shuts down the server safely.
         :return:
         """
-        if self.server and self.loop:
-            asyncio.run_coroutine_threadsafe(self.__shutdown_server(), self.loop)
+        if self.server and self.runtime.is_running():
+            self.runtime.submit(self.__shutdown_server())
 
     def start_service(self):
         """
-        Starts the server in a new thread.
+        Starts the server on the runtime loop, starting the runtime if needed.
         :return:
         """
-        threading.Thread(target=self.__server_thread_func, daemon=True).start()
+        self.runtime.start()
+        self.runtime.submit(self.__start_server()).add_done_callback(self.__on_server_done)
+
+    @staticmethod
+    def __on_server_done(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"[ERROR] Server loop exception: {future.exception()}")
@@ -0,0 +1,228 @@
+import logging
+import re
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+from collections import deque
+from typing import List, Optional
+
+from .metrics import MetricsRegistry
+
+# Seconds between two heartbeats of the loop
+HEARTBEAT_INTERVAL = 0.05
+# Lag past which the loop is stalled, the stack of its thread is then captured
+STALL_THRESHOLD = 0.25
+# Incidents kept, the oldest ones are dropped first
+MAX_INCIDENTS = 100
+# Frames kept in a captured stack, the innermost ones
+MAX_STACK_DEPTH = 30
+
+_STDLIB_PATHS = tuple({sysconfig.get_paths()["stdlib"], sysconfig.get_paths()["platstdlib"]})
+# asyncio formats a slow handle with the place its coroutine is defined at and the place it was created at, in debug
+# mode
+_DEFINED_AT = re.compile(r"defined at (.+?:\d+)")
+_CREATED_AT = re.compile(r"created at (.+?:\d+)")
+
+
+class Incident:
+    """
+    A stall of the loop, or a callback asyncio reported as slow.
+    """
+    __slots__ = ("kind", "started", "duration", "location", "stack", "detail")
+
+    def __init__(self, kind: str, started: float, location: str, stack: List[str], detail: str = "",
+                 duration: Optional[float] = None):
+        self.kind = kind  # "stall" or "slow_callback"
+        self.started = started  # Wall clock time
+        self.duration = duration  # Seconds, None while a stall goes on
+        self.location = location  # file:line of the code that blocked
+        self.stack = stack
+        self.detail = detail
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class LoopWatchdog:
+    """
+    Watches an event loop for blocking calls.
+
+    A heartbeat scheduled on the loop every interval seconds measures how late the loop runs it, that lag is recorded
+    in the uwu_loop_lag_seconds histogram. A monitor thread checks the heartbeat: once it is threshold seconds late,
+    the loop is stuck in a callback, and the stack of the loop thread is captured right then, so the incident points
+    at the blocking frame (a sync socket, a lock wait, a file write...) instead of at whatever runs next.
+
+    When the loop runs in debug mode, the slow callbacks asyncio reports are recorded too, with the place their
+    coroutine is defined at. Debug mode is costly, it is only turned on with slow_callbacks.
+
+    The last max_incidents incidents are kept, see incidents().
+    """
+    def __init__(self, name: str, interval: float = HEARTBEAT_INTERVAL, threshold: float = STALL_THRESHOLD,
+                 max_incidents: int = MAX_INCIDENTS, slow_callbacks: bool = False, metrics: MetricsRegistry = None):
+        """
+        :param name: Name of the loop, in the metrics and the logs.
+        :param interval: Seconds between two heartbeats.
+        :param threshold: Lag past which the loop is stalled, also the duration of a slow callback.
+        :param max_incidents: Incidents kept.
+        :param slow_callbacks: Run the loop in debug mode and record the slow callbacks asyncio reports.
+        :param metrics: Registry of the node the watchdog records in, a registry of its own if None.
+        """
+        self.name = name
+        self.interval = interval
+        self.threshold = threshold
+        self.slow_callbacks = slow_callbacks
+        self.stalls = 0
+        self.max_lag = 0.0
+        self._incidents = deque(maxlen=max_incidents)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._loop_thread_id = None
+        self._expected = 0.0  # Monotonic time the next heartbeat is due
+        self._stall: Optional[Incident] = None  # The stall going on, captured by the monitor
+        self._timer = None
+        self._monitor = None
+        self._stopped = threading.Event()
+        self._log_handler = None
+
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        self._lag = metrics.histogram("uwu_loop_lag_seconds", "Delay of the loop heartbeats, by loop",
+                                      ("loop",)).labels(loop=name)
+        self._stall_count = metrics.counter("uwu_loop_stalls_total", "Stalls of the loop, by loop",
+                                            ("loop",)).labels(loop=name)
+        self._slow_callback_count = metrics.counter("uwu_loop_slow_callbacks_total",
+                                                    "Slow callbacks reported by asyncio, by loop",
+                                                    ("loop",)).labels(loop=name)
+
+    def start(self, loop):
+        """
+        Starts watching a loop, from the loop thread.
+        """
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self.__schedule()
+
+        if self.slow_callbacks:
+            loop.set_debug(True)
+        if loop.get_debug():
+            loop.slow_callback_duration = self.threshold
+            self._log_handler = _SlowCallbackHandler(self)
+            logging.getLogger("asyncio").addHandler(self._log_handler)
+
+        self._monitor = threading.Thread(target=self.__watch, name=f"{self.name}_watchdog", daemon=True)
+        self._monitor.start()
+
+    def stop(self):
+        """
+        Stops watching, from the loop thread.
+        """
+        self._stopped.set()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._log_handler is not None:
+            logging.getLogger("asyncio").removeHandler(self._log_handler)
+            self._log_handler = None
+
+    def incidents(self, limit: int = None) -> List[dict]:
+        """
+        Returns the last incidents, oldest first, from any thread.
+        """
+        with self._lock:
+            incidents = [incident.as_dict() for incident in self._incidents]
+        return incidents[-limit:] if limit else incidents
+
+    def stats(self, limit: int = 10) -> dict:
+        """
+        :return: Counters of the watchdog, the lag quantiles in seconds and the last limit incidents.
+        """
+        return {
+            "stalls": self.stalls,
+            "slow_callbacks": self._slow_callback_count.value,
+            "max_lag": self.max_lag,
+            "lag": self._lag.snapshot(),
+            "incidents": self.incidents(limit),
+        }
+
+    def record_slow_callback(self, duration: float, detail: str):
+        """
+        Records a slow callback asyncio reported.
+        """
+        found = _DEFINED_AT.search(detail) or _CREATED_AT.search(detail)
+        self._slow_callback_count.inc()
+        self.__add(Incident("slow_callback", time.time() - duration, found.group(1) if found else "", [], detail,
+                            duration))
+
+    def __schedule(self):
+        self._expected = time.monotonic() + self.interval
+        self._timer = self._loop.call_later(self.interval, self.__beat)
+
+    def __beat(self):
+        lag = max(0.0, time.monotonic() - self._expected)
+        self._lag.observe(lag)
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+        with self._lock:
+            stall, self._stall = self._stall, None
+            if stall is not None:
+                stall.duration = lag
+        if stall is not None:
+            print(f"[WATCHDOG] {self.name} loop blocked for {lag:.3f}s at {stall.location}")
+
+        if not self._stopped.is_set():
+            self.__schedule()
+
+    def __watch(self):
+        """
+        Monitor thread, captures the stack of the loop thread once a heartbeat is threshold seconds late.
+        """
+        while not self._stopped.wait(min(self.interval, self.threshold / 2)):
+            late = time.monotonic() - self._expected
+            if late < self.threshold or self._stall is not None:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)[-MAX_STACK_DEPTH:]
+            del frame
+            with self._lock:
+                if self._stall is None and time.monotonic() - self._expected >= self.threshold:
+                    self._stall = Incident("stall", time.time() - late, self.__location(stack),
+                                           traceback.format_list(stack))
+                    self.stalls += 1
+                    self._stall_count.inc()
+                    self._incidents.append(self._stall)
+
+    def __add(self, incident: Incident):
+        with self._lock:
+            self._incidents.append(incident)
+
+    @staticmethod
+    def __location(stack: traceback.StackSummary) -> str:
+        """
+        The innermost frame outside the standard library, the code that made the blocking call.
+        """
+        for frame in reversed(stack):
+            if not frame.filename.startswith(_STDLIB_PATHS):
+                return f"{frame.filename}:{frame.lineno} in {frame.name}"
+        return f"{stack[-1].filename}:{stack[-1].lineno} in {stack[-1].name}" if stack else ""
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """
+    Catches the "Executing <handle> took N seconds" warnings of the asyncio logger, coming from the watched loop.
+    """
+    def __init__(self, watchdog: LoopWatchdog):
+        super().__init__(logging.WARNING)
+        self.watchdog = watchdog
+
+    def emit(self, record: logging.LogRecord):
+        if record.thread != self.watchdog._loop_thread_id or not str(record.msg).startswith("Executing"):
+            return
+        if isinstance(record.args, tuple) and len(record.args) == 2:
+            handle, duration = record.args
+            self.watchdog.record_slow_callback(float(duration), str(handle))